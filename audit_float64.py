@@ -0,0 +1,103 @@
+"""
+Audit of the float64 arrays in the preprocessing and data loading hot paths.
+
+Runs every benchmark of benchmark_hot_paths.py once on the synthetic data tree
+(synthetic_data.py), in strict float32 mode and under float32_mode.audit():
+
+ - the functions decorated with float32_mode.float32_only raise when they return
+   float64 arrays of more than the threshold,
+ - the items yielded by the data iterators are checked the same way,
+ - the float64 arrays of more than the threshold that the code of this repository
+   creates with np.zeros, np.empty, ... are reported with their call site.
+
+Usage:
+    python audit_float64.py [--only <substring>] [--max-mb 1] [--quick]
+                            [--data-dir /tmp/lung-synthetic]
+
+Exits with status 1 if any float64 array above the threshold is found, or if any
+audited benchmark fails: its path was not checked.
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import float32_mode
+
+# before data_transforms and friends are imported, the decorators look at it at import time
+os.environ[float32_mode.ENV_VAR] = '1'
+
+import benchmark_hot_paths
+import synthetic_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', action='append', help='audit the benchmarks whose name contains this')
+    parser.add_argument('--max-mb', type=float, default=float32_mode.MAX_FLOAT64_BYTES / 2. ** 20,
+                        help='largest float64 array that is allowed, in MB')
+    parser.add_argument('--quick', action='store_true', help='small scans, for a smoke run')
+    parser.add_argument('--data-dir', default=tempfile.gettempdir() + '/lung-synthetic',
+                        help='where the synthetic data is built (and reused)')
+    args = parser.parse_args()
+    max_bytes = int(args.max_mb * 2 ** 20)
+
+    if args.quick:
+        shape = (64, 192, 192)
+        p_transform_scan = dict(benchmark_hot_paths.P_TRANSFORM_SCAN, patch_size=(160, 160, 160),
+                                mm_patch_size=(160, 160, 160))
+        data_dir = args.data_dir + '-quick'
+    else:
+        shape, p_transform_scan = synthetic_data.DEFAULT_SHAPE, benchmark_hot_paths.P_TRANSFORM_SCAN
+        data_dir = args.data_dir
+
+    print('Building synthetic data in', data_dir)
+    paths = synthetic_data.make_dataset(data_dir, shape=shape)
+    synthetic_data.activate(paths['root'])
+
+    check_item = lambda item: float32_mode.check(item, 'generate()', max_bytes)
+    benchmarks = benchmark_hot_paths.Benchmarks(paths, repeat=1, n_items=2, p_transform_scan=p_transform_scan,
+                                                check_item=check_item)
+    names = [n for n in benchmarks.names() if not args.only or any(o in n for o in args.only)]
+
+    findings = OrderedDict()
+    failures = OrderedDict()
+    for name in names:
+        problems = []
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+                    float32_mode.audit(max_bytes) as allocations:
+                benchmarks.run(name)
+        except float32_mode.Float64Error as e:
+            problems.append(str(e))
+        except Exception as e:
+            print('%-50s failed: %s: %s' % (name, type(e).__name__, e))
+            sys.stdout.flush()
+            failures[name] = e
+            continue
+        # the same call site allocates once per call, report it once
+        for fn_name, array_shape, caller in sorted(set(allocations), key=str):
+            problems.append('np.%s%s at %s' % (fn_name, array_shape, caller))
+
+        print('%-50s %s' % (name, 'float64!' if problems else 'ok'))
+        for problem in problems:
+            print('    ' + problem)
+        sys.stdout.flush()
+        if problems:
+            findings[name] = problems
+
+    if findings:
+        print('%d of %d audited hot paths use float64 arrays of more than %d bytes' % (
+            len(findings), len(names), max_bytes))
+    if failures:
+        print('%d of %d audited hot paths failed and were not checked: %s' % (
+            len(failures), len(names), ', '.join(failures)))
+    if findings or failures:
+        sys.exit(1)
+    print('No float64 arrays of more than %d bytes' % max_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""
+Benchmarks of the preprocessing and detection hot paths on synthetic data.
+
+Builds a synthetic data tree (synthetic_data.py) and times scan reading,
+the scan and candidate transforms, histogram equalization, the lung
+segmentations, blob detection, candidate filtering, target masks, heatmaps
+and the generate() of the main data iterators. The data iterators get data
+preparation functions like the ones of the configs they are used with; the
+configs themselves are not imported as they need lasagne and the real data.
+
+Usage:
+    python benchmark_hot_paths.py [--output results.json] [--compare previous.json]
+                                  [--only <substring>] [--repeat 5] [--quick]
+                                  [--data-dir /tmp/lung-synthetic]
+
+Every benchmark reports min/median/mean/max seconds per call. The results
+are written as JSON together with the git revision, so runs on different
+commits can be compared with --compare.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+
+import synthetic_data
+import utils
+
+# p_transform of configs_seg_scan/dsb_s2_p8a1 (the patch config has 1 mm voxels)
+P_TRANSFORM_SCAN = {'patch_size': (416, 416, 416),
+                    'mm_patch_size': (416, 416, 416),
+                    'pixel_spacing': (1., 1., 1.)}
+# p_transform of configs_fpred_patch/luna_c3, used by configs_fpred_scan
+P_TRANSFORM_PATCH = {'patch_size': (48, 48, 48),
+                     'mm_patch_size': (48, 48, 48),
+                     'pixel_spacing': (1., 1., 1.)}
+# p_transform of configs_seg_patch/luna_p8a1
+P_TRANSFORM_SEG_PATCH = {'patch_size': (64, 64, 64),
+                         'mm_patch_size': (64, 64, 64),
+                         'pixel_spacing': (1., 1., 1.)}
+# p_transform of the configs_class_dsb configs (dsb_a_eliasx40_relias28_s5_p8a1 for the heatmap)
+P_TRANSFORM_CLASS = {'patch_size': (48, 48, 48),
+                     'mm_patch_size': (48, 48, 48),
+                     'pixel_spacing': (1., 1., 1.),
+                     'order': 0,
+                     'heatmap_size': (48, 48, 48),
+                     'heatmap_order': 0,
+                     'heatmap_norm': 32.,
+                     'max_shape': (400, 400, 400)}
+P_TRANSFORM_AUGMENT = {'translation_range_z': [-5, 5],
+                       'translation_range_y': [-5, 5],
+                       'translation_range_x': [-5, 5],
+                       'rotation_range_z': [-10, 10],
+                       'rotation_range_y': [-10, 10],
+                       'rotation_range_x': [-10, 10]}
+N_CANDIDATES_PER_PATIENT = 12
+
+
+def time_calls(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start_time = time.time()
+        fn()
+        times.append(time.time() - start_time)
+    return times
+
+
+def time_generate(data_iterator, n_items, check_item=None):
+    """
+    Times the first n_items items of data_iterator.generate(), one time per item.
+    check_item, if given, is called with every item (outside of the timing).
+    """
+    times = []
+    generator = data_iterator.generate()
+    while len(times) < n_items:
+        start_time = time.time()
+        try:
+            item = next(generator)
+        except StopIteration:
+            break
+        times.append(time.time() - start_time)
+        if check_item is not None:
+            check_item(item)
+    generator.close()
+    return times
+
+
+def summarize(times):
+    times = np.asarray(times)
+    return OrderedDict([('n', len(times)),
+                        ('min', float(times.min())),
+                        ('median', float(np.median(times))),
+                        ('mean', float(times.mean())),
+                        ('max', float(times.max()))])
+
+
+# data preparation functions like the ones of the configs
+
+def seg_scan_data_prep(data, pixel_spacing, p_transform):
+    import data_transforms
+    import lung_segmentation
+    lung_mask = lung_segmentation.segment_HU_scan(data)
+    x, tf_matrix, lung_mask_out = data_transforms.transform_scan3d(data=data, pixel_spacing=pixel_spacing,
+                                                                   p_transform=p_transform, lung_mask=lung_mask,
+                                                                   p_transform_augment=None)
+    x = data_transforms.pixelnormHU(x)
+    return x, lung_mask_out, tf_matrix
+
+
+def fpred_data_prep(data, patch_center, pixel_spacing, p_transform):
+    import data_transforms
+    x, patch_annotation_tf = data_transforms.transform_patch3d(data=data, luna_annotations=None,
+                                                               patch_center=patch_center, p_transform=p_transform,
+                                                               p_transform_augment=None,
+                                                               pixel_spacing=pixel_spacing, luna_origin=None,
+                                                               world_coord_system=False)
+    return data_transforms.pixelnormHU(x)
+
+
+def seg_patch_data_prep(data, patch_center, luna_annotations, pixel_spacing, luna_origin, p_transform,
+                        p_transform_augment):
+    import data_transforms
+    x, patch_annotation_tf, annotations_tf = data_transforms.transform_patch3d(
+        data=data, luna_annotations=luna_annotations, patch_center=patch_center, p_transform=p_transform,
+        p_transform_augment=p_transform_augment, pixel_spacing=pixel_spacing, luna_origin=luna_origin)
+    x = data_transforms.pixelnormHU(x)
+    y = data_transforms.make_3d_mask_from_annotations(img_shape=x.shape, annotations=annotations_tf,
+                                                      shape='sphere')
+    return x, y
+
+
+def class_data_prep(data, patch_centers, pixel_spacing, p_transform, p_transform_augment, **kwargs):
+    import data_transforms
+    x = data_transforms.transform_dsb_candidates(data=data, patch_centers=patch_centers, p_transform=p_transform,
+                                                 p_transform_augment=p_transform_augment,
+                                                 pixel_spacing=pixel_spacing)
+    return data_transforms.hu2normHU(x)
+
+
+def heatmap_data_prep(data_shapes, candidates, pixel_spacings, p_transform, p_transform_augment, out=None,
+                      **kwargs):
+    import data_transforms
+    return data_transforms.build_dsb_can_heatmaps(data_shapes=data_shapes, candidates=candidates,
+                                                  pixel_spacings=pixel_spacings, p_transform=p_transform,
+                                                  p_transform_augment=p_transform_augment, out=out)
+
+
+def candidates_prep(all_candidates, n_selection=None):
+    if n_selection:
+        all_candidates = all_candidates[:n_selection]
+    return all_candidates
+
+
+def heatmap_candidates_prep(all_candidates, n_selection=None):
+    return all_candidates[:, [0, 1, 2, 4]]
+
+
+class Benchmarks(object):
+    def __init__(self, paths, repeat, n_items, p_transform_scan, check_item=None):
+        self.paths = paths
+        self.repeat = repeat
+        self.n_items = n_items
+        self.p_transform_scan = p_transform_scan
+        self.check_item = check_item
+        self._cache = {}
+
+    def _dsb_patient_paths(self):
+        import utils_lung
+        return utils_lung.get_patient_data_paths(self.paths['dsb'])
+
+    def _scan(self):
+        if 'scan' not in self._cache:
+            import utils_lung
+            self._cache['scan'] = utils_lung.read_dicom_scan(self._dsb_patient_paths()[0])
+        return self._cache['scan']
+
+    def _candidates(self):
+        import utils_lung
+        pid = utils_lung.extract_pid_dir(self._dsb_patient_paths()[0])
+        return utils.load_pkl(self.paths['candidates'] + '/%s.pkl' % pid)
+
+    def _prediction_map(self):
+        """
+        A segmentation network output like volume: gaussian blobs at the nodules of a resampled scan.
+        """
+        if 'prediction_map' not in self._cache:
+            import data_transforms
+            shape = (128, 128, 128)
+            rng = np.random.RandomState(0)
+            annotations = np.column_stack([rng.uniform(10, 118, size=(20, 3)), rng.uniform(4, 20, size=20)])
+            self._cache['prediction_map'] = np.float32(
+                data_transforms.make_3d_mask_from_annotations(shape, annotations, shape='gauss'))
+        return self._cache['prediction_map']
+
+    # scan reading
+
+    def bench_read_dicom_scan(self):
+        import utils_lung
+        path = self._dsb_patient_paths()[0]
+        return time_calls(lambda: utils_lung.read_dicom_scan(path), self.repeat)
+
+    def bench_read_mhd(self):
+        import utils_lung
+        path = sorted(p for p in utils_lung.get_patient_data_paths(self.paths['luna']) if p.endswith('.mhd'))[0]
+        return time_calls(lambda: utils_lung.read_mhd(path), self.repeat)
+
+    # transforms
+
+    def bench_transform_scan3d(self):
+        import data_transforms
+        img, pixel_spacing = self._scan()
+        return time_calls(lambda: data_transforms.transform_scan3d(img, pixel_spacing, self.p_transform_scan),
+                          self.repeat)
+
+    def bench_transform_dsb_candidates(self):
+        import data_transforms
+        img, pixel_spacing = self._scan()
+        patch_centers = self._candidates()[:N_CANDIDATES_PER_PATIENT]
+        return time_calls(lambda: data_transforms.transform_dsb_candidates(
+            img, patch_centers, pixel_spacing, P_TRANSFORM_CLASS, P_TRANSFORM_AUGMENT), self.repeat)
+
+    def bench_histogram_equalization(self):
+        import data_transforms
+        img, pixel_spacing = self._scan()
+        return time_calls(lambda: data_transforms.histogram_equalization(img), self.repeat)
+
+    def bench_make_3d_mask_from_annotations_sphere(self):
+        import data_transforms
+        annotations = np.array([[20., 30., 32., 10.], [40., 12., 50., 6.], [5., 5., 5., 20.]])
+        shape = P_TRANSFORM_SEG_PATCH['patch_size']
+        return time_calls(lambda: data_transforms.make_3d_mask_from_annotations(shape, annotations, 'sphere'),
+                          self.repeat)
+
+    def bench_make_3d_mask_from_annotations_gauss(self):
+        import data_transforms
+        annotations = np.array([[20., 30., 32., 10.], [40., 12., 50., 6.], [5., 5., 5., 20.]])
+        shape = P_TRANSFORM_SEG_PATCH['patch_size']
+        return time_calls(lambda: data_transforms.make_3d_mask_from_annotations(shape, annotations, 'gauss'),
+                          self.repeat)
+
+    def bench_build_dsb_can_heatmap(self):
+        import data_transforms
+        img, pixel_spacing = self._scan()
+        candidates = heatmap_candidates_prep(self._candidates())
+        return time_calls(lambda: data_transforms.build_dsb_can_heatmap(
+            img.shape, candidates, pixel_spacing, P_TRANSFORM_CLASS, P_TRANSFORM_AUGMENT), self.repeat)
+
+    # lung segmentation
+
+    def _bench_segmentation(self, fn):
+        img, pixel_spacing = self._scan()
+        return time_calls(lambda: fn(img), self.repeat)
+
+    def bench_segment_HU_scan(self):
+        import lung_segmentation
+        return self._bench_segmentation(lung_segmentation.segment_HU_scan)
+
+    def bench_segment_HU_scan_frederic(self):
+        import lung_segmentation
+        return self._bench_segmentation(lung_segmentation.segment_HU_scan_frederic)
+
+    def bench_segment_HU_scan_elias(self):
+        import lung_segmentation
+        return self._bench_segmentation(lung_segmentation.segment_HU_scan_elias)
+
+    def bench_segment_HU_scan_ira(self):
+        import lung_segmentation
+        return self._bench_segmentation(lung_segmentation.segment_HU_scan_ira)
+
+    # detection
+
+    def bench_blob_dog(self):
+        import blobs_detection
+        prediction_map = self._prediction_map()
+        # the parameters of the seg scan scripts
+        return time_calls(lambda: blobs_detection.blob_dog(prediction_map, min_sigma=1, max_sigma=15,
+                                                           threshold=0.1), self.repeat)
+
+    def bench_prune_blobs(self):
+        import blobs_detection
+        rng = np.random.RandomState(0)
+        blobs = np.column_stack([rng.uniform(0, 400, size=(2000, 3)), rng.uniform(1, 15, size=2000)])
+        return time_calls(lambda: blobs_detection._prune_blobs(blobs.copy(), .5), self.repeat)
+
+    def bench_filter_close_neighbors(self):
+        import utils_lung
+        rng = np.random.RandomState(0)
+        candidates = np.column_stack([rng.uniform(0, 400, size=(1000, 3)), rng.uniform(2, 20, size=1000),
+                                      rng.uniform(size=1000)])
+        return time_calls(lambda: utils_lung.filter_close_neighbors(candidates), self.repeat)
+
+    # data iterators
+
+    def bench_generate_DSBScanLungMaskDataGenerator(self):
+        import data_iterators
+        data_iterator = data_iterators.DSBScanLungMaskDataGenerator(
+            data_path=self.paths['dsb'], transform_params=self.p_transform_scan,
+            data_prep_fun=partial(seg_scan_data_prep, p_transform=self.p_transform_scan))
+        return time_generate(data_iterator, self.n_items, self.check_item)
+
+    def bench_generate_CandidatesDSBDataGenerator(self):
+        import data_iterators
+        import utils_lung
+        data_iterator = data_iterators.CandidatesDSBDataGenerator(
+            data_path=self.paths['dsb'], transform_params=P_TRANSFORM_PATCH,
+            id2candidates_path=utils_lung.get_candidates_paths(self.paths['candidates']),
+            data_prep_fun=partial(fpred_data_prep, p_transform=P_TRANSFORM_PATCH))
+        return time_generate(data_iterator, 10 * self.n_items, self.check_item)
+
+    def bench_generate_PatchPositiveLunaDataGenerator(self):
+        import data_iterators
+        data_iterator = data_iterators.PatchPositiveLunaDataGenerator(
+            data_path=self.paths['luna'], batch_size=4, transform_params=P_TRANSFORM_SEG_PATCH,
+            data_prep_fun=partial(seg_patch_data_prep, p_transform=P_TRANSFORM_SEG_PATCH,
+                                  p_transform_augment=P_TRANSFORM_AUGMENT),
+            rng=np.random.RandomState(42), full_batch=False, random=True, infinite=True)
+        return time_generate(data_iterator, self.n_items, self.check_item)
+
+    def bench_generate_DSBPatientsDataGenerator(self):
+        import data_iterators
+        import utils_lung
+        id2candidates_path = utils_lung.get_candidates_paths(self.paths['candidates'])
+        data_iterator = data_iterators.DSBPatientsDataGenerator(
+            data_path=self.paths['dsb'], batch_size=1, transform_params=P_TRANSFORM_CLASS,
+            id2candidates_path=id2candidates_path, id2label=utils_lung.read_labels(self.paths['labels']),
+            data_prep_fun=partial(class_data_prep, p_transform=P_TRANSFORM_CLASS,
+                                  p_transform_augment=P_TRANSFORM_AUGMENT),
+            n_candidates_per_patient=N_CANDIDATES_PER_PATIENT, rng=np.random.RandomState(42), random=True,
+            infinite=True, candidates_prep_fun=candidates_prep, patient_ids=sorted(id2candidates_path.keys()))
+        return time_generate(data_iterator, self.n_items, self.check_item)
+
+    def bench_generate_DSBPatientsDataGenerator_only_heatmap(self):
+        import data_iterators
+        import utils_lung
+        id2candidates_path = utils_lung.get_candidates_paths(self.paths['candidates'])
+        data_iterator = data_iterators.DSBPatientsDataGenerator_only_heatmap(
+            data_path=self.paths['dsb'], batch_size=1, transform_params=P_TRANSFORM_CLASS,
+            id2candidates_path=id2candidates_path,
+            data_prep_fun=partial(heatmap_data_prep, p_transform=P_TRANSFORM_CLASS,
+                                  p_transform_augment=P_TRANSFORM_AUGMENT),
+            n_candidates_per_patient=N_CANDIDATES_PER_PATIENT, rng=np.random.RandomState(42), random=True,
+            infinite=True, candidates_prep_fun=heatmap_candidates_prep,
+            patient_ids=sorted(id2candidates_path.keys()))
+        return time_generate(data_iterator, self.n_items, self.check_item)
+
+    def names(self):
+        return [name[len('bench_'):] for name in dir(self) if name.startswith('bench_')]
+
+    def run(self, name):
+        return getattr(self, 'bench_' + name)()
+
+
+def get_environment():
+    import scipy
+    revision = utils.get_git_revision_hash()
+    return OrderedDict([('git_revision', revision.decode() if isinstance(revision, bytes) else revision),
+                        ('hostname', utils.hostname()),
+                        ('platform', platform.platform()),
+                        ('python', platform.python_version()),
+                        ('numpy', np.__version__),
+                        ('scipy', scipy.__version__),
+                        ('cpu_count', os.cpu_count()),
+                        ('time', time.strftime('%Y-%m-%d %H:%M:%S'))])
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print()
+    print('Compared to %s (%s)' % (previous_path, previous['environment'].get('git_revision')))
+    print('  %-50s %12s %12s %8s' % ('benchmark', 'before ms', 'now ms', 'speedup'))
+    for name, result in results.items():
+        before = previous['results'].get(name)
+        if 'median' not in result or not before or 'median' not in before:
+            continue
+        print('  %-50s %12.2f %12.2f %7.2fx' % (name, 1000. * before['median'], 1000. * result['median'],
+                                               before['median'] / result['median']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--only', action='append', help='run the benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per benchmark')
+    parser.add_argument('--items', type=int, default=4, help='items timed per data iterator')
+    parser.add_argument('--quick', action='store_true', help='small scans, for a smoke run')
+    parser.add_argument('--data-dir', default=tempfile.gettempdir() + '/lung-synthetic',
+                        help='where the synthetic data is built (and reused)')
+    args = parser.parse_args()
+    # the synthetic data tree becomes the working directory below
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    environment = get_environment()
+    if args.quick:
+        shape, p_transform_scan = (64, 192, 192), dict(P_TRANSFORM_SCAN, patch_size=(160, 160, 160),
+                                                       mm_patch_size=(160, 160, 160))
+        data_dir, args.repeat, args.items = args.data_dir + '-quick', min(args.repeat, 2), min(args.items, 2)
+    else:
+        shape, p_transform_scan = synthetic_data.DEFAULT_SHAPE, P_TRANSFORM_SCAN
+        data_dir = args.data_dir
+
+    print('Building synthetic data in', data_dir)
+    paths = synthetic_data.make_dataset(data_dir, shape=shape)
+    synthetic_data.activate(paths['root'])
+
+    benchmarks = Benchmarks(paths, args.repeat, args.items, p_transform_scan)
+    names = [n for n in benchmarks.names() if not args.only or any(o in n for o in args.only)]
+
+    results = OrderedDict()
+    for name in names:
+        try:
+            # the code under test prints a lot, keep the report readable
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                times = benchmarks.run(name)
+            result = summarize(times)
+            print('%-50s median %10.2f ms  min %10.2f ms  (n=%d)' % (name, 1000. * result['median'],
+                                                                   1000. * result['min'], result['n']))
+        except Exception as e:
+            result = {'error': '%s: %s' % (type(e).__name__, e)}
+            print('%-50s failed: %s' % (name, result['error']))
+        sys.stdout.flush()
+        results[name] = result
+
+    report = OrderedDict([('environment', environment),
+                          ('parameters', OrderedDict([('shape', list(shape)), ('repeat', args.repeat),
+                                                      ('items', args.items),
+                                                      ('scan_patch_size', list(p_transform_scan['patch_size']))])),
+                          ('results', results)])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to', output)
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+End-to-end throughput of the scoring pipeline on synthetic scans.
+
+Runs pipeline.Pipeline (segmentation, blob detection, false positive
+reduction, properties and classification) over the DICOM patients of a
+synthetic data tree (synthetic_data.py), with small random-weight stand-in
+models that take the input shapes of the configs_seg_scan, configs_fpred_scan
+and configs_class_dsb models. The data preparation is that of the configs
+(see benchmark_hot_paths.py). The segmentation stand-in adds a fixed
+intensity detector to its random layers, so that blob_dog finds the synthetic
+nodules and the later stages get a realistic number of candidates.
+
+For every stage it reports the wall time per patient, the CPU utilization
+(CPU seconds per wall second, above 1 when several cores are busy) and the
+memory high-water mark of the process after the stage, and for the whole run
+the number of patients per hour.
+
+Usage:
+    python benchmark_pipeline.py [--patients 4] [--quick]
+                                 [--output results.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+
+import benchmark_hot_paths
+import profiling
+import synthetic_data
+
+Model = namedtuple('Model', ['l_in', 'l_out'])
+
+# window of configs_seg_scan/dsb_s2_p8a1, the scan patch size is benchmark_hot_paths.P_TRANSFORM_SCAN
+SEG_WINDOW_SIZE = 160
+SEG_STRIDE = 128
+N_PROPERTIES = 10
+STAGES = ('load_scan', 'segment', 'reduce_false_positives', 'predict_properties', 'classify')
+
+
+def _conv_trunk(l):
+    import lasagne as nn
+    l = nn.layers.Conv3DLayer(l, num_filters=8, filter_size=3, stride=2)
+    l = nn.layers.Conv3DLayer(l, num_filters=16, filter_size=3, stride=2)
+    return nn.layers.GlobalPoolLayer(l)
+
+
+def build_seg_model(window_size, stride):
+    import lasagne as nn
+    l_in = nn.layers.InputLayer((None, 1, window_size, window_size, window_size))
+    l_features = nn.layers.Conv3DLayer(l_in, num_filters=8, filter_size=3, pad='same')
+    l = nn.layers.ConcatLayer([l_in, l_features])
+    # dense tissue (the input is pixelnormHU) lights up, the random features only add noise
+    W = np.float32(0.01 * np.random.RandomState(0).randn(1, 9, 1, 1, 1))
+    W[0, 0] = 8.
+    l = nn.layers.Conv3DLayer(l, num_filters=1, filter_size=1, W=W, b=nn.init.Constant(-2.),
+                              nonlinearity=nn.nonlinearities.sigmoid)
+    crop = (window_size - stride) // 2
+    for axis in (2, 3, 4):
+        l = nn.layers.SliceLayer(l, indices=slice(crop, crop + stride), axis=axis)
+    return Model(l_in, l)
+
+
+def build_patch_model(patch_size, num_units, nonlinearity):
+    import lasagne as nn
+    l_in = nn.layers.InputLayer((None, 1) + tuple(patch_size))
+    l_out = nn.layers.DenseLayer(_conv_trunk(l_in), num_units=num_units, nonlinearity=nonlinearity)
+    return Model(l_in, l_out)
+
+
+def build_class_model(n_candidates, patch_size):
+    import lasagne as nn
+    import theano.tensor as T
+    l_in = nn.layers.InputLayer((None, n_candidates) + tuple(patch_size))
+    l = nn.layers.ReshapeLayer(l_in, (-1, 1) + tuple(patch_size))
+    l = nn.layers.DenseLayer(_conv_trunk(l), num_units=1, nonlinearity=nn.nonlinearities.sigmoid)
+    l = nn.layers.ReshapeLayer(l, (-1, n_candidates))
+    l_out = nn.layers.ExpressionLayer(l, lambda p: 1. - T.prod(1. - p, axis=1, keepdims=True),
+                                      output_shape=(None, 1))
+    return Model(l_in, l_out)
+
+
+class StandInModels(object):
+    """
+    Has the attributes pipeline.Pipeline uses of pipeline.WarmModels, with stand-in models.
+    """
+
+    def __init__(self, p_transform_scan, window_size, stride):
+        import lasagne as nn
+        import theano
+
+        import compile_cache
+        import pipeline
+
+        nn.random.set_rng(np.random.RandomState(317070))
+        n_windows = (p_transform_scan['patch_size'][0] - window_size) // stride + 1
+        p_transform_patch = benchmark_hot_paths.P_TRANSFORM_PATCH
+        p_transform_class = benchmark_hot_paths.P_TRANSFORM_CLASS
+        n_candidates = benchmark_hot_paths.N_CANDIDATES_PER_PATIENT
+
+        self.seg_config_name = 'standin_seg'
+        self.fpred_config_name = 'standin_fpred'
+        self.props_config_name = 'standin_props'
+        self.class_config_name = 'standin_class'
+        self.class_uses_props = False
+
+        self.seg_config = SimpleNamespace(
+            window_size=window_size, stride=stride, n_windows=n_windows, p_transform=p_transform_scan,
+            data_iterator=SimpleNamespace(data_prep_fun=partial(benchmark_hot_paths.seg_scan_data_prep,
+                                                                p_transform=p_transform_scan)))
+        patch_iterator = SimpleNamespace(data_prep_fun=partial(benchmark_hot_paths.fpred_data_prep,
+                                                               p_transform=p_transform_patch))
+        self.fpred_config = SimpleNamespace(p_transform=p_transform_patch, data_iterator=patch_iterator)
+        self.props_config = SimpleNamespace(p_transform=p_transform_patch, data_iterator=patch_iterator)
+        self.class_config = SimpleNamespace(
+            p_transform=p_transform_class,
+            test_data_iterator=SimpleNamespace(
+                n_candidates_per_patient=n_candidates, transform_params=p_transform_class,
+                candidates_prep_fun=benchmark_hot_paths.candidates_prep,
+                data_prep_fun=partial(benchmark_hot_paths.class_data_prep, p_transform=p_transform_class,
+                                      p_transform_augment=None)))
+
+        self.predict_seg = pipeline.compile_predict_fn(build_seg_model(window_size, stride), 'standin_seg')
+        self.predict_fpred = pipeline.compile_predict_fn(
+            build_patch_model(p_transform_patch['patch_size'], 2, nn.nonlinearities.softmax), 'standin_fpred')
+        self.predict_props = pipeline.compile_predict_fn(
+            build_patch_model(p_transform_patch['patch_size'], N_PROPERTIES, nn.nonlinearities.sigmoid),
+            'standin_props')
+        class_model = build_class_model(n_candidates, p_transform_class['patch_size'])
+        self.predict_class = compile_cache.function([class_model.l_in.input_var],
+                                                    nn.layers.get_output(class_model.l_out, deterministic=True),
+                                                    name='standin_class')
+        print('theano device: %s, floatX: %s' % (theano.config.device, theano.config.floatX))
+
+
+class StageRecorder(object):
+    """
+    Records wall time, CPU time and the memory high-water mark of named stages.
+    """
+
+    def __init__(self):
+        self.records = OrderedDict((stage, []) for stage in STAGES)
+
+    def record(self, stage, fn, *args, **kwargs):
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        start_time = time.time()
+        result = fn(*args, **kwargs)
+        wall = time.time() - start_time
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+        self.records.setdefault(stage, []).append((wall, cpu, profiling.peak_rss_mb()))
+        return result
+
+    def summary(self):
+        results = OrderedDict()
+        for stage, records in self.records.items():
+            if not records:
+                continue
+            wall, cpu, peak_rss = (np.asarray(r) for r in zip(*records))
+            result = benchmark_hot_paths.summarize(wall)
+            result['cpu_utilization'] = float(cpu.sum() / wall.sum()) if wall.sum() > 0 else 0.
+            result['peak_rss_mb'] = float(peak_rss.max())
+            results[stage] = result
+        return results
+
+
+def instrument(pipeline_obj, recorder):
+    """
+    Routes the stage methods of a pipeline.Pipeline through recorder.
+    """
+    for stage in STAGES[1:]:
+        setattr(pipeline_obj, stage, partial(recorder.record, stage, getattr(pipeline_obj, stage)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type=int, default=4, help='synthetic patients to score')
+    parser.add_argument('--quick', action='store_true', help='small scans and windows, for a smoke run')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--data-dir', default=tempfile.gettempdir() + '/lung-synthetic-pipeline',
+                        help='where the synthetic data is built (and reused)')
+    args = parser.parse_args()
+    # the synthetic data tree becomes the working directory below
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    environment = benchmark_hot_paths.get_environment()
+    if args.quick:
+        shape, window_size, stride = (64, 192, 192), 64, 48
+        p_transform_scan = dict(benchmark_hot_paths.P_TRANSFORM_SCAN, patch_size=(160, 160, 160),
+                                mm_patch_size=(160, 160, 160))
+        data_dir = args.data_dir + '-quick'
+    else:
+        shape, window_size, stride = synthetic_data.DEFAULT_SHAPE, SEG_WINDOW_SIZE, SEG_STRIDE
+        p_transform_scan = benchmark_hot_paths.P_TRANSFORM_SCAN
+        data_dir = args.data_dir
+
+    print('Building synthetic data in', data_dir)
+    paths = synthetic_data.make_dataset(data_dir, n_dsb=args.patients, n_luna=1, shape=shape)
+    synthetic_data.activate(paths['root'])
+
+    import pipeline
+    import utils_lung
+
+    print('Building and compiling the stand-in models')
+    start_time = time.time()
+    models = StandInModels(p_transform_scan, window_size, stride)
+    compile_time = time.time() - start_time
+
+    recorder = StageRecorder()
+    scoring_pipeline = pipeline.Pipeline(models)
+    instrument(scoring_pipeline, recorder)
+
+    n_blobs, n_candidates = [], []
+    start_time = time.time()
+    for patient_path in utils_lung.get_patient_data_paths(paths['dsb'])[:args.patients]:
+        scan = recorder.record('load_scan', pipeline.load_scan, patient_path)
+        result = scoring_pipeline.run(scan)
+        n_blobs.append(len(result['blobs']))
+        n_candidates.append(len(result['fpred_candidates']))
+        print('%s: %d blobs, p(cancer) %.3f, %s' % (scan.pid, n_blobs[-1], result['cancer_probability'],
+                                                    ', '.join('%s %.1f s' % t for t in result['timings'].items())))
+    total_time = time.time() - start_time
+
+    results = recorder.summary()
+    print()
+    print('%-25s %10s %10s %8s %12s' % ('stage', 'median s', 'mean s', 'CPU', 'peak RSS MB'))
+    for stage, r in results.items():
+        print('%-25s %10.2f %10.2f %7.2fx %12.0f' % (stage, r['median'], r['mean'], r['cpu_utilization'],
+                                                   r['peak_rss_mb']))
+    patients_per_hour = 3600. * len(n_blobs) / total_time if total_time > 0 else 0.
+    print('%d patients in %.1f s: %.1f patients/hour (compilation %.1f s not included)' % (
+        len(n_blobs), total_time, patients_per_hour, compile_time))
+
+    report = OrderedDict([('environment', environment),
+                          ('parameters', OrderedDict([('shape', list(shape)), ('patients', len(n_blobs)),
+                                                      ('scan_patch_size', list(p_transform_scan['patch_size'])),
+                                                      ('window_size', window_size), ('stride', stride)])),
+                          ('total', OrderedDict([('wall', total_time), ('patients_per_hour', patients_per_hour),
+                                                 ('compile_time', compile_time),
+                                                 ('mean_blobs', float(np.mean(n_blobs)) if n_blobs else 0.),
+                                                 ('mean_candidates',
+                                                  float(np.mean(n_candidates)) if n_candidates else 0.)])),
+                          ('results', results)])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to', output)
+    if previous:
+        benchmark_hot_paths.compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
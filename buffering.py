@@ -1,6 +1,14 @@
 import multiprocessing as mp
-import Queue
+import queue
 import threading
+import weakref
+from collections import defaultdict
+
+import numpy as np
+
+import profiling
+
+DEFAULT_BUFFER_SIZE = 5
 
 
 def buffered_gen_mp(source_gen, buffer_size=2):
@@ -17,7 +25,7 @@ def buffered_gen_mp(source_gen, buffer_size=2):
     # will generate one extra element and block until there is room in the buffer.
 
     def _buffered_generation_process(source_gen, buffer):
-        for data in source_gen:
+        for data in profiling.profile_iterator(source_gen):
             buffer.put(data, block=True)
         buffer.put(None)  # sentinel: signal the end of the iterator
         buffer.close()  # unfortunately this does not suffice as a signal: if buffer.get()
@@ -30,7 +38,7 @@ def buffered_gen_mp(source_gen, buffer_size=2):
         yield data
 
 
-def buffered_gen_threaded(source_gen, buffer_size=5):
+def buffered_gen_threaded(source_gen, buffer_size=DEFAULT_BUFFER_SIZE):
     """
     Generator that runs a slow source generator in a separate thread. Beware of the GIL!
     buffer_size: the maximal number of items to pre-generate (length of the buffer)
@@ -38,13 +46,13 @@ def buffered_gen_threaded(source_gen, buffer_size=5):
     if buffer_size < 2:
         raise RuntimeError("Minimal buffer size is 2!")
 
-    buffer = Queue.Queue(maxsize=buffer_size - 1)
+    buffer = queue.Queue(maxsize=buffer_size - 1)
 
     # the effective buffer size is one less, because the generation process
     # will generate one extra element and block until there is room in the buffer.
 
     def _buffered_generation_thread(source_gen, buffer):
-        for data in source_gen:
+        for data in profiling.profile_iterator(source_gen):
             buffer.put(data, block=True)
         buffer.put(None)  # sentinel: signal the end of the iterator
 
@@ -54,3 +62,87 @@ def buffered_gen_threaded(source_gen, buffer_size=5):
 
     for data in iter(buffer.get, None):
         yield data
+
+
+class BatchPool(object):
+    """
+    Recycled batch arrays for the data iterators.
+
+    zeros() and empty() hand out an array of the pool if one of the right shape and
+    dtype was given back with release(), and allocate a new one otherwise, so an
+    iterator whose consumer never releases its batches behaves as with np.zeros.
+    A consumer releases a batch once it is done with it, typically right after
+    set_value() copied it to the device:
+
+        for x_chunk, y_chunk, ids in buffering.buffered_gen_threaded(data_iterator.generate()):
+            x_shared.set_value(x_chunk)
+            y_shared.set_value(y_chunk)
+            buffering.release(x_chunk, y_chunk)
+
+    At most size arrays per shape and dtype are kept. With buffered_gen_threaded,
+    buffer_size - 1 batches wait in the queue, one is being filled and one is being
+    consumed, so the default size lets the iterators run without allocating.
+    """
+
+    def __init__(self, size=DEFAULT_BUFFER_SIZE + 1):
+        self.size = size
+        self.n_allocated = 0
+        self._free = defaultdict(list)
+        # the arrays handed out, without keeping them alive
+        self._owned = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    def _get(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            if self._free[key]:
+                return self._free[key].pop(), False
+            self.n_allocated += 1
+        a = np.zeros(key[0], dtype=key[1])
+        self._owned[id(a)] = a
+        return a, True
+
+    def zeros(self, shape, dtype='float32'):
+        a, new = self._get(shape, dtype)
+        if not new:
+            a.fill(0)
+        return a
+
+    def empty(self, shape, dtype='float32'):
+        """
+        Like zeros(), but a recycled array keeps its old values: for batches that are
+        overwritten completely.
+        """
+        return self._get(shape, dtype)[0]
+
+    def release(self, a):
+        """
+        Gives a back to the pool. Returns False if a was not handed out by this pool.
+        """
+        if not isinstance(a, np.ndarray) or self._owned.get(id(a)) is not a:
+            return False
+        key = (a.shape, a.dtype.str)
+        with self._lock:
+            free = self._free[key]
+            if len(free) < self.size and not any(f is a for f in free):
+                free.append(a)
+        return True
+
+
+_pools = weakref.WeakSet()
+
+
+def release(*items):
+    """
+    Gives the arrays in items (arrays, or tuples and lists of them such as the items
+    of a data iterator) back to the BatchPool they came from. Other values are ignored.
+    Only release a batch when nothing refers to it anymore: the iterator refills it.
+    """
+    for item in items:
+        if isinstance(item, (tuple, list)):
+            release(*item)
+        elif isinstance(item, np.ndarray):
+            for pool in list(_pools):
+                if pool.release(item):
+                    break
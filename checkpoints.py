@@ -0,0 +1,350 @@
+"""
+Model checkpoints as uncompressed npz files.
+
+Every parameter is stored as its own float32 array, next to a JSON header with
+the parameter names and the training metadata (configuration, experiment id,
+chunk index and loss histories) that the pickled metadata dicts used to hold.
+utils.load_model_metadata() returns the same dict for both formats, so code
+that loads a trained model does not care which one it gets.
+
+AsyncCheckpointWriter snapshots the parameters on the training thread and
+writes them in the background, to a temporary file that is renamed into place,
+so a crash during a save never corrupts the last good checkpoint.
+
+The arrays of a checkpoint are memory-mapped straight from the npz file and
+load_params() sets only the parameters of the layers that are asked for, by
+layer name or prefix. Old pickles are converted with
+
+    python checkpoints.py <metadata.pkl> [<config_package> <config_name>]
+
+which writes <metadata>.npz next to the pickle; load_params() picks it up
+instead of the pickle. With a config, the parameters get the layer names of its
+build_model(), otherwise they can only be loaded all at once, in order.
+Format 1 checkpoints, written before the naming of unnamed layers changed,
+are still matched by name with the old scheme (get_param_names_v1).
+"""
+import importlib
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import zipfile
+from collections import OrderedDict
+
+import lasagne as nn
+import numpy as np
+
+import utils
+
+HEADER_KEY = '__header__'
+PARAM_KEY = 'param_%04d'
+# format 1 checkpoints name unnamed layers after their position in the network (get_param_names_v1)
+FORMAT = 2
+
+
+def get_param_names(l_out):
+    """
+    Names of the parameters of the network in the order of get_all_params: <layer name>.<param name>.
+    Unnamed layers are called after their class and how many layers of that class
+    with parameters come before them, so the names do not depend on the layers
+    without parameters, like the input layers, in front of a network.
+    """
+    names, seen = [], set()
+    class_counts = {}
+    for layer in nn.layers.get_all_layers(l_out):
+        params = [p for p in layer.get_params() if p not in seen]
+        if not params:
+            continue
+        class_name = layer.__class__.__name__
+        class_counts[class_name] = class_counts.get(class_name, 0) + 1
+        layer_name = layer.name or '%s%d' % (class_name, class_counts[class_name] - 1)
+        for param in params:
+            seen.add(param)
+            name = '%s.%s' % (layer_name, param.name)
+            if name in names:
+                name = '%s%d.%s' % (layer_name, class_counts[class_name] - 1, param.name)
+            names.append(name)
+    return names
+
+
+def get_param_names_v1(l_out):
+    """
+    The parameter names of format 1 checkpoints: unnamed layers are called after
+    their class and position among all layers of the network.
+    """
+    names, seen = [], set()
+    for i, layer in enumerate(nn.layers.get_all_layers(l_out)):
+        layer_name = layer.name or '%s_%d' % (layer.__class__.__name__, i)
+        for param in layer.get_params():
+            if param in seen:
+                continue
+            seen.add(param)
+            name = '%s.%s' % (layer_name, param.name)
+            if name in names:
+                name = '%s_%d.%s' % (layer_name, i, param.name)
+            names.append(name)
+    return names
+
+
+def _to_json(obj):
+    if isinstance(obj, dict):
+        return dict((k, _to_json(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_to_json(v) for v in obj]
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    return obj
+
+
+def save_checkpoint(path, metadata, param_values, param_names=None):
+    """
+    Writes metadata (without param_values) and the parameters to path, atomically.
+    """
+    metadata = dict((k, v) for k, v in metadata.items() if k != 'param_values')
+    if param_names is None:
+        param_names = [PARAM_KEY % i for i in range(len(param_values))]
+    header = {'format': FORMAT,
+              'param_names': param_names,
+              'param_shapes': [list(v.shape) for v in param_values],
+              'metadata': _to_json(metadata)}
+
+    arrays = OrderedDict()
+    arrays[HEADER_KEY] = np.frombuffer(json.dumps(header).encode('utf-8'), dtype='uint8')
+    for i, v in enumerate(param_values):
+        arrays[PARAM_KEY % i] = np.asarray(v, dtype='float32')
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Checkpoint(object):
+    """
+    Name-indexed view on a checkpoint file; the parameters are memory-mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as zf:
+            self._infos = dict((info.filename[:-len('.npy')], info) for info in zf.infolist())
+        header = json.loads(self._read(HEADER_KEY).tobytes().decode('utf-8'))
+        self.metadata = header['metadata']
+        self.format = header.get('format', 1)
+        self.param_names = header['param_names']
+        self._keys = dict((name, PARAM_KEY % i) for i, name in enumerate(self.param_names))
+
+    @property
+    def has_layer_names(self):
+        return self.param_names != [PARAM_KEY % i for i in range(len(self.param_names))]
+
+    def _read(self, key):
+        info = self._infos[key]
+        if info.compress_type != zipfile.ZIP_STORED:
+            with np.load(self.path) as npz:
+                return npz[key]
+        with open(self.path, 'rb') as f:
+            # the array data follows the local zip header and the .npy header of the member
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if not shape or 0 in shape:
+            with np.load(self.path) as npz:
+                return npz[key]
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                         order='F' if fortran_order else 'C')
+
+    def __contains__(self, name):
+        return name in self._keys
+
+    def __getitem__(self, name):
+        return self._read(self._keys[name])
+
+    def param_values(self):
+        return [self._read(PARAM_KEY % i) for i in range(len(self.param_names))]
+
+
+def load_checkpoint(path):
+    """
+    Returns the metadata dict of a checkpoint, with its parameters under 'param_values'.
+    """
+    checkpoint = Checkpoint(path)
+    metadata = dict(checkpoint.metadata)
+    metadata['param_names'] = checkpoint.param_names
+    metadata['param_values'] = checkpoint.param_values()
+    return metadata
+
+
+def resolve_path(path):
+    """
+    Prefers the converted checkpoint next to a pickle.
+    """
+    if path.endswith('.pkl') and os.path.isfile(path[:-len('.pkl')] + '.npz'):
+        return path[:-len('.pkl')] + '.npz'
+    return path
+
+
+def _layer_selected(param_name, layers):
+    layer_name = param_name.rsplit('.', 1)[0]
+    return any(layer_name.startswith(l) for l in layers)
+
+
+def get_layer_names(l_out, l_trunk):
+    """
+    Names of the layers with parameters of the part of the network ending in l_out
+    that l_trunk is built on (l_trunk included), for load_params(l_out, path, layers=...).
+    """
+    trunk_params = set(nn.layers.get_all_params(l_trunk))
+    names = []
+    for name, param in zip(get_param_names(l_out), nn.layers.get_all_params(l_out)):
+        layer_name = name.rsplit('.', 1)[0]
+        if param in trunk_params and layer_name not in names:
+            names.append(layer_name)
+    return names
+
+
+def load_params(l_out, path, layers=None):
+    """
+    Sets the parameters of the network ending in l_out from a checkpoint or a pickle.
+    If layers (names or name prefixes, see get_layer_names) is given, only the parameters
+    of the matching layers are set. Checkpoints with layer names are matched by name,
+    pickles and checkpoints without names by position, which needs the parameters of
+    the whole network in the file.
+    """
+    path = resolve_path(path)
+    print('Load parameters from', path)
+    params = nn.layers.get_all_params(l_out)
+    names = get_param_names(l_out)
+
+    if path.endswith('.npz'):
+        checkpoint = Checkpoint(path)
+        by_name = checkpoint.has_layer_names
+        if not by_name:
+            keys = checkpoint.param_names
+        elif checkpoint.format >= 2:
+            keys = names
+        else:
+            keys = get_param_names_v1(l_out)
+    else:
+        checkpoint = utils.load_pkl(path)['param_values']
+        by_name = False
+        keys = list(range(len(checkpoint)))
+
+    if by_name:
+        missing = [name for name, key in zip(names, keys) if key not in checkpoint and
+                   (layers is None or _layer_selected(name, layers))]
+        if missing:
+            raise ValueError('parameters not in %s: %s' % (path, ', '.join(missing)))
+    elif len(params) != len(keys):
+        raise ValueError('mismatch: got %d values to set %d parameters' % (len(keys), len(params)))
+
+    for name, key, param in zip(names, keys, params):
+        if layers is not None and not _layer_selected(name, layers):
+            continue
+        value = checkpoint[key]
+        if value.shape != param.get_value(borrow=True).shape:
+            raise ValueError('mismatch: parameter %s has shape %r but value to set has shape %r' %
+                             (name, param.get_value(borrow=True).shape, value.shape))
+        param.set_value(np.asarray(value, dtype=param.dtype))
+
+
+def convert_pkl(pkl_path, l_out=None):
+    """
+    Converts a pickled metadata dict into a checkpoint next to it, named after
+    the parameters of l_out if given. Returns the path of the checkpoint.
+    """
+    metadata = utils.load_pkl(pkl_path)
+    param_names = get_param_names(l_out) if l_out is not None else None
+    if param_names is not None and len(param_names) != len(metadata['param_values']):
+        raise ValueError('%s holds %d parameters, the model has %d' %
+                         (pkl_path, len(metadata['param_values']), len(param_names)))
+    npz_path = pkl_path[:-len('.pkl')] + '.npz'
+    save_checkpoint(npz_path, metadata, metadata['param_values'], param_names)
+    return npz_path
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread. Every checkpoint goes to
+    <dir of path>/checkpoints/<name>-chunk<idx>.npz, of which the last keep_last
+    are kept, and then replaces path, which always holds the latest one.
+    """
+
+    def __init__(self, path, keep_last=3):
+        self.path = path
+        self.keep_last = keep_last
+        self.checkpoints_dir = utils.get_dir_path('checkpoints', os.path.dirname(path))
+        self.name = os.path.basename(path).rsplit('.', 1)[0]
+        # at most one snapshot waits while another one is written
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, metadata, l_out):
+        """
+        Snapshots the parameters of l_out and returns; the files are written in the background.
+        """
+        param_values = [np.asarray(v, dtype='float32') for v in nn.layers.get_all_param_values(l_out)]
+        self._queue.put((metadata, param_values, get_param_names(l_out)))
+
+    def _write(self, metadata, param_values, param_names):
+        checkpoint_path = self.checkpoints_dir + '/%s-chunk%06d.npz' % (self.name, metadata['chunks_since_start'])
+        save_checkpoint(checkpoint_path, metadata, param_values, param_names)
+
+        # point path at the new checkpoint without copying it
+        # the temporary file stays out of the models dir, where find_model_metadata globs
+        tmp_path = self.checkpoints_dir + '/%s.latest.tmp' % self.name
+        try:
+            os.link(checkpoint_path, tmp_path)
+        except OSError:
+            save_checkpoint(tmp_path, metadata, param_values, param_names)
+        os.rename(tmp_path, self.path)
+        print('  saved to %s' % self.path)
+
+        old_checkpoints = sorted(f for f in os.listdir(self.checkpoints_dir)
+                                 if f.startswith(self.name + '-chunk') and f.endswith('.npz'))
+        for f in old_checkpoints[:-self.keep_last]:
+            os.remove(self.checkpoints_dir + '/' + f)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print('checkpoint writer: saving %s failed: %r' % (self.path, e))
+
+    def close(self):
+        """
+        Waits until the pending checkpoints are written.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 4):
+        sys.exit("Usage: checkpoints.py <metadata.pkl> [<config_package> <config_name>]")
+    model_l_out = None
+    if len(sys.argv) == 4:
+        config = importlib.import_module('%s.%s' % (sys.argv[2], sys.argv[3]))
+        model_l_out = config.build_model().l_out
+    print('saved to %s' % convert_pkl(sys.argv[1], model_l_out))
@@ -0,0 +1,190 @@
+"""
+Persistent cache for compiled theano functions.
+
+Most of the time spent in theano.function goes to optimizing the graph. The
+optimized function is pickled into a cache directory, keyed by a fingerprint of
+the symbolic graph (after givens are substituted) and the compile options, so
+that later processes and runs can skip the optimization step.
+
+On a cache hit the shared variables stored with the pickled function are
+swapped for the live ones of the current process, so set_value() on the data
+buffers and set_all_param_values() on the model still reach the function.
+
+Set THEANO_FN_CACHE=0 to disable the cache, THEANO_FN_CACHE_DIR to change its
+location (default: <METADATA_PATH>/compile_cache). Profiled runs (see
+profiling.py) compile every function with theano's profiler and skip the cache.
+"""
+import hashlib
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import theano
+from theano.compile.pfunc import rebuild_collect_shared
+
+import profiling
+
+# flags that change the code theano generates for the same graph
+_CONFIG_FLAGS = ('device', 'floatX', 'mode', 'optimizer', 'optimizer_including', 'optimizer_excluding',
+                 'cast_policy', 'int_division', 'warn_float64', 'on_opt_error')
+
+hits = 0
+misses = 0
+
+
+def enabled():
+    return os.environ.get('THEANO_FN_CACHE', '1') != '0'
+
+
+def get_cache_dir():
+    cache_dir = os.environ.get('THEANO_FN_CACHE_DIR')
+    if cache_dir is None:
+        import pathfinder
+        import utils
+        return utils.get_dir_path('compile_cache', pathfinder.METADATA_PATH)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def _update_pairs(updates):
+    if updates is None:
+        return []
+    if hasattr(updates, 'items'):
+        return list(updates.items())
+    return list(updates)
+
+
+def _node_signature(node, var_ids):
+    op = node.op
+    if hasattr(op, '__props__'):
+        op_str = '%s%r' % (type(op).__name__, tuple(getattr(op, p) for p in op.__props__))
+    else:
+        op_str = '%s:%s' % (type(op).__name__, op)
+    ins = ','.join(str(var_ids[v]) for v in node.inputs)
+    outs = ','.join(str(v.type) for v in node.outputs)
+    return '%s(%s)->%s' % (op_str, ins, outs)
+
+
+def _graph_signature(inputs, outputs):
+    """
+    Describes the graph with sequential ids instead of object ids, so that the
+    same model built in another process gives the same signature.
+    """
+    var_ids = {}
+    lines = []
+
+    def var_id(v):
+        if v not in var_ids:
+            var_ids[v] = len(var_ids)
+            if isinstance(v, theano.compile.SharedVariable):
+                lines.append('shared %d %s' % (var_ids[v], v.type))
+            elif isinstance(v, theano.gof.Constant):
+                data = np.asarray(v.data)
+                lines.append('const %d %s %s' % (var_ids[v], v.type,
+                                                  hashlib.sha1(data.tobytes()).hexdigest()))
+            elif v.owner is None:
+                lines.append('input %d %s' % (var_ids[v], v.type))
+        return var_ids[v]
+
+    for v in inputs:
+        var_id(v)
+    for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs(outputs), outputs):
+        for v in node.inputs:
+            var_id(v)
+        lines.append(_node_signature(node, var_ids))
+        for v in node.outputs:
+            var_id(v)
+    lines.append('outputs ' + ','.join(str(var_id(v)) for v in outputs))
+    return '\n'.join(lines)
+
+
+def _collect(inputs, outputs, givens, updates, no_default_updates):
+    outputs_list = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+    input_vars, cloned_outputs, other_stuff = rebuild_collect_shared(outputs_list, inputs, replace=givens,
+                                                                     updates=_update_pairs(updates),
+                                                                     rebuild_strict=True, copy_inputs_over=True,
+                                                                     no_default_updates=no_default_updates)
+    # the shared inputs come in the same order as the implicit inputs of the compiled function
+    shared_inputs = other_stuff[3]
+    return input_vars, cloned_outputs, shared_inputs
+
+
+def fingerprint(inputs, outputs, givens=None, updates=None, **kwargs):
+    input_vars, cloned_outputs, shared_inputs = _collect(inputs, outputs, givens, updates,
+                                                         kwargs.get('no_default_updates', False))
+    h = hashlib.sha1()
+    h.update(('theano %s\n' % theano.__version__).encode('utf-8'))
+    h.update(('python %d.%d\n' % sys.version_info[:2]).encode('utf-8'))
+    for flag in _CONFIG_FLAGS:
+        h.update(('%s=%s\n' % (flag, getattr(theano.config, flag, None))).encode('utf-8'))
+    for k in sorted(kwargs):
+        h.update(('%s=%r\n' % (k, kwargs[k])).encode('utf-8'))
+    h.update(('single_output=%s\n' % (not isinstance(outputs, (list, tuple)))).encode('utf-8'))
+    h.update(_graph_signature(input_vars, cloned_outputs).encode('utf-8'))
+    return h.hexdigest(), shared_inputs
+
+
+def _load(path, shared_inputs):
+    with open(path, 'rb') as f:
+        fn = pickle.load(f)
+    cached_shared = fn.get_shared()
+    if len(cached_shared) != len(shared_inputs):
+        raise ValueError('cached function has %d shared inputs, expected %d' %
+                         (len(cached_shared), len(shared_inputs)))
+    return fn.copy(swap=dict(zip(cached_shared, shared_inputs)))
+
+
+def _save(fn, path):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(fn, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def function(inputs, outputs, givens=None, updates=None, name=None, **kwargs):
+    """
+    Drop-in replacement for theano.function(inputs, outputs, givens=..., updates=...)
+    that reuses a previously compiled function when the graph and options match.
+    """
+    global hits, misses
+    name = name or 'fn'
+    if profiling.enabled():
+        fn = theano.function(inputs, outputs, givens=givens, updates=updates, name=name, profile=True, **kwargs)
+        profiling.register_function(fn, name)
+        return fn
+    if not enabled():
+        return theano.function(inputs, outputs, givens=givens, updates=updates, name=name, **kwargs)
+
+    key, shared_inputs = fingerprint(inputs, outputs, givens, updates, **kwargs)
+    path = get_cache_dir() + '/%s.pkl' % key
+
+    start_time = time.time()
+    if os.path.isfile(path):
+        try:
+            fn = _load(path, shared_inputs)
+            hits += 1
+            print('compile cache hit: %s %s (%.2f s)' % (name, key[:12], time.time() - start_time))
+            return fn
+        except Exception as e:
+            print('compile cache: failed to load %s (%s), recompiling' % (path, e))
+
+    fn = theano.function(inputs, outputs, givens=givens, updates=updates, name=name, **kwargs)
+    misses += 1
+    print('compile cache miss: %s %s (compiled in %.2f s)' % (name, key[:12], time.time() - start_time))
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    try:
+        _save(fn, path)
+    except Exception as e:
+        print('compile cache: could not store %s (%s)' % (name, e))
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    return fn
@@ -150,7 +150,7 @@ def build_model():
 
     metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
     metadata_path = utils.find_model_metadata(metadata_dir, 'luna_p8a1')
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
     for p, pv in zip(nn.layers.get_all_params(l_enc), metadata['param_values']):
         if p.get_value().shape != pv.shape:
             raise ValueError("mismatch: parameter has shape %r but value to "
@@ -109,7 +109,7 @@ def dense_prelu_layer(l_in, num_units):
 def build_segmentation_model(l_in):
     metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
     metadata_path = utils.find_model_metadata(metadata_dir, patch_segmentation_config.__name__.split('.')[-1])
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
 
     model = patch_segmentation_config.build_model(l_in=l_in, patch_size=p_transform['patch_size'])
     nn.layers.set_all_param_values(model.l_out, metadata['param_values'])
@@ -11,6 +11,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -229,8 +230,7 @@ def load_pretrained_model(l_in):
                 b=nn.init.Constant(0))
 
     
-    metadata = utils.load_pkl(os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_fred_malignancy_2-20170328-230443.pkl"))
-    nn.layers.set_all_param_values(l, metadata['param_values'])
+    checkpoints.load_params(l, os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_fred_malignancy_2-20170328-230443.pkl"), layers=checkpoints.get_layer_names(l, l))
 
     return l
 
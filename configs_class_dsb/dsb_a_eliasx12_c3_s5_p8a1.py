@@ -9,6 +9,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -212,10 +213,9 @@ def load_pretrained_model(l_in):
 
 
 
-    metadata = utils.load_pkl(os.path.join("/mnt/storage/metadata/dsb3/models/eavsteen/","t_el_0-20170321-013339.pkl"))
-    nn.layers.set_all_param_values(l_out, metadata['param_values'])
-
-    return nn.layers.get_all_layers(l_out)[-3]
+    features = nn.layers.get_all_layers(l_out)[-3]
+    checkpoints.load_params(l_out, os.path.join("/mnt/storage/metadata/dsb3/models/eavsteen/","t_el_0-20170321-013339.pkl"), layers=checkpoints.get_layer_names(l_out, features))
+    return features
 
 
 def build_model():
@@ -11,6 +11,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -215,10 +216,9 @@ def load_pretrained_model(l_in):
                                  nonlinearity=nn.nonlinearities.softmax)
 
 
-    metadata = utils.load_pkl(os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/ikorshun/","luna_c3-20170226-174919.pkl"))
-    nn.layers.set_all_param_values(l_out, metadata['param_values'])
-
-    return nn.layers.get_all_layers(l_out)[-3]
+    features = nn.layers.get_all_layers(l_out)[-3]
+    checkpoints.load_params(l_out, os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/ikorshun/","luna_c3-20170226-174919.pkl"), layers=checkpoints.get_layer_names(l_out, features))
+    return features
 
 
 def build_model():
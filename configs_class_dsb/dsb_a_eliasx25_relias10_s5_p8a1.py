@@ -11,6 +11,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -69,41 +70,13 @@ def get_feature_dict(feature_vector):
     return d_feat
 
 
-def logodds2p(lo):
-    if lo < -500:
-        # prevent underflow
-        return 0.
-    elif lo > 500:
-        # prevent overflow
-        return 1.
-    else:
-        odds = np.exp(lo)
-        p = odds / (1+odds)
-        return p
-
-
-def candidates_prep_function(all_candidates):
-    candidates_w_svalue = []
-    for candidate in all_candidates:
-        # print('candidate', candidate)
-        feature_vector = candidate[4:]
-        d_feat = get_feature_dict(feature_vector)
-        # print(d_feat)
-
-        noduletype = d_feat['texture'][1]*(-0.1276) + d_feat['texture'][2]*(0.377)
-        partial_simplified_logodds = (5.3854 * ((d_feat['size']/10)**(-0.5) - 1.58113883)) + noduletype + 0.7729*(d_feat['spiculation']/5)
-        sorting_value = d_feat['malignancy']/5 + logodds2p(partial_simplified_logodds)
-        # print("d_feat['malignancy']/5", d_feat['malignancy']/5)
-        # print("logodds2p(partial_simplified_logodds)", logodds2p(partial_simplified_logodds))
-
-        can_w_svalue = np.concatenate((candidate[:3], [sorting_value]))  
-        # print(can_w_svalue)
-        candidates_w_svalue.append(can_w_svalue)
-
-    a = np.asarray(sorted(candidates_w_svalue, key=lambda x: x[-1], reverse=True))
-    # print(a[:10])
-    return a
-
+def candidates_prep_function(all_candidates, n_selection=None):
+    # the properties of all candidates at once, one row (or rows, for classes) per property
+    d_feat = get_feature_dict(all_candidates[:, 4:].T)
+    noduletype = d_feat['texture'][1] * (-0.1276) + d_feat['texture'][2] * (0.377)
+    partial_simplified_logodds = (5.3854 * ((d_feat['size'] / 10) ** (-0.5) - 1.58113883)) + noduletype + 0.7729 * (d_feat['spiculation'] / 5)
+    sorting_value = d_feat['malignancy'] / 5 + utils_lung.logodds2p(partial_simplified_logodds)
+    return utils_lung.rank_candidates(all_candidates, sorting_value, n_selection)
 
 
 data_prep_function_train = partial(data_prep_function, p_transform_augment=p_transform_augment,
@@ -282,10 +255,8 @@ def load_pretrained_model(l_in):
     l_out = nn.layers.ConcatLayer(final_layers, name = 'final_concat_layer')
 
 
-    metadata = utils.load_pkl(os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_elias_10-20170328-003348.pkl"))
-    nn.layers.set_all_param_values(l_out, metadata['param_values'])
-
     features = nn.layers.get_all_layers(l_out)[(-2-len(final_layers))]
+    checkpoints.load_params(l_out, os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_elias_10-20170328-003348.pkl"), layers=checkpoints.get_layer_names(l_out, features))
     print('features layer', features.name)
 
     return features
@@ -11,6 +11,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -282,10 +283,8 @@ def load_pretrained_model(l_in):
     l_out = nn.layers.ConcatLayer(final_layers, name = 'final_concat_layer')
 
 
-    metadata = utils.load_pkl(os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_elias_10-20170328-003348.pkl"))
-    nn.layers.set_all_param_values(l_out, metadata['param_values'])
-
     features = nn.layers.get_all_layers(l_out)[(-3-len(final_layers))]
+    checkpoints.load_params(l_out, os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_elias_10-20170328-003348.pkl"), layers=checkpoints.get_layer_names(l_out, features))
     print('features layer', features.name)
 
     return features
@@ -9,6 +9,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -67,48 +68,23 @@ def get_feature_dict(feature_vector):
     return d_feat
 
 
-def logodds2p(lo):
-    if lo < -500:
-        # prevent underflow
-        return 0.
-    elif lo > 500:
-        # prevent overflow
-        return 1.
-    else:
-        odds = np.exp(lo)
-        p = odds / (1+odds)
-        return p
-
-
 def candidates_prep_function_train(all_candidates, n_candidates, selection_pool_factor = 2):
-    candidates_w_svalue = []
-    for candidate in all_candidates:
-        feature_vector = candidate[4:]
-        d_feat = get_feature_dict(feature_vector)
-        sorting_value = d_feat['malignancy']/5
-        can_w_svalue = np.concatenate((candidate[:3], [sorting_value])) 
-        candidates_w_svalue.append(can_w_svalue)
-    a = np.asarray(sorted(candidates_w_svalue, key=lambda x: x[-1], reverse=True))
-    n_select = selection_pool_factor * n_candidates
-    p_mal_sel = a[:n_select,a.shape[1]-1]
+    # the properties of all candidates at once, one row (or rows, for classes) per property
+    d_feat = get_feature_dict(all_candidates[:, 4:].T)
+    sorting_value = d_feat['malignancy']/5
+    a = utils_lung.rank_candidates(all_candidates, sorting_value, selection_pool_factor * n_candidates)
+
+    # a new random selection every call, weighted by the malignancy
+    p_mal_sel = a[:, -1].astype('float64')
     p_mal_sel = p_mal_sel / np.sum(p_mal_sel)
-    idcs = np.arange(n_select)
-    idcs = rng.choice(idcs,n_candidates, replace=False, p=p_mal_sel)
-    a = a[idcs]
-    return a
+    idcs = rng.choice(len(a), n_candidates, replace=False, p=p_mal_sel)
+    return a[idcs]
 
 
 def candidates_prep_function_test(all_candidates, n_candidates):
-    candidates_w_svalue = []
-    for candidate in all_candidates:
-        feature_vector = candidate[4:]
-        d_feat = get_feature_dict(feature_vector)
-        sorting_value = d_feat['malignancy']/5
-        can_w_svalue = np.concatenate((candidate[:3], [sorting_value])) 
-        candidates_w_svalue.append(can_w_svalue)
-    a = np.asarray(sorted(candidates_w_svalue, key=lambda x: x[-1], reverse=True))
-    a = a[:n_candidates]
-    return a
+    d_feat = get_feature_dict(all_candidates[:, 4:].T)
+    sorting_value = d_feat['malignancy']/5
+    return utils_lung.rank_candidates(all_candidates, sorting_value, n_candidates)
 
 
 data_prep_function_train = partial(data_prep_function, p_transform_augment=p_transform_augment,
@@ -287,10 +263,8 @@ def load_pretrained_model(l_in):
     l_out = nn.layers.ConcatLayer(final_layers, name = 'final_concat_layer')
 
 
-    metadata = utils.load_pkl(os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_elias_18-20170329-182238.pkl"))
-    nn.layers.set_all_param_values(l_out, metadata['param_values'])
-
     features = nn.layers.get_all_layers(l_out)[(-2-len(final_layers))]
+    checkpoints.load_params(l_out, os.path.join("/home/eavsteen/dsb3/storage/metadata/dsb3/models/eavsteen/","r_elias_18-20170329-182238.pkl"), layers=checkpoints.get_layer_names(l_out, features))
     print('features layer', features.name)
 
     return features
@@ -9,6 +9,7 @@ from functools import partial
 import lasagne.layers.dnn as dnn
 import theano.tensor as T
 import utils
+import checkpoints
 import utils_lung
 import os
 
@@ -48,13 +49,15 @@ p_transform_augment = {
 n_candidates_per_patient = 8
 
 
-def data_prep_function(data, candidates, pixel_spacing, p_transform,
-                       p_transform_augment, **kwargs):
-    x = data_transforms.build_dsb_can_heatmap(data=data,
-                                                 candidates=candidates,
-                                                 p_transform=p_transform,
-                                                 p_transform_augment=p_transform_augment,
-                                                 pixel_spacing=pixel_spacing)
+def data_prep_function(data_shapes, candidates, pixel_spacings, p_transform,
+                       p_transform_augment, out=None, **kwargs):
+    # the heatmaps of a whole batch at once
+    x = data_transforms.build_dsb_can_heatmaps(data_shapes=data_shapes,
+                                               candidates=candidates,
+                                               pixel_spacings=pixel_spacings,
+                                               p_transform=p_transform,
+                                               p_transform_augment=p_transform_augment,
+                                               out=out)
 
     return x
 
@@ -78,38 +81,11 @@ def get_feature_dict(feature_vector):
     return d_feat
 
 
-def logodds2p(lo):
-    if lo < -500:
-        # prevent underflow
-        return 0.
-    elif lo > 500:
-        # prevent overflow
-        return 1.
-    else:
-        odds = np.exp(lo)
-        p = odds / (1+odds)
-        return p
-
-
 def candidates_prep_function(all_candidates, n_selection=None):
-    candidates_w_svalue = []
-    for candidate in all_candidates:
-        # print('candidate', candidate)
-        feature_vector = candidate[4:]
-        d_feat = get_feature_dict(feature_vector)
-        # print(d_feat)
-        sorting_value = d_feat['malignancy']
-        can_w_svalue = np.concatenate((candidate[:3], [sorting_value]))  
-        # print(can_w_svalue)
-        candidates_w_svalue.append(can_w_svalue)
-
-    a = np.asarray(sorted(candidates_w_svalue, key=lambda x: x[-1], reverse=True))
-    
-    if n_selection:
-        a = a[:n_selection]
-
-    return a
-
+    # the properties of all candidates at once, one row (or rows, for classes) per property
+    d_feat = get_feature_dict(all_candidates[:, 4:].T)
+    sorting_value = d_feat['malignancy']
+    return utils_lung.rank_candidates(all_candidates, sorting_value, n_selection)
 
 
 data_prep_function_train = partial(data_prep_function, p_transform_augment=p_transform_augment,
@@ -298,10 +274,8 @@ def load_pretrained_model(l_in):
     l_out = nn.layers.ConcatLayer(final_layers, name = 'final_concat_layer')
 
 
-    metadata = utils.load_pkl(os.path.join('/home/frederic/kaggle-dsb3/dsb/storage/metadata/dsb3/models/eavsteen/',"r_elias_28-20170331-230303.pkl"))
-    nn.layers.set_all_param_values(l_out, metadata['param_values'])
-
     features = d_final_layers['malignancy']
+    checkpoints.load_params(l_out, os.path.join('/home/frederic/kaggle-dsb3/dsb/storage/metadata/dsb3/models/eavsteen/',"r_elias_28-20170331-230303.pkl"), layers=checkpoints.get_layer_names(l_out, features))
     print('features layer', features.name)
 
     return features
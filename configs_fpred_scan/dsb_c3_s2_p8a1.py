@@ -6,6 +6,7 @@ import string
 import numpy as np
 import lasagne as nn
 import utils_lung
+import work_queue
 import os
 
 # TODO: IMPORT A CORRECT PATCH CLASSIFICATION MODEL HERE
@@ -32,7 +33,7 @@ id2candidates_path = utils_lung.get_candidates_paths(segmentation_outputs_path)
 # filter our those, who are already generated
 predictions_dir = utils.get_dir_path('model-predictions', pathfinder.METADATA_PATH) \
                   + '/' + utils.get_script_name(__file__)
-exclude_pids = utils_lung.get_generated_pids(predictions_dir)
+exclude_pids = work_queue.get_completed_pids(utils.get_script_name(__file__), predictions_dir)
 
 data_iterator = data_iterators.CandidatesDSBDataGenerator(data_path=pathfinder.DATA_PATH,
                                                           transform_params=p_transform,
@@ -44,7 +45,7 @@ data_iterator = data_iterators.CandidatesDSBDataGenerator(data_path=pathfinder.D
 def build_model():
     metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
     metadata_path = utils.find_model_metadata(metadata_dir, patch_class_config.__name__.split('.')[-1])
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
 
     print('Build model')
     model = patch_class_config.build_model()
@@ -48,7 +48,7 @@ data_iterator = data_iterators.CandidatesDSBDataGenerator(data_path=pathfinder.D
 def build_model():
     metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
     metadata_path = utils.find_model_metadata(metadata_dir, patch_class_config.__name__.split('.')[-1])
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
 
     print('Build model')
     model = patch_class_config.build_model()
@@ -36,7 +36,7 @@ data_iterator = data_iterators.FixedCandidatesLunaDataGenerator(data_path=pathfi
 def build_model():
     metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
     metadata_path = utils.find_model_metadata(metadata_dir, patch_class_config.__name__.split('.')[-1])
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
 
     print('Build model')
     model = patch_class_config.build_model()
@@ -66,6 +66,11 @@ data_iterator = data_iterators.DSBDataGenerator(data_path=pathfinder.DATA_PATH,
 
 
 
+# dense feature extraction: windows per forward pass, and optionally a function of the
+# scan returning a voxel mask (e.g. of the lungs) outside of which windows are skipped
+feature_batch_size = 32
+window_mask_function = None
+
 nchunks_per_epoch = data_iterator.nsamples / chunk_size
 max_nchunks = nchunks_per_epoch * 100
 
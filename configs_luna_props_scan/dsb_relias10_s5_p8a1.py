@@ -52,7 +52,7 @@ def build_model():
     metadata_path = utils.find_model_metadata(metadata_dir, patch_class_config.__name__.split('.')[-1])
     print('loading model', metadata_path)
     print('please check if model pkl is the correct one')
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
 
     print('Build model')
     model = patch_class_config.build_model()
@@ -8,6 +8,8 @@ import numpy as np
 import lasagne as nn
 import os
 import utils_lung
+import work_queue
+import shard_planner
 # TODO: IMPORT A CORRECT PATCH MODEL HERE
 import configs_seg_patch.luna_p8a1 as patch_config
 
@@ -36,37 +38,44 @@ def data_prep_function(data, pixel_spacing, p_transform=p_transform):
 # check if some predictions were generated
 predictions_dir = utils.get_dir_path('model-predictions', pathfinder.METADATA_PATH) + \
                   '/' + utils.get_script_name(__file__)
-exclude_pids = utils_lung.get_generated_pids(predictions_dir)
+exclude_pids = work_queue.get_completed_pids(utils.get_script_name(__file__), predictions_dir)
 
 data_iterator = data_iterators.DSBScanLungMaskDataGenerator(data_path=pathfinder.DATA_PATH,
                                                             transform_params=p_transform,
                                                             data_prep_fun=data_prep_function,
                                                             exclude_pids=exclude_pids)
 
-# create 4 data iterators with different indices to process
+# create 4 data iterators with parts of equal estimated cost to process,
+# the costs are estimated when an iterator first needs its patients
+pid2cost = shard_planner.estimate_costs
+
 data_iterator0 = data_iterators.DSBScanLungMaskDataGenerator(data_path=pathfinder.DATA_PATH,
                                                              transform_params=p_transform,
                                                              data_prep_fun=data_prep_function,
                                                              exclude_pids=exclude_pids,
-                                                             part_out_of=(1, 4))
+                                                             part_out_of=(1, 4),
+                                                             pid2cost=pid2cost)
 
 data_iterator1 = data_iterators.DSBScanLungMaskDataGenerator(data_path=pathfinder.DATA_PATH,
                                                              transform_params=p_transform,
                                                              data_prep_fun=data_prep_function,
                                                              exclude_pids=exclude_pids,
-                                                             part_out_of=(2, 4))
+                                                             part_out_of=(2, 4),
+                                                             pid2cost=pid2cost)
 
 data_iterator2 = data_iterators.DSBScanLungMaskDataGenerator(data_path=pathfinder.DATA_PATH,
                                                              transform_params=p_transform,
                                                              data_prep_fun=data_prep_function,
                                                              exclude_pids=exclude_pids,
-                                                             part_out_of=(3, 4))
+                                                             part_out_of=(3, 4),
+                                                             pid2cost=pid2cost)
 
 data_iterator3 = data_iterators.DSBScanLungMaskDataGenerator(data_path=pathfinder.DATA_PATH,
                                                              transform_params=p_transform,
                                                              data_prep_fun=data_prep_function,
                                                              exclude_pids=exclude_pids,
-                                                             part_out_of=(4, 4))
+                                                             part_out_of=(4, 4),
+                                                             pid2cost=pid2cost)
 
 data_iterators = [data_iterator0, data_iterator1, data_iterator2, data_iterator3]
 
@@ -74,7 +83,7 @@ data_iterators = [data_iterator0, data_iterator1, data_iterator2, data_iterator3
 def build_model():
     metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
     metadata_path = utils.find_model_metadata(metadata_dir, patch_config.__name__.split('.')[-1])
-    metadata = utils.load_pkl(metadata_path)
+    metadata = utils.load_model_metadata(metadata_path)
 
     print('Build model')
     model = patch_config.build_model(patch_size=(window_size, window_size, window_size))
@@ -1,7 +1,17 @@
+import glob
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
 import numpy as np
+import buffering
 import utils_lung
 import pathfinder
 import utils
+import shard_planner
 
 
 # 6% to 28% for nodules 5 to 10 mm,
@@ -78,7 +88,7 @@ class LunaDataGenerator(object):
                                                                   self.id2annotations[pid],
                                                                   luna_origin=origin)
 
-                x = np.float32(x)[None, None, :, :, :]
+                x = np.asarray(x, dtype='float32')[None, None, :, :, :]
                 y = np.float32(y)[None, None, :, :, :]
 
                 yield x, y, None, annotations, tf_matrix, pid
@@ -113,9 +123,7 @@ class LunaSimpleDataGenerator(object):
             img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
                 if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
 
-            x = np.float32(img)
-
-            yield x, pid
+            yield img, pid
 
 
 
@@ -156,7 +164,7 @@ class LunaScanPositiveLungMaskDataGenerator(LunaDataGenerator):
                                                                              self.id2annotations[pid],
                                                                              luna_origin=origin)
 
-                x = np.float32(x)[None, None, :, :, :]
+                x = np.asarray(x, dtype='float32')[None, None, :, :, :]
                 y = np.float32(y)[None, None, :, :, :]
                 lung_mask = np.float32(lung_mask)[None, None, :, :, :]
 
@@ -233,6 +241,7 @@ class PatchLunaDataGenerator(object):
         self.transform_params = transform_params
         self.batch_size = batch_size
         self.full_batch = full_batch
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -243,8 +252,8 @@ class PatchLunaDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
+                x_batch = self.batch_pool.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -345,6 +354,7 @@ class PatchPositiveLunaDataGenerator(object):
         self.transform_params = transform_params
         self.batch_size = batch_size
         self.full_batch = full_batch
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -355,8 +365,8 @@ class PatchPositiveLunaDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
+                x_batch = self.batch_pool.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -456,6 +466,7 @@ class CandidatesLunaDataGenerator(object):
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
         self.positive_proportion = positive_proportion
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -466,8 +477,8 @@ class CandidatesLunaDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb, 1), dtype='float32')
+                x_batch = self.batch_pool.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb, 1), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -538,6 +549,7 @@ class CandidatesLunaDataGenerator(object):
         self.transform_params = transform_params
         self.positive_proportion = positive_proportion
         self.return_malignancy = return_malignancy
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -548,8 +560,8 @@ class CandidatesLunaDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb,), dtype='float32')
+                x_batch = self.batch_pool.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb,), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -735,6 +747,7 @@ class CandidatesLunaSizeDataGenerator(object):
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
         self.positive_proportion = positive_proportion
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -745,8 +758,8 @@ class CandidatesLunaSizeDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb, 1), dtype='float32')
+                x_batch = self.batch_pool.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb, 1), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -883,6 +896,7 @@ class CandidatesLunaSizeBinDataGenerator(object):
         self.transform_params = transform_params
         self.positive_proportion = positive_proportion
         self.bin_borders = bin_borders
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -893,8 +907,8 @@ class CandidatesLunaSizeBinDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb,), dtype='float32')
+                x_batch = self.batch_pool.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb,), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -1071,7 +1085,8 @@ class CandidatesLunaPropsDataGenerator(object):
 
         self.order_objectives = order_objectives
         self.property_bin_borders = property_bin_borders
-	self.property_type = property_type
+        self.property_type = property_type
+        self.batch_pool = buffering.BatchPool()
         #self.return_enable_target_vector = return_enable_target_vector
 
     def L2(self, a,b):
@@ -1150,9 +1165,9 @@ class CandidatesLunaPropsDataGenerator(object):
 
                 nb = len(pos_idxs_batch) + len(neg_idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb, len(self.order_objectives)), dtype='float32')
-                z_batch = np.zeros((nb, len(self.order_objectives)), dtype='float32')
+                x_batch = self.batch_pool.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb, len(self.order_objectives)), dtype='float32')
+                z_batch = self.batch_pool.zeros((nb, len(self.order_objectives)), dtype='float32')
                 patients_ids = []
 
                 batch_ptr = 0
@@ -1359,55 +1374,98 @@ class DSBScanDataGenerator(object):
 
             x, tf_matrix = self.data_prep_fun(data=img, pixel_spacing=pixel_spacing)
 
-            x = np.float32(x)[None, None, :, :, :]
+            x = np.asarray(x, dtype='float32')[None, None, :, :, :]
             yield x, None, tf_matrix, pid
 
 
 class DSBScanLungMaskDataGenerator(object):
     def __init__(self, data_path, transform_params, data_prep_fun, exclude_pids=None,
-                 include_pids=None, part_out_of=(1, 1)):
-
-        self.patient_paths = utils_lung.get_patient_data_paths(data_path)
-
-        this_part = part_out_of[0]
-        all_parts = part_out_of[1]
-        part_lenght = int(len(self.patient_paths) / all_parts)
-
-        if this_part == all_parts:
-            self.patient_paths = self.patient_paths[part_lenght * (this_part - 1):]
-        else:
-            self.patient_paths = self.patient_paths[part_lenght * (this_part - 1): part_lenght * this_part]
-
-        if exclude_pids is not None:
-            for ep in exclude_pids:
-                for i in range(len(self.patient_paths)):
-                    if ep in self.patient_paths[i]:
-                        self.patient_paths.pop(i)
-                        break
-
-        if include_pids is not None:
-            self.patient_paths = [data_path + '/' + p for p in include_pids]
-
-        self.nsamples = len(self.patient_paths)
+                 include_pids=None, part_out_of=(1, 1), work_queue=None, pid2cost=None):
+        """
+        :param pid2cost: pid -> estimated cost, or a function that returns it for a list of
+         patient paths (like shard_planner.estimate_costs), to balance the parts by cost
+         instead of by number of patients. The parts are planned when the patients of the
+         iterator are first needed, not when it is constructed.
+        """
         self.data_path = data_path
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
+        self.work_queue = work_queue
+        self.exclude_pids = exclude_pids
+        self.include_pids = include_pids
+        self.part_out_of = part_out_of
+        self.pid2cost = pid2cost
+        self._patient_paths = None
+        self._predicted_cost = None
+
+    def _plan(self):
+        if self.include_pids is not None:
+            self._patient_paths = [self.data_path + '/' + p for p in self.include_pids]
+            return
+
+        # the parts are planned on all the patients, so that every part gets the same
+        # partition whenever it is (re)started; the patients that are done are left out after
+        patient_paths = utils_lung.get_patient_data_paths(self.data_path)
+        this_part, all_parts = self.part_out_of
+        pid2cost = None
+        if self.pid2cost is not None:
+            # parts balanced by the estimated cost of the patients instead of their number
+            pid2cost = self.pid2cost(patient_paths) if callable(self.pid2cost) else self.pid2cost
+            pids = [utils_lung.extract_pid_dir(p) for p in patient_paths]
+            shards = shard_planner.plan_shards(pids, pid2cost, all_parts)
+            part_paths = [self.data_path + '/' + pid for pid in shards[this_part - 1]]
+        else:
+            part_lenght = int(len(patient_paths) / all_parts)
+            if this_part == all_parts:
+                part_paths = patient_paths[part_lenght * (this_part - 1):]
+            else:
+                part_paths = patient_paths[part_lenght * (this_part - 1): part_lenght * this_part]
+
+        if self.exclude_pids is not None:
+            exclude_pids = set(self.exclude_pids)
+            part_paths = [p for p in part_paths if utils_lung.extract_pid_dir(p) not in exclude_pids]
+        self._patient_paths = part_paths
+        if pid2cost is not None:
+            # the cost of the work that is left in this part
+            self._predicted_cost = shard_planner.get_shard_cost(
+                [utils_lung.extract_pid_dir(p) for p in part_paths], pid2cost)
+
+    @property
+    def patient_paths(self):
+        if self._patient_paths is None:
+            self._plan()
+        return self._patient_paths
+
+    @property
+    def nsamples(self):
+        return len(self.patient_paths)
+
+    @property
+    def predicted_cost(self):
+        if self._patient_paths is None:
+            self._plan()
+        return self._predicted_cost
 
     def generate(self):
-        for p in self.patient_paths:
+        if self.work_queue is not None:
+            patient_paths = (self.data_path + '/' + pid for pid in self.work_queue)
+        else:
+            patient_paths = self.patient_paths
+        for p in patient_paths:
             pid = utils_lung.extract_pid_dir(p)
 
             img, pixel_spacing = utils_lung.read_dicom_scan(p)
 
             x, lung_mask, tf_matrix = self.data_prep_fun(data=img, pixel_spacing=pixel_spacing)
 
-            x = np.float32(x)[None, None, :, :, :]
+            x = np.asarray(x, dtype='float32')[None, None, :, :, :]
             lung_mask = np.float32(lung_mask)[None, None, :, :, :]
             yield x, lung_mask, tf_matrix, pid
 
 
 class CandidatesDSBDataGenerator(object):
-    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None):
+    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None,
+                 work_queue=None):
         if exclude_pids is not None:
             for p in exclude_pids:
                 id2candidates_path.pop(p, None)
@@ -1421,10 +1479,11 @@ class CandidatesDSBDataGenerator(object):
         self.data_path = data_path
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
+        self.work_queue = work_queue
 
     def generate(self):
-
-        for pid in self.id2candidates_path.iterkeys():
+        pids = self.id2candidates_path.keys() if self.work_queue is None else self.work_queue
+        for pid in pids:
             patient_path = self.id2patient_path[pid]
             print(pid, patient_path)
             img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
@@ -1445,7 +1504,8 @@ class CandidatesDSBDataGenerator(object):
 
 
 class CandidatesDSBDataGeneratorTTA(object):
-    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None, tta=64):
+    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None, tta=64,
+                 work_queue=None):
         if exclude_pids is not None:
             for p in exclude_pids:
                 id2candidates_path.pop(p, None)
@@ -1460,10 +1520,11 @@ class CandidatesDSBDataGeneratorTTA(object):
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
         self.tta = tta
+        self.work_queue = work_queue
 
     def generate(self):
-
-        for pid in self.id2candidates_path.iterkeys():
+        pids = self.id2candidates_path.keys() if self.work_queue is None else self.work_queue
+        for pid in pids:
             patient_path = self.id2patient_path[pid]
             print(pid, patient_path)
             img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
@@ -1485,10 +1546,121 @@ class CandidatesDSBDataGeneratorTTA(object):
                 yield x_batch, y_batch, [pid]
 
 
+def get_ranked_candidates(cache, pid, candidates_path, candidates_prep_fun, *args):
+    """
+    candidates_prep_fun applied to the candidates of a patient. Only the candidates file is
+    kept in cache (read-only, per pid and path): candidates_prep_fun runs on every call, as
+    some configs sample the candidates at random every epoch.
+    """
+    key = (pid, candidates_path)
+    if key not in cache:
+        candidates = utils.load_pkl(candidates_path)
+        if isinstance(candidates, np.ndarray):
+            candidates.flags.writeable = False
+        cache[key] = candidates
+    return candidates_prep_fun(cache[key], *args)
+
+
+class FeatureStore(object):
+    """
+    The features of all patients in a directory of <pid>.pkl feature files, packed in one
+    memory-mapped array of shape (n_patients,) + p_features['output_shape'], with the
+    reshape and swapaxes of p_features already applied, and the pid of every row.
+    The store is written to <features_path>/packed-<layout key>-<files key>, where the
+    layout key is derived from the layout in p_features and the dtype and the files key
+    from the names, sizes and modification times of the feature files: features that are
+    added or regenerated later are packed again, and the older stores of the layout removed.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.features = np.load(store_dir + '/features.npy', mmap_mode='r')
+        with open(store_dir + '/pids.json') as f:
+            self.pids = json.load(f)
+        self.pid2row = dict((pid, row) for row, pid in enumerate(self.pids))
+
+    @staticmethod
+    def get_feature_paths(features_path):
+        return sorted(glob.glob(features_path + '/*.pkl'))
+
+    @staticmethod
+    def get_layout_key(p_features, dtype):
+        layout = [(k, p_features[k]) for k in ('output_shape', 'reshape', 'swapaxes') if k in p_features]
+        layout.append(('dtype', np.dtype(dtype).str))
+        return hashlib.sha1(repr(layout).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def get_files_key(feature_paths):
+        files = []
+        for path in feature_paths:
+            st = os.stat(path)
+            files.append((os.path.basename(path), st.st_size, st.st_mtime_ns))
+        return hashlib.sha1(repr(files).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def get_store_dir(cls, features_path, p_features, dtype, feature_paths=None):
+        if feature_paths is None:
+            feature_paths = cls.get_feature_paths(features_path)
+        return features_path + '/packed-%s-%s' % (cls.get_layout_key(p_features, dtype),
+                                                  cls.get_files_key(feature_paths))
+
+    @classmethod
+    def open(cls, features_path, p_features, dtype='float32'):
+        feature_paths = cls.get_feature_paths(features_path)
+        store_dir = cls.get_store_dir(features_path, p_features, dtype, feature_paths)
+        if not os.path.isfile(store_dir + '/pids.json'):
+            cls.pack(features_path, p_features, dtype, store_dir, feature_paths)
+        return cls(store_dir)
+
+    @classmethod
+    def pack(cls, features_path, p_features, dtype, store_dir, feature_paths=None):
+        if feature_paths is None:
+            feature_paths = cls.get_feature_paths(features_path)
+        pids = [utils_lung.extract_pid_filename(p, '.pkl') for p in feature_paths]
+        tmp_dir = '%s.%d.tmp' % (store_dir, os.getpid())
+        utils.auto_make_dir(tmp_dir)
+        features = np.lib.format.open_memmap(tmp_dir + '/features.npy', mode='w+', dtype=dtype,
+                                             shape=(len(pids),) + tuple(p_features['output_shape']))
+        for row, path in enumerate(feature_paths):
+            t_features = utils.load_pkl(path)
+            if 'reshape' in p_features:
+                t_features = np.reshape(t_features, p_features['reshape'])
+            if 'swapaxes' in p_features:
+                t_features = np.swapaxes(t_features, *p_features['swapaxes'])
+            features[row] = t_features
+        features.flush()
+        del features
+        with open(tmp_dir + '/pids.json', 'w') as f:
+            json.dump(pids, f)
+        try:
+            os.rename(tmp_dir, store_dir)
+            print('Packed the features of %d patients in %s' % (len(pids), store_dir))
+        except OSError:
+            # another process packed the same features first
+            shutil.rmtree(tmp_dir)
+
+        # the stores of older versions of the feature files
+        layout_prefix = 'packed-%s-' % cls.get_layout_key(p_features, dtype)
+        for d in os.listdir(features_path):
+            if d.startswith(layout_prefix) and not d.endswith('.tmp') and \
+                    features_path + '/' + d != store_dir:
+                shutil.rmtree(features_path + '/' + d, ignore_errors=True)
+
+    def get_rows(self, pids):
+        missing = [pid for pid in pids if pid not in self.pid2row]
+        if missing:
+            raise ValueError('no features for %d patients in %s, e.g. %s' % (len(missing), self.store_dir,
+                                                                            ', '.join(missing[:5])))
+        return np.array([self.pid2row[pid] for pid in pids], dtype='int64')
+
+
 class DSBFeatureDataGenerator(object):
     def __init__(self, data_path, batch_size, p_features,
-                 rng, random, infinite, patient_ids=None):
-
+                 rng, random, infinite, patient_ids=None, packed=True, packed_dtype='float32'):
+        """
+        With packed, the features are gathered from a FeatureStore of data_path (float32 or float16)
+        instead of being unpickled per patient.
+        """
         print('init DSBFeatureDataGenerator')
 
         self.id2label = utils_lung.read_labels(pathfinder.LABELS_PATH)
@@ -1507,8 +1679,30 @@ class DSBFeatureDataGenerator(object):
         self.rng = rng
         self.random = random
         self.infinite = infinite
+        self.packed = packed
+        self.packed_dtype = packed_dtype
+        self.feature_store = None
+        self.batch_pool = buffering.BatchPool()
+
+    def get_feature_store(self):
+        if self.feature_store is None:
+            self.feature_store = FeatureStore.open(self.data_path, self.p_features, self.packed_dtype)
+        return self.feature_store
+
+    def load_features(self, pid):
+        t_features = utils.load_pkl(self.data_path + '/' + pid + '.pkl')
+        if 'reshape' in self.p_features:
+            t_features = np.reshape(t_features, self.p_features['reshape'])
+        if 'swapaxes' in self.p_features:
+            t_features = np.swapaxes(t_features, *self.p_features['swapaxes'])
+        return t_features
 
     def generate(self):
+        pids = [utils_lung.extract_pid_dir(p) for p in self.patient_paths]
+        if self.packed:
+            store = self.get_feature_store()
+            rows = store.get_rows(pids)
+
         while True:
             rand_idxs = np.arange(self.nsamples)
             if self.random:
@@ -1516,33 +1710,20 @@ class DSBFeatureDataGenerator(object):
 
             for pos in range(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
+                if len(idxs_batch) < self.batch_size:
+                    continue
 
-                x_batch = np.zeros((self.batch_size,)
-                                   + self.p_features['output_shape'], dtype='float32')
-
-                y_batch = np.zeros((self.batch_size,), dtype='float32')
-                
-                pids_batch = []
-
-                for i, idx in enumerate(idxs_batch):
-                    patient_path = self.patient_paths[idx]
-                    pid = utils_lung.extract_pid_dir(patient_path)
-
-                    t_features = utils.load_pkl(patient_path+'.pkl')
-                    if 'reshape' in self.p_features:
-                        t_features = np.reshape(t_features, self.p_features['reshape'])
-                    if 'swapaxes' in self.p_features:
-                        t_features = np.swapaxes(t_features, *self.p_features['swapaxes'])
-
-
-                    x_batch[i] = t_features
-
-                    y_batch[i] = self.id2label.get(pid)
-                    
-                    pids_batch.append(pid)
+                pids_batch = [pids[idx] for idx in idxs_batch]
+                y_batch = np.array([self.id2label.get(pid) for pid in pids_batch], dtype='float32')
+                if self.packed:
+                    x_batch = np.asarray(store.features[rows[idxs_batch]], dtype='float32')
+                else:
+                    x_batch = self.batch_pool.zeros((self.batch_size,)
+                                                    + self.p_features['output_shape'], dtype='float32')
+                    for i, pid in enumerate(pids_batch):
+                        x_batch[i] = self.load_features(pid)
 
-                if len(idxs_batch) == self.batch_size:
-                    yield x_batch, y_batch, pids_batch
+                yield x_batch, y_batch, pids_batch
 
             if not self.infinite:
                 break
@@ -1573,6 +1754,8 @@ class DSBPatientsDataGenerator(object):
         self.shuffle_top_n = shuffle_top_n
         self.return_patch_locs = return_patch_locs
         self.candidates_prep_fun = candidates_prep_fun
+        self.loaded_candidates = {}
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -1583,13 +1766,13 @@ class DSBPatientsDataGenerator(object):
             for pos in range(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
 
-                x_batch = np.zeros((self.batch_size, self.n_candidates_per_patient,)
-                                   + self.transform_params['patch_size'], dtype='float32')
+                x_batch = self.batch_pool.empty((self.batch_size, self.n_candidates_per_patient,)
+                                                + self.transform_params['patch_size'], dtype='float32')
 
                 if self.return_patch_locs:
-                    x_loc_batch = np.zeros((self.batch_size, self.n_candidates_per_patient, 3), dtype='float32')
+                    x_loc_batch = self.batch_pool.empty((self.batch_size, self.n_candidates_per_patient, 3), dtype='float32')
 
-                y_batch = np.zeros((self.batch_size,), dtype='float32')
+                y_batch = self.batch_pool.zeros((self.batch_size,), dtype='float32')
                 pids_batch = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -1598,10 +1781,13 @@ class DSBPatientsDataGenerator(object):
 
                     img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
 
-                    all_candidates = utils.load_pkl(self.id2candidates_path[pid])
                     if self.candidates_prep_fun:
-                        top_candidates = self.candidates_prep_fun(all_candidates, self.n_candidates_per_patient)
+                        top_candidates = get_ranked_candidates(self.loaded_candidates, pid,
+                                                               self.id2candidates_path[pid],
+                                                               self.candidates_prep_fun,
+                                                               self.n_candidates_per_patient)
                     else:
+                        all_candidates = utils.load_pkl(self.id2candidates_path[pid])
                         top_candidates = all_candidates[:self.n_candidates_per_patient]
                         if self.shuffle_top_n:
                             self.rng.shuffle(top_candidates)
@@ -1648,24 +1834,27 @@ class DSBPatientsDataGeneratorTTA(object):
         self.n_candidates_per_patient = n_candidates_per_patient
         self.tta = tta
         self.candidates_prep_fun = candidates_prep_fun
+        self.loaded_candidates = {}
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         print()
         for idx in range(self.nsamples):
-            x_batch = np.zeros((self.tta, self.n_candidates_per_patient,)
-                               + self.transform_params['patch_size'], dtype='float32')
+            x_batch = self.batch_pool.empty((self.tta, self.n_candidates_per_patient,)
+                                            + self.transform_params['patch_size'], dtype='float32')
 
-            y_batch = np.zeros((self.tta,), dtype='float32')
+            y_batch = self.batch_pool.zeros((self.tta,), dtype='float32')
 
             patient_path = self.patient_paths[idx]
             pid = utils_lung.extract_pid_dir(patient_path)
 
             img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
 
-            all_candidates = utils.load_pkl(self.id2candidates_path[pid])
             if self.candidates_prep_fun:
-                top_candidates = self.candidates_prep_fun(all_candidates, self.n_candidates_per_patient)
+                top_candidates = get_ranked_candidates(self.loaded_candidates, pid, self.id2candidates_path[pid],
+                                                       self.candidates_prep_fun, self.n_candidates_per_patient)
             else:
+                all_candidates = utils.load_pkl(self.id2candidates_path[pid])
                 top_candidates = all_candidates[:self.n_candidates_per_patient]
 
             for i in range(self.tta):
@@ -1709,8 +1898,14 @@ class DSBPixelSpacingsGenerator(object):
 
 class DSBPatientsDataGenerator_only_heatmap(object):
     def __init__(self, data_path, batch_size, transform_params, id2candidates_path, data_prep_fun, 
-                 n_candidates_per_patient, rng, random, infinite, candidates_prep_fun, return_patch_locs=False, shuffle_top_n=False, patient_ids=None):
-
+                 n_candidates_per_patient, rng, random, infinite, candidates_prep_fun, return_patch_locs=False, shuffle_top_n=False, patient_ids=None,
+                 header_cache_dir=None):
+        """
+        The heatmaps only need the shape and pixel spacing of the scans, which are read from the
+        DICOM headers once and cached in header_cache_dir (default <METADATA_PATH>/dicom_headers).
+        data_prep_fun builds the heatmaps of a whole batch into out, it is called with lists
+        data_shapes, candidates and pixel_spacings (see data_transforms.build_dsb_can_heatmaps).
+        """
         self.id2label = utils_lung.read_labels(pathfinder.LABELS_PATH)
         self.id2candidates_path = id2candidates_path
         self.patient_paths = []
@@ -1731,7 +1926,19 @@ class DSBPatientsDataGenerator_only_heatmap(object):
         self.infinite = infinite
         self.shuffle_top_n = shuffle_top_n
         self.candidates_prep_fun = candidates_prep_fun
+        self.loaded_candidates = {}
         self.n_candidates_per_patient = n_candidates_per_patient
+        self.header_cache_dir = header_cache_dir
+        self.pid2header = {}
+        self.batch_pool = buffering.BatchPool()
+
+    def get_header(self, patient_path):
+        pid = utils_lung.extract_pid_dir(patient_path)
+        if pid not in self.pid2header:
+            if self.header_cache_dir is None:
+                self.header_cache_dir = utils_lung.get_dicom_header_cache_dir()
+            self.pid2header[pid] = utils_lung.load_dicom_scan_header(patient_path, self.header_cache_dir)
+        return self.pid2header[pid]
 
     def generate(self):
         while True:
@@ -1742,27 +1949,30 @@ class DSBPatientsDataGenerator_only_heatmap(object):
             for pos in range(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
 
-                x_batch = np.zeros((self.batch_size,)
-                                   + self.transform_params['heatmap_size'], dtype='float32')
+                x_batch = self.batch_pool.empty((self.batch_size,)
+                                                + self.transform_params['heatmap_size'], dtype='float32')
 
-                y_batch = np.zeros((self.batch_size,), dtype='float32')
+                y_batch = self.batch_pool.zeros((self.batch_size,), dtype='float32')
                 pids_batch = []
+                data_shapes, candidates_batch, pixel_spacings = [], [], []
 
                 for i, idx in enumerate(idxs_batch):
                     patient_path = self.patient_paths[idx]
                     pid = utils_lung.extract_pid_dir(patient_path)
 
-                    img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
-
-                    all_candidates = utils.load_pkl(self.id2candidates_path[pid])
-                    candidates_w_value = self.candidates_prep_fun(all_candidates)
-
-                    x_batch[i] = np.float32(self.data_prep_fun(data=img,
-                                                               candidates=candidates_w_value,
-                                                               pixel_spacing=pixel_spacing))
+                    header = self.get_header(patient_path)
+                    data_shapes.append(header['shape'])
+                    pixel_spacings.append(header['pixel_spacing'])
+                    candidates_batch.append(get_ranked_candidates(self.loaded_candidates, pid,
+                                                                  self.id2candidates_path[pid],
+                                                                  self.candidates_prep_fun))
                     y_batch[i] = self.id2label.get(pid)
                     pids_batch.append(pid)
 
+                # one call for the whole batch, the heatmaps are written into x_batch
+                self.data_prep_fun(data_shapes=data_shapes, candidates=candidates_batch,
+                                   pixel_spacings=pixel_spacings, out=x_batch)
+
                 if len(idxs_batch) == self.batch_size:
                     yield x_batch, y_batch, pids_batch
 
@@ -1796,6 +2006,7 @@ class DSBPatientsDataGeneratorRandomSelectionNonCancerous(object):
         self.shuffle_top_n = shuffle_top_n
         self.top_true = top_true
         self.top_false = top_false  
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -1806,9 +2017,9 @@ class DSBPatientsDataGeneratorRandomSelectionNonCancerous(object):
             for pos in range(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
 
-                x_batch = np.zeros((self.batch_size, self.n_candidates_per_patient, 1,)
-                                   + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((self.batch_size,), dtype='float32')
+                x_batch = self.batch_pool.zeros((self.batch_size, self.n_candidates_per_patient, 1,)
+                                                + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((self.batch_size,), dtype='float32')
                 pids_batch = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -1880,6 +2091,7 @@ class BalancedDSBPatientsDataGenerator(object):
         self.random = random
         self.infinite = infinite
         self.shuffle_top_n = shuffle_top_n
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -1908,9 +2120,9 @@ class BalancedDSBPatientsDataGenerator(object):
                 break
 
     def prepare_batch(self, batch_pids):
-        x_batch = np.zeros((len(batch_pids), self.n_candidates_per_patient, 1,)
-                               + self.transform_params['patch_size'], dtype='float32')
-        y_batch = np.zeros((len(batch_pids),), dtype='float32')
+        x_batch = self.batch_pool.zeros((len(batch_pids), self.n_candidates_per_patient, 1,)
+                                        + self.transform_params['patch_size'], dtype='float32')
+        y_batch = self.batch_pool.zeros((len(batch_pids),), dtype='float32')
         for i, pid in enumerate(batch_pids):
             patient_path = self.data_path + '/' + str(pid)
             img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)  
@@ -1925,7 +2137,8 @@ class BalancedDSBPatientsDataGenerator(object):
         return x_batch, y_batch, batch_pids
 
 class DSBDataGenerator(object):
-    def __init__(self, data_path, transform_params=None, data_prep_fun=None, patient_pids=None, **kwargs):
+    def __init__(self, data_path, transform_params=None, data_prep_fun=None, patient_pids=None, work_queue=None,
+                 **kwargs):
         self.patient_paths = utils_lung.get_patient_data_paths(data_path)
 
 
@@ -1935,9 +2148,14 @@ class DSBDataGenerator(object):
         self.data_path = data_path
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
+        self.work_queue = work_queue
 
     def generate(self):
-        for p in self.patient_paths:
+        if self.work_queue is not None:
+            patient_paths = (self.data_path + '/' + pid for pid in self.work_queue)
+        else:
+            patient_paths = self.patient_paths
+        for p in patient_paths:
             pid = utils_lung.extract_pid_dir(p)
 
             img, pixel_spacing = utils_lung.read_dicom_scan(p)
@@ -1947,7 +2165,7 @@ class DSBDataGenerator(object):
             else:
                 x = img
 
-            x = np.float32(x)
+            x = np.asarray(x, dtype='float32')
             yield x,  pid
 
 
@@ -2015,6 +2233,7 @@ class CandidatesPropertiesLunaDataGenerator(object):
         self.properties_included = properties_included
 
         assert self.transform_params['pixel_spacing'] == (1., 1., 1.)
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -2025,8 +2244,8 @@ class CandidatesPropertiesLunaDataGenerator(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
-                y_batch = np.zeros((nb, self.nlabels), dtype='float32')
+                x_batch = self.batch_pool.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
+                y_batch = self.batch_pool.zeros((nb, self.nlabels), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -2124,6 +2343,7 @@ class CandidatesPropertiesLunaDataGenerator2(object):
         self.properties_included = properties_included
 
         assert self.transform_params['pixel_spacing'] == (1., 1., 1.)
+        self.batch_pool = buffering.BatchPool()
 
     def generate(self):
         while True:
@@ -2134,11 +2354,11 @@ class CandidatesPropertiesLunaDataGenerator2(object):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
                 # allocate batches
-                x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
+                x_batch = self.batch_pool.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
                 if self.nlabels == 1:
-                    y_batch = np.zeros((nb,), dtype='float32')
+                    y_batch = self.batch_pool.zeros((nb,), dtype='float32')
                 else:
-                    y_batch = np.zeros((nb, self.nlabels), dtype='float32')
+                    y_batch = self.batch_pool.zeros((nb, self.nlabels), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
@@ -2247,4 +2467,189 @@ class CandidatesLunaValidDataGenerator2(object):
                                                         pixel_spacing=pixel_spacing,
                                                         luna_origin=origin))[None, :, :, :]
 
-                yield x_batch, y_batch, [pid]
\ No newline at end of file
+                yield x_batch, y_batch, [pid]
+
+class MaterializedDataGenerator(object):
+    """
+    Replays the batches of a deterministic data iterator (no random selection, no
+    augmentation) from memory-mapped files. The first pass runs the wrapped iterator
+    and writes its batches to <cache_root>/<name>-<key>, where the key is derived
+    from the class, the transform parameters and the settings of the iterator.
+    Later passes, also in later runs, read the batches back without touching the scans.
+    Iterators that select at random or augment are not cached, they run as before.
+    """
+
+    _basic_types = (str, int, float, bool, type(None))
+    # state that does not change the batches of a deterministic iterator
+    _ignored_types = (np.random.RandomState, buffering.BatchPool)
+
+    def __init__(self, data_iterator, cache_root, name):
+        self.data_iterator = data_iterator
+        self.nsamples = data_iterator.nsamples
+        try:
+            self.cache_dir = cache_root + '/%s-%s' % (name, self.get_cache_key(data_iterator))
+        except ValueError as e:
+            print('Not caching the batches of %s: %s' % (name, e))
+            self.cache_dir = None
+
+    @classmethod
+    def _describe(cls, value):
+        """
+        A string that changes with value, or None if there is no such string.
+        """
+        if isinstance(value, cls._basic_types):
+            return repr(value)
+        if isinstance(value, (list, tuple)):
+            descriptions = [cls._describe(v) for v in value]
+            if any(d is None for d in descriptions):
+                return None
+            return '[%s]' % ', '.join(descriptions)
+        if isinstance(value, dict):
+            descriptions = [(repr(k), cls._describe(value[k])) for k in sorted(value, key=repr)]
+            if any(d is None for _, d in descriptions):
+                return None
+            return '{%s}' % ', '.join('%s: %s' % kd for kd in descriptions)
+        if isinstance(value, np.ndarray):
+            return hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+        if isinstance(value, np.generic):
+            return repr(value.item())
+        if isinstance(value, functools.partial):
+            # the data_prep_fun of most configs: a function with p_transform and friends bound to it
+            keys = sorted(value.keywords)
+            descriptions = [cls._describe(v) for v in [value.func] + list(value.args) +
+                            [value.keywords[k] for k in keys]]
+            if any(d is None for d in descriptions):
+                return None
+            n_args = 1 + len(value.args)
+            descriptions[n_args:] = ['%s=%s' % kd for kd in zip(keys, descriptions[n_args:])]
+            return 'partial(%s)' % ', '.join(descriptions)
+        if inspect.isfunction(value):
+            # the source of the module (a config) stands for the globals the function reads
+            closure = [cell.cell_contents for cell in value.__closure__ or ()]
+            descriptions = [cls._describe(v) for v in [value.__defaults__ or (), value.__kwdefaults__ or {}, closure]]
+            if any(d is None for d in descriptions):
+                return None
+            return 'function(%s)' % ', '.join(['%s.%s' % (value.__module__, value.__name__),
+                                               cls._source_hash(value)] + descriptions)
+        if callable(value) and hasattr(value, '__name__'):
+            return '%s.%s' % (getattr(value, '__module__', None), value.__name__)
+        return None
+
+    @staticmethod
+    def _source_hash(function):
+        try:
+            with open(inspect.getsourcefile(function), 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except (TypeError, IOError, OSError):
+            return hashlib.sha1(function.__code__.co_code).hexdigest()
+
+    @staticmethod
+    def _augments(function):
+        """
+        True if function, e.g. a data_prep_fun, applies a random augmentation.
+        """
+        try:
+            parameter = inspect.signature(function).parameters.get('p_transform_augment')
+        except (TypeError, ValueError):
+            return False
+        if parameter is not None:
+            return parameter.default is not inspect.Parameter.empty and bool(parameter.default)
+        # a function that reads the augmentation straight from the globals of its config
+        while isinstance(function, functools.partial):
+            function = function.func
+        return inspect.isfunction(function) and 'p_transform_augment' in function.__code__.co_names and \
+            bool(function.__globals__.get('p_transform_augment'))
+
+    @classmethod
+    def get_cache_key(cls, data_iterator):
+        """
+        Raises ValueError if a setting of data_iterator cannot be described, as the
+        cache could then silently replay the batches of different settings, and if
+        data_iterator is random, as replaying would freeze one draw of its batches.
+        """
+        if getattr(data_iterator, 'random', False):
+            raise ValueError('%s selects its samples at random' % data_iterator.__class__.__name__)
+        description = [data_iterator.__class__.__name__]
+        for attr, value in sorted(vars(data_iterator).items()):
+            if isinstance(value, cls._ignored_types):
+                continue
+            if callable(value) and cls._augments(value):
+                raise ValueError('%s.%s augments its batches' % (data_iterator.__class__.__name__, attr))
+            value_description = cls._describe(value)
+            if value_description is None:
+                raise ValueError('cannot derive a cache key from %s.%s = %r' %
+                                 (data_iterator.__class__.__name__, attr, value))
+            description.append('%s=%s' % (attr, value_description))
+        return hashlib.sha1('\n'.join(description).encode('utf-8')).hexdigest()[:16]
+
+    def _materialize(self):
+        tmp_dir = '%s.%d.tmp' % (self.cache_dir, os.getpid())
+        utils.auto_make_dir(tmp_dir)
+        files, offsets, index = {}, {}, []
+        recording = True
+        try:
+            for item in self.data_iterator.generate():
+                if recording:
+                    entry = []
+                    for k, value in enumerate(item):
+                        if isinstance(value, np.ndarray):
+                            if k not in files:
+                                files[k] = open(tmp_dir + '/array_%d.bin' % k, 'wb')
+                                offsets[k] = 0
+                            value = np.ascontiguousarray(value)
+                            files[k].write(value.tobytes())
+                            entry.append({'file': k, 'offset': offsets[k], 'shape': value.shape,
+                                          'dtype': value.dtype.str})
+                            offsets[k] += value.nbytes
+                        else:
+                            try:
+                                json.dumps(value)
+                            except (TypeError, ValueError) as e:
+                                # the index could not be written after the pass
+                                print('Not caching the batches in %s: %s' % (self.cache_dir, e))
+                                recording = False
+                                break
+                            entry.append({'value': value})
+                    index.append(entry)
+                yield item
+        finally:
+            for f in files.values():
+                f.close()
+
+        if not recording:
+            self.cache_dir = None
+            shutil.rmtree(tmp_dir)
+            return
+        with open(tmp_dir + '/index.json', 'w') as f:
+            json.dump(index, f)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+            print('Materialized %d batches in %s' % (len(index), self.cache_dir))
+        except OSError:
+            # another process materialized the same batches first
+            shutil.rmtree(tmp_dir)
+
+    def _replay(self):
+        with open(self.cache_dir + '/index.json') as f:
+            index = json.load(f)
+        files = {}
+        for entry in index:
+            item = []
+            for e in entry:
+                if 'file' in e:
+                    if e['file'] not in files:
+                        files[e['file']] = np.memmap(self.cache_dir + '/array_%d.bin' % e['file'], dtype='uint8',
+                                                     mode='c')
+                    dtype = np.dtype(e['dtype'])
+                    nbytes = int(np.prod(e['shape'])) * dtype.itemsize
+                    item.append(files[e['file']][e['offset']:e['offset'] + nbytes].view(dtype).reshape(e['shape']))
+                else:
+                    item.append(e['value'])
+            yield tuple(item)
+
+    def generate(self):
+        if self.cache_dir is None:
+            return self.data_iterator.generate()
+        if os.path.isfile(self.cache_dir + '/index.json'):
+            return self._replay()
+        return self._materialize()
@@ -3,6 +3,7 @@ import numpy as np
 import scipy.ndimage
 import math
 import utils_lung
+import float32_mode
 
 MAX_HU = 400.
 MIN_HU = -1000.
@@ -11,32 +12,36 @@ rng = np.random.RandomState(317070)
 
 
 
+@float32_mode.float32_only
 def hu2normHU(x):
     """
     Modifies input data
     :param x:
     :return:
     """
-    x = (x - MIN_HU) / (MAX_HU - MIN_HU)
+    x = (np.asarray(x, dtype='float32') - MIN_HU) / (MAX_HU - MIN_HU)
     x = np.clip(x, 0., 1., out=x)
     return x
 
+@float32_mode.float32_only
 def hu2normHU_low_clip(x):
     """
     Modifies input data
     :param x:
     :return:
     """
-    x = (x - MIN_HU) / (MAX_HU - MIN_HU)
+    x = (np.asarray(x, dtype='float32') - MIN_HU) / (MAX_HU - MIN_HU)
     x = np.clip(x, 0., 10., out=x)
     return x
 
+@float32_mode.float32_only
 def pixelnormHU(x):
-    x = (x - MIN_HU) / (MAX_HU - MIN_HU)
+    x = (np.asarray(x, dtype='float32') - MIN_HU) / (MAX_HU - MIN_HU)
     x = np.clip(x, 0., 1., out=x)
     return (x - 0.5) / 0.5
 
 
+@float32_mode.float32_only
 def histogram_equalization(x, hist=None, bins=None):
     # hist is a normalized histogram, which means that the sum of the counts has to be one
     if hist is None and bins is None:
@@ -50,7 +55,7 @@ def histogram_equalization(x, hist=None, bins=None):
     assert(len(bins) == (len(hist)+1))
 
     # init our target array 
-    z = np.empty(x.shape)
+    z = np.empty(x.shape, dtype='float32')
 
     # copy the values outside of the bins from the original
     z[x<=bins[0]] = x[x<=bins[0]] 
@@ -111,10 +116,11 @@ def get_rescale_params_hist_eq(x, hist=None, bins=None):
 
     return bins, original_borders
 
+@float32_mode.float32_only
 def apply_hist_eq_patch(x, bins, original_borders):
 
     # init our target array 
-    z = np.empty(x.shape)
+    z = np.empty(x.shape, dtype='float32')
 
     # if np.isnan(z).any():
     #     print('1 np.isnan(z).any()', np.isnan(z).any())
@@ -170,6 +176,7 @@ def sample_augmentation_parameters(transformation):
     return namedtuple('Params', ['translation', 'rotation'])(translation, rotation)
 
 
+@float32_mode.float32_only
 def transform_scan3d(data, pixel_spacing, p_transform,
                      luna_annotations=None,
                      luna_origin=None,
@@ -229,6 +236,7 @@ def transform_scan3d(data, pixel_spacing, p_transform,
         return data_out, tf_total, lung_mask_out
 
 
+@float32_mode.float32_only
 def transform_patch3d(data, pixel_spacing, p_transform,
                       patch_center,
                       luna_origin,
@@ -342,6 +350,7 @@ def transform_patch3d_ls(data, pixel_spacing, p_transform,
     return data_out #, patch_annotation_out
 
 
+@float32_mode.float32_only
 def transform_dsb_candidates(data, patch_centers, pixel_spacing, p_transform,
                              p_transform_augment=None):
     input_shape = np.asarray(data.shape)
@@ -350,47 +359,47 @@ def transform_dsb_candidates(data, patch_centers, pixel_spacing, p_transform,
     patches_out = []
     for zyxd in patch_centers:
         if -1 in zyxd:
-            patch_out = np.zeros(output_shape)
+            patch_out = np.zeros(output_shape, dtype='float32')
         elif 'affine_tf' in p_transform and not p_transform['affine_tf']:
             assert(output_shape[0] == output_shape[1])
             assert(output_shape[0] == output_shape[2])
 
             zyx = np.round(np.array(zyxd[:3])).astype('int32')
 
-            z_in = zyx[0] > output_shape[0]/2 and zyx[0] < input_shape[0]-output_shape[0]/2
-            y_in = zyx[1] > output_shape[1]/2 and zyx[1] < input_shape[1]-output_shape[1]/2
-            x_in = zyx[2] > output_shape[2]/2 and zyx[2] < input_shape[2]-output_shape[2]/2
+            z_in = zyx[0] > output_shape[0]//2 and zyx[0] < input_shape[0]-output_shape[0]//2
+            y_in = zyx[1] > output_shape[1]//2 and zyx[1] < input_shape[1]-output_shape[1]//2
+            x_in = zyx[2] > output_shape[2]//2 and zyx[2] < input_shape[2]-output_shape[2]//2
 
             patch_inside_tensor = z_in and y_in and x_in
 
             if patch_inside_tensor:
-                patch_out = data[zyx[0]-output_shape[0]/2:zyx[0]+output_shape[0]/2,
-                                 zyx[1]-output_shape[1]/2:zyx[1]+output_shape[1]/2,
-                                 zyx[2]-output_shape[2]/2:zyx[2]+output_shape[2]/2] 
+                patch_out = data[zyx[0]-output_shape[0]//2:zyx[0]+output_shape[0]//2,
+                                 zyx[1]-output_shape[1]//2:zyx[1]+output_shape[1]//2,
+                                 zyx[2]-output_shape[2]//2:zyx[2]+output_shape[2]//2] 
             else:
                 data_pad = np.empty((input_shape[0]+output_shape[0], 
                                      input_shape[1]+output_shape[1], 
-                                     input_shape[2]+output_shape[2]))
+                                     input_shape[2]+output_shape[2]), dtype=data.dtype)
 
-                data_pad[0:output_shape[0]/2,:,:] = 0
-                data_pad[output_shape[0]/2+input_shape[0]:,:,:] = 0
+                data_pad[0:output_shape[0]//2,:,:] = 0
+                data_pad[output_shape[0]//2+input_shape[0]:,:,:] = 0
 
-                data_pad[:,0:output_shape[1]/2,:] = 0
-                data_pad[:,output_shape[1]/2+input_shape[1]:,:] = 0
+                data_pad[:,0:output_shape[1]//2,:] = 0
+                data_pad[:,output_shape[1]//2+input_shape[1]:,:] = 0
 
-                data_pad[:,:,0:output_shape[2]/2] = 0
-                data_pad[:,:,output_shape[2]/2+input_shape[2]:] = 0
+                data_pad[:,:,0:output_shape[2]//2] = 0
+                data_pad[:,:,output_shape[2]//2+input_shape[2]:] = 0
 
-                data_pad[output_shape[0]/2:output_shape[0]/2+input_shape[0],
-                         output_shape[1]/2:output_shape[1]/2+input_shape[1],
-                         output_shape[2]/2:output_shape[2]/2+input_shape[2],] = data
+                data_pad[output_shape[0]//2:output_shape[0]//2+input_shape[0],
+                         output_shape[1]//2:output_shape[1]//2+input_shape[1],
+                         output_shape[2]//2:output_shape[2]//2+input_shape[2],] = data
 
                 #too slow data_pad = np.lib.pad(data, output_shape[0], mode='constant', constant_values = MIN_HU)
 
-                zyx_pad = zyx + output_shape/2
-                patch_out = data_pad[zyx_pad[0]-output_shape[0]/2:zyx_pad[0]+output_shape[0]/2,
-                                     zyx_pad[1]-output_shape[1]/2:zyx_pad[1]+output_shape[1]/2,
-                                     zyx_pad[2]-output_shape[2]/2:zyx_pad[2]+output_shape[2]/2] 
+                zyx_pad = zyx + output_shape//2
+                patch_out = data_pad[zyx_pad[0]-output_shape[0]//2:zyx_pad[0]+output_shape[0]//2,
+                                     zyx_pad[1]-output_shape[1]//2:zyx_pad[1]+output_shape[1]//2,
+                                     zyx_pad[2]-output_shape[2]//2:zyx_pad[2]+output_shape[2]//2] 
         else:
             mm_patch_size = np.asarray(p_transform['mm_patch_size'], dtype='float32')
             out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
@@ -415,87 +424,132 @@ def transform_dsb_candidates(data, patch_centers, pixel_spacing, p_transform,
             patch_out = apply_affine_transform(data, tf_total, order=p_transform['order'], output_shape=output_shape)
         
         patches_out.append(patch_out[None, :, :, :])
-    return np.concatenate(patches_out, axis=0)
+    return np.concatenate(patches_out, axis=0).astype('float32', copy=False)
 
 
-def build_dsb_can_heatmap(data, candidates, pixel_spacing, p_transform,
+def build_dsb_can_heatmap(data_shape, candidates, pixel_spacing, p_transform,
                              p_transform_augment=None):
+    """
+    Only the shape of the scan is needed, see utils_lung.read_dicom_scan_header
+    """
+    return build_dsb_can_heatmaps([data_shape], [candidates], [pixel_spacing], p_transform,
+                                  p_transform_augment)[0]
 
-    assert(candidates.shape[1]>3)
-
-    mm_patch_size = np.asarray(p_transform['mm_patch_size'], dtype='float32')
-    out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
-
-    input_shape = np.asarray(data.shape)
-    mm_shape = input_shape * pixel_spacing / out_pixel_spacing
-
-    output_shape = p_transform['heatmap_size']
-    max_shape = p_transform['max_shape']
-
-    # Constructing heatmap
-    heatmap = np.zeros(output_shape)
-    max_dims = np.zeros(3)
-    min_dims = 99999*np.ones(3)
-    for can in candidates:
-        value = can[-1]
-        zyx = np.array(can[:3])
-        zyx_mm = zyx * mm_shape / input_shape
-        #only for analyse purpose
-        for idx, d in enumerate(zyx_mm):
-            if d>max_dims[idx]:
-                max_dims[idx] = d
-            if d<min_dims[idx]:
-                min_dims[idx] = d
-        zyx_hm = zyx_mm / max_shape * output_shape
-        heatmap[zyx_hm.astype('int')] += value 
-
-    # print('max_dims', max_dims)
-    # print('min_dims', min_dims)
-    # print('heatmap max', np.amax(heatmap))
-    # print('heatmap min', np.amin(heatmap))
-
-    # augmentation
-    if p_transform_augment:
-        augment_params_sample = sample_augmentation_parameters(p_transform_augment)
-        tf_augment = affine_transform(translation=augment_params_sample.translation, rotation=augment_params_sample.rotation)
-        heatmap = apply_affine_transform(heatmap, tf_augment, order=p_transform['heatmap_order'], output_shape=output_shape)
 
-    heatmap = heatmap / p_transform['heatmap_norm']
+@float32_mode.float32_only
+def build_dsb_can_heatmaps(data_shapes, candidates, pixel_spacings, p_transform,
+                           p_transform_augment=None, out=None):
+    """
+    Heatmaps of the candidates of several scans, or of one scan repeated for test time augmentation.
+    Every candidate adds its value (last column) to the voxel it falls in. The augmentation is
+    sampled per heatmap and applied to the candidate coordinates: each candidate moves to the
+    voxel nearest to where the transform maps it.
+    With translations only this is what resampling the dense heatmap with order 0 gives. With
+    rotations it is not: an order 0 resample of the rotated grid skips some voxels of the
+    heatmap and samples others twice, so it drops or duplicates candidates (on 40 candidates it
+    kept 32), while here every candidate that stays inside the heatmap is counted exactly once.
+    :param out: float32 array of at least len(data_shapes) heatmaps to fill
+    """
+    output_shape = np.asarray(p_transform['heatmap_size'])
+    out_pixel_spacing = np.asarray(p_transform['pixel_spacing'], dtype='float32')
+    max_shape = np.asarray(p_transform['max_shape'], dtype='float32')
 
-    return heatmap
+    n = len(data_shapes)
+    if out is None:
+        out = np.zeros((n,) + tuple(output_shape), dtype='float32')
+    else:
+        out = out[:n]
+        out[...] = 0.
+
+    idxs_all, zyx_all, values_all = [], [], []
+    for i, (data_shape, can, pixel_spacing) in enumerate(zip(data_shapes, candidates, pixel_spacings)):
+        assert (can.shape[1] > 3)
+        # the candidates are in voxels of the scan, data_shape cancels out of zyx * mm_shape / input_shape
+        zyx_mm = can[:, :3] * np.asarray(pixel_spacing, dtype='float32') / out_pixel_spacing
+        zyx_hm = (zyx_mm / max_shape * output_shape).astype('int')
+
+        if p_transform_augment:
+            augment_params_sample = sample_augmentation_parameters(p_transform_augment)
+            tf_augment = affine_transform(translation=augment_params_sample.translation,
+                                          rotation=augment_params_sample.rotation)
+            # apply_affine_transform samples the input at T.dot(output) + s
+            zyx_hm = np.rint(np.linalg.solve(tf_augment[:3, :3], (zyx_hm - tf_augment[:3, 3]).T).T).astype('int')
+
+        idxs_all.append(np.full(len(can), i, dtype='int'))
+        zyx_all.append(zyx_hm)
+        values_all.append(can[:, -1])
+
+    idxs = np.concatenate(idxs_all)
+    zyx = np.concatenate(zyx_all).reshape((-1, 3))
+    values = np.concatenate(values_all).astype('float32')
+    inside = np.all((zyx >= 0) & (zyx < output_shape), axis=1)
+    np.add.at(out, (idxs[inside], zyx[inside, 0], zyx[inside, 1], zyx[inside, 2]), values[inside])
+
+    out /= np.float32(p_transform['heatmap_norm'])
+    return out
+
+
+@float32_mode.float32_only
+def make_3d_mask(img_shape, center, radius, shape='sphere'):
+    mask = np.zeros(img_shape, dtype='float32')
+    add_3d_mask(mask, center, radius, shape)
+    return mask
 
 
-def make_3d_mask(img_shape, center, radius, shape='sphere'):
-    mask = np.zeros(img_shape)
+def add_3d_mask(target, center, radius, shape='sphere'):
+    """
+    Draws a cube, sphere or gaussian into target, touching only its bounding box.
+    Cubes and spheres are maxed with target, gaussians are added to it.
+    """
     radius = np.rint(radius)
     center = np.rint(center)
-    sz = np.arange(int(max(center[0] - radius, 0)), int(max(min(center[0] + radius + 1, img_shape[0]), 0)))
-    sy = np.arange(int(max(center[1] - radius, 0)), int(max(min(center[1] + radius + 1, img_shape[1]), 0)))
-    sx = np.arange(int(max(center[2] - radius, 0)), int(max(min(center[2] + radius + 1, img_shape[2]), 0)))
-    sz, sy, sx = np.meshgrid(sz, sy, sx)
+    # the gaussian is cut off at a distance of sqrt(3) * radius
+    extent = np.floor(np.sqrt(3) * radius) if shape == 'gauss' else radius
+    box = tuple(slice(int(min(max(c - extent, 0), n)), int(max(min(c + extent + 1, n), 0)))
+                for c, n in zip(center, target.shape))
+    if any(b.start >= b.stop for b in box):
+        return target
+
+    z, y, x = np.ogrid[box]
+    distance2 = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2
     if shape == 'cube':
-        mask[sz, sy, sx] = 1.
+        target[box] = 1
     elif shape == 'sphere':
-        distance2 = ((center[0] - sz) ** 2
-                     + (center[1] - sy) ** 2
-                     + (center[2] - sx) ** 2)
-        distance_matrix = np.ones_like(mask) * np.inf
-        distance_matrix[sz, sy, sx] = distance2
-        mask[(distance_matrix <= radius ** 2)] = 1
+        np.maximum(target[box], distance2 <= radius ** 2, out=target[box], casting='unsafe')
     elif shape == 'gauss':
-        z, y, x = np.ogrid[:mask.shape[0], :mask.shape[1], :mask.shape[2]]
-        distance = ((z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2)
-        mask = np.exp(- 1. * distance / (2 * radius ** 2))
-        mask[(distance > 3 * radius ** 2)] = 0
-    return mask
+        stamp = np.exp(- 1. * distance2 / (2 * radius ** 2))
+        stamp[(distance2 > 3 * radius ** 2)] = 0
+        target[box] += stamp.astype(target.dtype)
+    return target
 
 
-def make_3d_mask_from_annotations(img_shape, annotations, shape):
-    mask = np.zeros(img_shape)
+@float32_mode.float32_only
+def make_3d_mask_from_annotations(img_shape, annotations, shape, out=None, dtype='float32'):
+    """
+    Union of the masks of the annotations (z, y, x, diameter), gaussians are summed and clipped to 1.
+    :param out: array of img_shape to draw into, cleared first. uint8 only works for cubes and spheres
+    """
+    if out is None:
+        out = np.zeros(img_shape, dtype=dtype)
+    else:
+        out[...] = 0
     for zyxd in annotations:
-        mask += make_3d_mask(img_shape, zyxd[:3], zyxd[-1] / 2, shape)
-    mask = np.clip(mask, 0., 1.)
-    return mask
+        add_3d_mask(out, zyxd[:3], zyxd[-1] / 2, shape)
+    if shape == 'gauss':
+        np.clip(out, 0., 1., out=out)
+    return out
+
+
+@float32_mode.float32_only
+def make_3d_masks_from_annotations(img_shape, annotations_batch, shape, out=None, dtype='float32'):
+    """
+    make_3d_mask_from_annotations for a batch of patches, into out[i] for the i-th list of annotations
+    """
+    if out is None:
+        out = np.zeros((len(annotations_batch),) + tuple(img_shape), dtype=dtype)
+    for i, annotations in enumerate(annotations_batch):
+        make_3d_mask_from_annotations(img_shape, annotations, shape, out=out[i])
+    return out
 
 
 def make_gaussian_annotation(patch_annotation_tf, patch_size):
@@ -525,7 +579,7 @@ def affine_transform(scale=None, rotation=None, translation=None):
     matrix = np.eye(4)
 
     if translation is not None:
-        matrix[:3, 3] = -np.asarray(translation, np.float)
+        matrix[:3, 3] = -np.asarray(translation, 'float64')
 
     if scale is not None:
         matrix[0, 0] = 1. / scale[0]
@@ -533,10 +587,9 @@ def affine_transform(scale=None, rotation=None, translation=None):
         matrix[2, 2] = 1. / scale[2]
 
     if rotation is not None:
-        rotation = np.asarray(rotation, np.float)
-        rotation = map(math.radians, rotation)
-        cos = map(math.cos, rotation)
-        sin = map(math.sin, rotation)
+        rotation = np.radians(np.asarray(rotation, 'float64'))
+        cos = np.cos(rotation)
+        sin = np.sin(rotation)
 
         mz = np.eye(4)
         mz[1, 1] = cos[0]
@@ -564,5 +617,6 @@ def apply_affine_transform(_input, matrix, order=1, output_shape=None):
     # output.dot(T) + s = input
     T = matrix[:3, :3]
     s = matrix[:3, 3]
-    return scipy.ndimage.interpolation.affine_transform(
-        _input, matrix=T, offset=s, order=order, output_shape=output_shape)
+    # the scans are int16 HU, the resampled output is float32
+    return scipy.ndimage.affine_transform(
+        _input, matrix=T, offset=s, order=order, output_shape=output_shape, output=np.float32)
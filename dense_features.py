@@ -0,0 +1,88 @@
+"""
+Dense feature extraction over the sliding windows of a scan.
+
+generate_features_dsb.py runs a patch model over every patch_size^3 window of a
+scan, at the given stride. Instead of one forward pass per window, the windows
+are copied into a preallocated float32 batch and evaluated batch_size at a time,
+and the features are written straight into a preallocated grid of shape
+(n_z, n_y, n_x, n_features).
+
+Windows can be skipped with a voxel mask of the scan (e.g. a lung mask): a
+window is only evaluated if the mask covers at least min_mask_fraction of it,
+the features of the skipped windows are zero.
+"""
+import numpy as np
+
+import float32_mode
+
+
+def window_starts(size, patch_size, stride):
+    return np.arange(0, size - patch_size, stride)
+
+
+def get_grid_shape(scan_shape, patch_size, stride):
+    return tuple(len(window_starts(s, patch_size, stride)) for s in scan_shape)
+
+
+def window_mask_fractions(mask, patch_size, stride):
+    """
+    Fraction of every window covered by mask, from sums over stride^3 blocks.
+    """
+    if patch_size % stride:
+        raise ValueError('masking windows needs a patch size that is a multiple of the stride')
+    grid_shape = get_grid_shape(mask.shape, patch_size, stride)
+    n_blocks = [s // stride for s in mask.shape]
+    blocks = mask[:n_blocks[0] * stride, :n_blocks[1] * stride, :n_blocks[2] * stride]
+    blocks = blocks.reshape(n_blocks[0], stride, n_blocks[1], stride, n_blocks[2], stride)
+    blocks = blocks.sum(axis=(1, 3, 5), dtype='int64')
+
+    # window sums as differences of the cumulative block sums
+    w = patch_size // stride
+    c = np.zeros([n + 1 for n in n_blocks], dtype='int64')
+    c[1:, 1:, 1:] = blocks.cumsum(0).cumsum(1).cumsum(2)
+    z, y, x = [slice(0, n) for n in grid_shape]
+    z1, y1, x1 = [slice(w, w + n) for n in grid_shape]
+    sums = (c[z1, y1, x1] - c[z, y1, x1] - c[z1, y, x1] - c[z1, y1, x]
+            + c[z, y, x1] + c[z, y1, x] + c[z1, y, x] - c[z, y, x])
+    return sums / float(patch_size ** 3)
+
+
+@float32_mode.float32_only
+def extract_dense_features(x, feature_fn, n_features, patch_size=48, stride=16, batch_size=32,
+                           mask=None, min_mask_fraction=0.01, out=None, metrics=None):
+    """
+    :param x: scan, any leading dimensions of size 1 are dropped
+    :param feature_fn: maps a float32 batch of windows (n, patch_size, patch_size, patch_size)
+     to features (n, n_features)
+    :param mask: voxel mask of the scan, windows mostly outside of it are skipped
+    :param out: float32 array of the grid shape to write the features into
+    :param metrics: metrics.StageMetrics to time the feature_fn calls with
+    :return: the feature grid and the number of windows evaluated
+    """
+    x = x.reshape(x.shape[-3:])
+    grid_shape = get_grid_shape(x.shape, patch_size, stride)
+    if out is None:
+        out = np.zeros(grid_shape + (n_features,), dtype='float32')
+    else:
+        out[...] = 0.
+
+    if mask is None:
+        window_idxs = np.indices(grid_shape).reshape(3, -1).T
+    else:
+        fractions = window_mask_fractions(np.asarray(mask).reshape(x.shape), patch_size, stride)
+        window_idxs = np.argwhere(fractions >= min_mask_fraction)
+
+    batch = np.empty((batch_size, patch_size, patch_size, patch_size), dtype='float32')
+    for pos in range(0, len(window_idxs), batch_size):
+        idxs_batch = window_idxs[pos:pos + batch_size]
+        nb = len(idxs_batch)
+        for i, (iz, iy, ix) in enumerate(idxs_batch):
+            z, y, x0 = iz * stride, iy * stride, ix * stride
+            batch[i] = x[z:z + patch_size, y:y + patch_size, x0:x0 + patch_size]
+        if metrics is None:
+            features = feature_fn(batch[:nb])
+        else:
+            with metrics.timer('feature_fn'):
+                features = feature_fn(batch[:nb])
+        out[idxs_batch[:, 0], idxs_batch[:, 1], idxs_batch[:, 2]] = features
+    return out, len(window_idxs)
@@ -0,0 +1,123 @@
+"""
+Strict float32 mode and float64 allocation audit of the preprocessing code.
+
+Scans are int16 HU and everything after resampling is float32; a float64 array
+of scan or patch size doubles the memory traffic of the data loaders.
+theano.config.warn_float64 only guards the graphs, this guards the numpy side.
+
+ - Functions decorated with float32_only raise Float64Error when they return a
+   float64 array of more than MAX_FLOAT64_BYTES. The check is only installed in
+   strict mode: run a script with --strict-float32 (or LUNG_STRICT_FLOAT32=1 in
+   the environment); otherwise the functions are left as they are.
+ - audit() records the float64 arrays above the threshold that numpy's array
+   creation functions (np.zeros, np.empty, ...) return to code of this repository
+   while it is active.
+
+    python audit_float64.py
+
+runs the hot paths of data_transforms, data_iterators and friends on synthetic
+data under audit() and in strict mode, and fails if any of them returns or
+allocates float64 above the threshold.
+"""
+import functools
+import os
+import sys
+import traceback
+from contextlib import contextmanager
+
+import numpy as np
+
+ENV_VAR = 'LUNG_STRICT_FLOAT32'
+# small float64 arrays (affine matrices, histograms, candidate lists) are fine
+MAX_FLOAT64_BYTES = 2 ** 20
+
+if '--strict-float32' in sys.argv:
+    sys.argv.remove('--strict-float32')
+    os.environ[ENV_VAR] = '1'
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+_CREATION_FUNCTIONS = ('zeros', 'empty', 'ones', 'full', 'zeros_like', 'empty_like', 'ones_like', 'full_like')
+
+
+class Float64Error(TypeError):
+    pass
+
+
+def enabled():
+    return os.environ.get(ENV_VAR, '0') not in ('', '0')
+
+
+def find_float64(value, max_bytes=MAX_FLOAT64_BYTES):
+    """
+    Shapes of the float64 arrays of more than max_bytes in value, a (nested) tuple, list or dict of arrays.
+    """
+    if isinstance(value, np.ndarray):
+        return [value.shape] if value.dtype == np.float64 and value.nbytes > max_bytes else []
+    if isinstance(value, (tuple, list)):
+        return [shape for v in value for shape in find_float64(v, max_bytes)]
+    if isinstance(value, dict):
+        return [shape for v in value.values() for shape in find_float64(v, max_bytes)]
+    return []
+
+
+def check(value, where, max_bytes=MAX_FLOAT64_BYTES):
+    shapes = find_float64(value, max_bytes)
+    if shapes:
+        raise Float64Error('%s returned float64 arrays of shapes %s' % (where, shapes))
+    return value
+
+
+def float32_only(fn):
+    """
+    In strict mode, fn raises Float64Error when it returns a large float64 array.
+    """
+    if not enabled():
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return check(fn(*args, **kwargs), '%s.%s' % (fn.__module__, fn.__name__))
+
+    return wrapper
+
+
+def _caller_in_repo():
+    # the innermost frame outside numpy and this module, if it is code of this repository
+    for filename, lineno, name, _ in reversed(traceback.extract_stack()[:-2]):
+        if os.path.abspath(filename) == os.path.abspath(__file__):
+            continue
+        if os.path.dirname(os.path.abspath(filename)) == REPO_DIR or \
+                os.path.abspath(filename).startswith(REPO_DIR + os.sep + 'configs_'):
+            return '%s:%d (%s)' % (os.path.relpath(filename, REPO_DIR), lineno, name)
+        return None
+    return None
+
+
+@contextmanager
+def audit(max_bytes=MAX_FLOAT64_BYTES):
+    """
+    Yields a list that collects (function, shape, caller) for every float64 array of more than
+    max_bytes created with numpy's creation functions by code of this repository.
+    """
+    allocations = []
+    originals = dict((name, getattr(np, name)) for name in _CREATION_FUNCTIONS)
+
+    def wrap(name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            a = fn(*args, **kwargs)
+            if isinstance(a, np.ndarray) and a.dtype == np.float64 and a.nbytes > max_bytes:
+                caller = _caller_in_repo()
+                if caller is not None:
+                    allocations.append((name, a.shape, caller))
+            return a
+
+        return wrapper
+
+    for name, fn in originals.items():
+        setattr(np, name, wrap(name, fn))
+    try:
+        yield allocations
+    finally:
+        for name, fn in originals.items():
+            setattr(np, name, fn)
@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import pathfinder
 import utils
 from configuration import config, set_configuration
@@ -10,6 +11,10 @@ import theano.tensor as T
 import utils_lung
 import blobs_detection
 import logger
+import work_queue
+import metrics
+import profiling
+import dense_features
 from collections import defaultdict
 
 theano.config.warn_float64 = 'raise'
@@ -33,45 +38,58 @@ sys.stderr = sys.stdout
 # builds model and sets its parameters
 model = config().build_model()
 
-x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
-givens_valid = {}
-givens_valid[model.l_in.input_var] = x_shared
-
-get_featuremap = theano.function([], nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens_valid,
+get_featuremap = compile_cache.function([model.l_in.input_var],
+                                        nn.layers.get_output(model.l_out, deterministic=True),
                                         on_unused_input='ignore')
 
 data_iterator = config().data_iterator
+queue = work_queue.WorkQueue(work_queue.get_queue_dir(config_name),
+                             [utils_lung.extract_pid_dir(p) for p in data_iterator.patient_paths])
+data_iterator.work_queue = queue
+stage_metrics = metrics.open_metrics(config_name)
 
 print()
 print('Data')
 print('n samples: %d' % data_iterator.nsamples)
 
-prev_pid = None
-candidates = []
-patients_count = 0
 patch_size = 48
 stride = 16
-for n, (x, id) in enumerate(data_iterator.generate()):
+n_features = model.l_out.output_shape[1]
+# optional in the config: the number of windows per call and a function of the scan
+# giving the voxels (e.g. the lungs) outside of which windows are skipped
+feature_batch_size = getattr(config(), 'feature_batch_size', 32)
+window_mask_function = getattr(config(), 'window_mask_function', None)
+predictions = None
+for n, (x, id) in enumerate(stage_metrics.iterate(profiling.profile_iterator(data_iterator.generate()))):
     pid = id
-
     print(pid)
-    print(model.l_out.output_shape)
-    predictions = np.empty(((x.shape[2]-patch_size+1)//stride, (x.shape[3]-patch_size+1)//stride, (x.shape[4]-patch_size+1)//stride,) + (model.l_out.output_shape[1],))
-    print(predictions.shape)
     print('x.shape', x.shape)
-    for idxi, i in enumerate(np.arange(0,x.shape[2]-patch_size,stride)):  
-        print('slice idxi', idxi )
-	for idxj, j in enumerate(np.arange(0,x.shape[3]-patch_size,stride)):  
-            for idxk, k in enumerate(np.arange(0,x.shape[4]-patch_size,stride)):
-                #print(i, j, k, '|', idxi, idxj, idxk, x.shape[4], x.shape[4]-patch_size+1)
-		x_in = x[0,0,i:i+patch_size,j:j+patch_size,k:k+patch_size]
-                #print(x_in.shape)
-                x_shared.set_value(x_in[None,:,:,:])
-                fm = get_featuremap()
-		#print(fm.shape)
-                predictions[idxi,idxj,idxk] = fm[0]
-
-    result = np.concatenate(predictions,axis=0)
+
+    grid_shape = dense_features.get_grid_shape(x.shape[-3:], patch_size, stride) + (n_features,)
+    if predictions is None or predictions.shape != grid_shape:
+        predictions = np.zeros(grid_shape, dtype='float32')
+
+    mask = None
+    if window_mask_function is not None:
+        with stage_metrics.timer('window_mask'):
+            mask = window_mask_function(x.reshape(x.shape[-3:]))
+
+    predictions, n_windows = dense_features.extract_dense_features(x, get_featuremap, n_features,
+                                                                   patch_size=patch_size, stride=stride,
+                                                                   batch_size=feature_batch_size,
+                                                                   mask=mask, out=predictions,
+                                                                   metrics=stage_metrics)
+    print('windows evaluated', n_windows, 'of', np.prod(grid_shape[:3]))
+
+    result = predictions.reshape((-1,) + grid_shape[2:])
+
+    if not queue.renew(pid):
+        # the worker that took it over saves the features of this patient
+        continue
 
     utils.save_pkl(result, outputs_path + '/%s.pkl' % pid)
+    queue.complete(pid)
+    stage_metrics.add_samples(1)
+    stage_metrics.flush(n, pid=pid, windows=n_windows)
+
+stage_metrics.close()
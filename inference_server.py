@@ -0,0 +1,86 @@
+"""
+Long-running scoring service for single DSB studies.
+
+Loads the segmentation, false positive reduction, nodule properties and cancer
+classification models once, compiles their prediction functions and then
+answers requests over localhost HTTP, so that scoring a study does not pay for
+process startup, model building and compilation:
+
+    POST /score   {"patient_path": "/data/dsb3/stage2/<pid>"}
+    GET  /health
+
+The response holds the cancer probability, the candidates with their scores
+and the wall time spent in each stage.
+
+Usage: python inference_server.py <seg_config> <fpred_config> <props_config> <class_config> [port]
+"""
+import json
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import theano
+
+import logger
+import pathfinder
+import pipeline
+import utils
+
+theano.config.warn_float64 = 'raise'
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    pipeline = None
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._send_json(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            start_time = time.time()
+            scan = pipeline.load_scan(request['patient_path'])
+            read_time = time.time() - start_time
+            result = self.pipeline.run(scan)
+            result['timings']['read_dicom'] = read_time
+            result['timings']['total'] = time.time() - start_time
+            print(result['pid'], result['cancer_probability'], result['timings'])
+            for k in ('blobs', 'fpred_candidates', 'props_candidates'):
+                result[k] = result[k].tolist()
+            self._send_json(200, result)
+        except Exception as e:
+            print('scoring failed:', repr(e))
+            self._send_json(500, {'error': repr(e)})
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        sys.exit("Usage: inference_server.py <seg_config> <fpred_config> <props_config> <class_config> [port]")
+
+    port = int(sys.argv[5]) if len(sys.argv) > 5 else 8017
+
+    logs_dir = utils.get_dir_path('logs', pathfinder.METADATA_PATH)
+    sys.stdout = logger.Logger(logs_dir + '/inference_server-%s.log' % utils.timestamp())
+    sys.stderr = sys.stdout
+
+    start_time = time.time()
+    ScoringRequestHandler.pipeline = pipeline.Pipeline(pipeline.WarmModels(*sys.argv[1:5]))
+    print('models loaded and compiled in %.2f s' % (time.time() - start_time))
+
+    server = HTTPServer(('127.0.0.1', port), ScoringRequestHandler)
+    print('serving on http://127.0.0.1:%d' % port)
+    server.serve_forever()
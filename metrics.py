@@ -0,0 +1,135 @@
+"""
+Per-stage throughput metrics for the training and inference loops.
+
+The loops time their stages (waiting for data, set_value, the compiled
+function, checkpointing, validation, ...) with named timers and count the
+samples they process. Every flush() appends one JSON line to
+<logs>/<name>.metrics.jsonl with the wall time and samples/s since the last
+flush and, per stage, the number of calls, total time and p50/p95 latency.
+
+    python summarize_metrics.py <logs>/<name>.metrics.jsonl
+
+tells where the time of a run goes. In profiled runs (see profiling.py) every
+stage also gets the peak RSS of the process at the end of its calls.
+"""
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+import profiling
+
+
+class StageMetrics(object):
+    def __init__(self, path, run_name):
+        self.path = path
+        self.run_name = run_name
+        self._file = open(path, 'a')
+        self._durations = OrderedDict()
+        self._samples = 0
+        self._last_flush = time.time()
+        self.track_rss = profiling.enabled()
+        self._peak_rss = {}
+
+    def add_duration(self, stage, seconds):
+        self._durations.setdefault(stage, []).append(seconds)
+        if self.track_rss:
+            self._peak_rss[stage] = profiling.peak_rss_mb()
+
+    @contextmanager
+    def timer(self, stage):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_duration(stage, time.time() - start_time)
+
+    def iterate(self, iterable, stage='data_wait'):
+        """
+        Yields the items of iterable, timing how long every item is waited for.
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_duration(stage, time.time() - start_time)
+            yield item
+
+    def add_samples(self, n):
+        self._samples += n
+
+    def flush(self, step=None, **fields):
+        """
+        Writes the metrics since the last flush as one JSON line and resets them.
+        """
+        now = time.time()
+        wall = now - self._last_flush
+        record = OrderedDict()
+        record['run'] = self.run_name
+        record['time'] = now
+        record['step'] = step
+        record['wall'] = wall
+        record['samples'] = self._samples
+        record['samples_per_s'] = self._samples / wall if wall > 0 else 0.
+        stages = OrderedDict()
+        for stage, durations in self._durations.items():
+            durations = np.asarray(durations)
+            stages[stage] = OrderedDict([('n', len(durations)),
+                                         ('total', float(durations.sum())),
+                                         ('mean', float(durations.mean())),
+                                         ('p50', float(np.percentile(durations, 50))),
+                                         ('p95', float(np.percentile(durations, 95)))])
+            if stage in self._peak_rss:
+                stages[stage]['peak_rss_mb'] = self._peak_rss[stage]
+        record['stages'] = stages
+        record.update(fields)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+        self._durations = OrderedDict()
+        self._peak_rss = {}
+        self._samples = 0
+        self._last_flush = now
+
+    def close(self, step=None):
+        if self._durations or self._samples:
+            self.flush(step)
+        self._file.close()
+
+
+class NoMetrics(object):
+    """
+    Stands in for StageMetrics where nothing is recorded.
+    """
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def iterate(self, iterable, stage='data_wait'):
+        return iter(iterable)
+
+    def add_duration(self, stage, seconds):
+        pass
+
+    def add_samples(self, n):
+        pass
+
+    def flush(self, step=None, **fields):
+        pass
+
+    def close(self, step=None):
+        pass
+
+
+def open_metrics(name):
+    import pathfinder
+    import utils
+    profiling.start(name)
+    logs_dir = utils.get_dir_path('logs', pathfinder.METADATA_PATH)
+    return StageMetrics(logs_dir + '/%s.metrics.jsonl' % name, name)
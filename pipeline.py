@@ -0,0 +1,190 @@
+"""
+In-memory scoring pipeline for a single DSB study.
+
+The file based pipeline runs test_seg_scan_dsb.py, test_fpred_scan_dsb.py,
+test_luna_props_scan_dsb.py and test_class_dsb.py one after the other, every
+stage reading the DICOM scan again and handing its candidates to the next one
+through pickles. Here the scan is decoded once and the HU volume, the blobs and
+the scored candidates are passed between the stages directly:
+
+    models = pipeline.WarmModels('dsb_s2_p8a1', 'dsb_c3_s2_p8a1', 'dsb_relias10_s5_p8a1', config_name)
+    result = pipeline.Pipeline(models).run(pipeline.load_scan(patient_path))
+
+With outputs_dir set, the blobs and candidates are also written in the
+model-predictions layout the file based scripts use.
+"""
+import importlib
+import time
+from collections import namedtuple
+
+import lasagne as nn
+import numpy as np
+
+import blobs_detection
+import checkpoints
+import compile_cache
+import pathfinder
+import utils
+import utils_lung
+
+Scan = namedtuple('Scan', ['pid', 'data', 'pixel_spacing'])
+
+
+def load_scan(patient_path):
+    patient_path = patient_path.rstrip('/')
+    img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
+    return Scan(utils_lung.extract_pid_dir(patient_path), img, pixel_spacing)
+
+
+def compile_predict_fn(model, name):
+    x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
+    givens = {model.l_in.input_var: x_shared}
+    get_predictions = compile_cache.function([], nn.layers.get_output(model.l_out, deterministic=True),
+                                             givens=givens, on_unused_input='ignore', name=name)
+
+    def predict(x):
+        x_shared.set_value(x)
+        return get_predictions()
+
+    return predict
+
+
+class WarmModels(object):
+    """
+    Builds the models of the four stages once and compiles their prediction functions.
+    """
+
+    def __init__(self, seg_config_name, fpred_config_name, props_config_name, class_config_name):
+        self.seg_config_name = seg_config_name
+        self.fpred_config_name = fpred_config_name
+        self.props_config_name = props_config_name
+        self.class_config_name = class_config_name
+
+        self.seg_config = importlib.import_module('configs_seg_scan.%s' % seg_config_name)
+        self.fpred_config = importlib.import_module('configs_fpred_scan.%s' % fpred_config_name)
+        self.props_config = importlib.import_module('configs_luna_props_scan.%s' % props_config_name)
+        self.class_config = importlib.import_module('configs_class_dsb.%s' % class_config_name)
+
+        # the classifier was trained either on the fpred or on the properties candidates
+        self.class_uses_props = getattr(self.class_config, 'candidates_config', None) == props_config_name
+
+        self.predict_seg = compile_predict_fn(self.seg_config.build_model(), 'seg')
+        self.predict_fpred = compile_predict_fn(self.fpred_config.build_model(), 'fpred')
+        self.predict_props = compile_predict_fn(self.props_config.build_model(), 'props')
+
+        metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
+        class_model = self.class_config.build_model()
+        checkpoints.load_params(class_model.l_out, utils.find_model_metadata(metadata_dir, class_config_name))
+        self.predict_class = compile_cache.function([class_model.l_in.input_var],
+                                                    nn.layers.get_output(class_model.l_out, deterministic=True),
+                                                    name='class')
+
+
+class Pipeline(object):
+    def __init__(self, models, outputs_dir=None):
+        self.models = models
+        self.outputs_dir = outputs_dir
+
+    def _persist(self, config_name, pid, obj):
+        if self.outputs_dir is not None:
+            outputs_path = self.outputs_dir + '/%s' % config_name
+            utils.auto_make_dir(outputs_path)
+            utils.save_pkl(obj, outputs_path + '/%s.pkl' % pid)
+
+    def segment(self, scan):
+        cfg = self.models.seg_config
+        x, lung_mask, tf_matrix = cfg.data_iterator.data_prep_fun(data=scan.data, pixel_spacing=scan.pixel_spacing)
+        x = np.asarray(x, dtype='float32')[None, None, :, :, :]
+        lung_mask = np.float32(lung_mask)[None, None, :, :, :]
+
+        window_size, stride, n_windows = cfg.window_size, cfg.stride, int(cfg.n_windows)
+        predictions_scan = np.zeros((1, 1, n_windows * stride, n_windows * stride, n_windows * stride),
+                                    dtype='float32')
+        for iz in range(n_windows):
+            for iy in range(n_windows):
+                for ix in range(n_windows):
+                    predictions_scan[0, 0,
+                    iz * stride:(iz + 1) * stride,
+                    iy * stride:(iy + 1) * stride,
+                    ix * stride:(ix + 1) * stride] = self.models.predict_seg(
+                        x[:, :, iz * stride:(iz * stride) + window_size,
+                        iy * stride:(iy * stride) + window_size,
+                        ix * stride:(ix * stride) + window_size])
+
+        if predictions_scan.shape != x.shape:
+            pad_width = (np.asarray(x.shape) - np.asarray(predictions_scan.shape)) // 2
+            pad_width = [(p, p) for p in pad_width]
+            predictions_scan = np.pad(predictions_scan, pad_width=pad_width, mode='constant')
+        predictions_scan *= lung_mask
+
+        blobs = blobs_detection.blob_dog(predictions_scan[0, 0], min_sigma=1, max_sigma=15, threshold=0.1)
+        blobs_original_voxel_coords = [tf_matrix.dot(np.append(blob[:3], [1])) for blob in blobs]
+        return np.asarray(blobs_original_voxel_coords).reshape((-1, 4))
+
+    def _score_patches(self, scan, cfg, predict, blobs):
+        predictions = []
+        for candidate in blobs:
+            x = np.float32(cfg.data_iterator.data_prep_fun(data=scan.data,
+                                                           patch_center=candidate[:3],
+                                                           pixel_spacing=scan.pixel_spacing))[None, :, :, :]
+            predictions.append(predict(x))
+        return predictions
+
+    def reduce_false_positives(self, scan, blobs):
+        predictions = self._score_patches(scan, self.models.fpred_config, self.models.predict_fpred, blobs)
+        candidates = [np.append(candidate, [[p[0][1]]]) for candidate, p in zip(blobs, predictions)]
+        candidates = sorted(candidates, key=lambda x: x[-1], reverse=True)
+        return np.asarray(candidates).reshape((-1, blobs.shape[1] + 1))
+
+    def predict_properties(self, scan, blobs):
+        predictions = self._score_patches(scan, self.models.props_config, self.models.predict_props, blobs)
+        return np.asarray([np.append(candidate, [p]) for candidate, p in zip(blobs, predictions)])
+
+    def classify(self, scan, candidates):
+        data_iterator = self.models.class_config.test_data_iterator
+        n_candidates = data_iterator.n_candidates_per_patient
+        if data_iterator.candidates_prep_fun:
+            top_candidates = data_iterator.candidates_prep_fun(candidates, n_candidates)
+        else:
+            top_candidates = candidates[:n_candidates]
+
+        top_candidates = np.array(top_candidates, dtype='float32')
+
+        x = np.zeros((1, n_candidates) + data_iterator.transform_params['patch_size'], dtype='float32')
+        if len(top_candidates):
+            x[0, :len(top_candidates)] = np.float32(data_iterator.data_prep_fun(data=scan.data, pid=scan.pid,
+                                                                                patch_centers=top_candidates,
+                                                                                pixel_spacing=scan.pixel_spacing))
+        predictions = self.models.predict_class(x)
+        return float(predictions[0, 1] if predictions.shape[-1] == 2 else predictions[0, 0])
+
+    def run(self, scan):
+        timings = {}
+
+        start_time = time.time()
+        blobs = self.segment(scan)
+        timings['segmentation'] = time.time() - start_time
+        self._persist(self.models.seg_config_name, scan.pid, blobs)
+
+        start_time = time.time()
+        fpred_candidates = self.reduce_false_positives(scan, blobs)
+        timings['fpred'] = time.time() - start_time
+        self._persist(self.models.fpred_config_name, scan.pid, fpred_candidates)
+
+        start_time = time.time()
+        props_candidates = self.predict_properties(scan, blobs)
+        timings['props'] = time.time() - start_time
+        self._persist(self.models.props_config_name, scan.pid, props_candidates)
+
+        start_time = time.time()
+        class_candidates = props_candidates if self.models.class_uses_props else fpred_candidates
+        cancer_probability = self.classify(scan, class_candidates)
+        timings['classification'] = time.time() - start_time
+
+        return {'pid': scan.pid,
+                'cancer_probability': cancer_probability,
+                'pixel_spacing': [float(s) for s in scan.pixel_spacing],
+                'blobs': blobs,
+                'fpred_candidates': fpred_candidates,
+                'props_candidates': props_candidates,
+                'timings': timings}
@@ -15,7 +15,7 @@ set_configuration(config_dir, config_name)
 metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
 metadata_path = utils.find_model_metadata(metadata_dir, config_name)
 
-metadata = utils.load_pkl(metadata_path)
+metadata = utils.load_model_metadata(metadata_path)
 expid = metadata['experiment_id']
 
 analysis_dir = utils.get_dir_path('analysis', pathfinder.METADATA_PATH)
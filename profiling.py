@@ -0,0 +1,140 @@
+"""
+Opt-in profiling of the train_*/test_* scripts.
+
+Run a script with --profile (or with LUNG_PROFILE=1 in the environment):
+
+    python train_class_dsb.py <configuration_name> --profile
+
+The flag is taken out of sys.argv when this module is imported, which happens
+through compile_cache and buffering before the scripts read their arguments,
+and is passed on to child processes through the environment. In a profiled run
+
+ - compile_cache.function compiles with theano's per-op profiler (and bypasses
+   the compile cache); the op and apply summaries of all functions are written
+   to theano_profile.txt at exit,
+ - the data iterators' generate() runs under cProfile inside the thread or
+   process that drives it (buffering, or profile_iterator in the scripts that
+   iterate directly); every generator gets a .prof file and a text summary,
+ - metrics.StageMetrics adds the peak RSS of the process to every stage.
+
+The reports go to <METADATA_PATH>/profiles/<name>/, where name is the
+experiment id (or the configuration name for inference) the script opens its
+metrics with.
+"""
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import resource
+import sys
+import threading
+
+ENV_VAR = 'LUNG_PROFILE'
+
+if '--profile' in sys.argv:
+    sys.argv.remove('--profile')
+    os.environ[ENV_VAR] = '1'
+
+_run_name = None
+_functions = []
+_lock = threading.Lock()
+
+
+def enabled():
+    return os.environ.get(ENV_VAR, '0') not in ('', '0')
+
+
+def start(name):
+    """
+    Names the report directory of this run. The first name given wins.
+    """
+    global _run_name
+    if _run_name is None:
+        _run_name = name
+
+
+def get_report_dir():
+    import pathfinder
+    import utils
+    name = _run_name
+    if name is None:
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        name = '-'.join([script] + sys.argv[1:2])
+    report_dir = utils.get_dir_path('profiles', pathfinder.METADATA_PATH) + '/' + name
+    utils.auto_make_dir(report_dir)
+    return report_dir
+
+
+def peak_rss_mb():
+    """
+    High-water mark of the resident memory of this process in MB.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss / 2. ** 20 if sys.platform == 'darwin' else maxrss / 2. ** 10
+
+
+def register_function(fn, name):
+    """
+    Keeps a function compiled with profile=True so that its profile is written at exit.
+    """
+    with _lock:
+        if not _functions:
+            atexit.register(_write_theano_profiles)
+        _functions.append((name, fn))
+
+
+def _write_theano_profiles():
+    path = get_report_dir() + '/theano_profile.txt'
+    with open(path, 'w') as f:
+        for name, fn in _functions:
+            profile = getattr(fn, 'profile', None)
+            if profile is None:
+                continue
+            f.write('=' * 80 + '\n%s\n' % name + '=' * 80 + '\n')
+            profile.summary(file=f)
+            f.write('\n')
+    print('theano profiles written to', path)
+
+
+def _write_generator_profile(profiler, name, n_items):
+    path = get_report_dir() + '/generate-%s-%d-%d' % (name, os.getpid(), threading.current_thread().ident)
+    profiler.dump_stats(path + '.prof')
+    s = io.StringIO()
+    s.write('%s: %d items, peak RSS of process %d: %.1f MB\n\n' % (name, n_items, os.getpid(), peak_rss_mb()))
+    pstats.Stats(profiler, stream=s).sort_stats('cumulative').print_stats(50)
+    with open(path + '.txt', 'w') as f:
+        f.write(s.getvalue())
+
+
+def profile_iterator(source_gen, name=None):
+    """
+    Yields the items of source_gen, profiling the code that produces them with cProfile.
+    cProfile only sees the thread it runs in, so call this in the thread that
+    consumes source_gen. Returns source_gen as it is when profiling is off.
+    """
+    if not enabled():
+        return source_gen
+    if name is None:
+        name = getattr(source_gen, '__qualname__', type(source_gen).__name__)
+    return _profile_iterator(source_gen, name)
+
+
+def _profile_iterator(source_gen, name):
+    profiler = cProfile.Profile()
+    iterator = iter(source_gen)
+    n_items = 0
+    try:
+        while True:
+            profiler.enable()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+            n_items += 1
+            yield item
+    finally:
+        _write_generator_profile(profiler, name, n_items)
@@ -0,0 +1,144 @@
+"""
+Cost-aware static sharding of patients.
+
+Splitting the patients into parts of equal size leaves one part running long
+after the others, because the processing time of a patient scales with the size
+of its scan and with the number of blobs found in it, not with the patient count.
+Here the cost of every patient is estimated from cheap metadata (the slice
+count and spacing from the DICOM headers and, for the patch stages, the blob
+count of the previous stage) and the patients are assigned to the parts with the
+longest-processing-time-first rule.
+
+The header records are the ones utils_lung.load_dicom_scan_header caches in
+<METADATA_PATH>/dicom_headers, shared with the heatmap data iterator. Shard
+scripts record their predicted cost and actual wall time in
+<METADATA_PATH>/shard-plans:
+
+    python shard_planner.py <config_name>
+
+prints the predicted versus the actual wall time of every part.
+"""
+import heapq
+import json
+import os
+import sys
+
+import pathfinder
+import utils
+import utils_lung
+
+def get_plans_dir():
+    return utils.get_dir_path('shard-plans', pathfinder.METADATA_PATH)
+
+
+def get_scan_features(patient_paths):
+    """
+    Returns pid -> slice count, voxel spacing and shape of the scans, from the DICOM
+    header records that utils_lung.load_dicom_scan_header reads once and caches.
+    """
+    pid2features = {}
+    for p in patient_paths:
+        header = utils_lung.load_dicom_scan_header(p)
+        pid2features[utils_lung.extract_pid_dir(p)] = {'n_slices': int(header['shape'][0]),
+                                                       'pixel_spacing': [float(s) for s in header['pixel_spacing']],
+                                                       'shape': [int(s) for s in header['shape']]}
+    return pid2features
+
+
+def get_blob_counts(candidates_dir):
+    """
+    Returns pid -> number of candidates a previous stage wrote to candidates_dir.
+    """
+    id2candidates_path = utils_lung.get_candidates_paths(candidates_dir)
+    return dict((pid, len(utils.load_pkl(path))) for pid, path in id2candidates_path.items())
+
+
+def estimate_cost(features, n_blobs=0, volume_weight=1., slice_weight=0.01, blob_weight=0.):
+    """
+    Relative cost of a patient. The volume term (in dm^3) covers the resampling and
+    the sliding window segmentation, the slice term the DICOM decoding and the
+    blob term the patch stages, which run the model once per candidate.
+    """
+    volume = features['n_slices'] * features['pixel_spacing'][0] * \
+             features['shape'][1] * features['pixel_spacing'][1] * \
+             features['shape'][2] * features['pixel_spacing'][2] * 1e-6
+    return volume_weight * volume + slice_weight * features['n_slices'] + blob_weight * n_blobs
+
+
+def estimate_costs(patient_paths, candidates_dir=None, **kwargs):
+    """
+    Returns pid -> relative cost for the patients in patient_paths. Pass the
+    outputs directory of the previous stage as candidates_dir and a blob_weight
+    to account for the number of candidates of each patient.
+    """
+    pid2features = get_scan_features(patient_paths)
+    pid2blobs = get_blob_counts(candidates_dir) if candidates_dir is not None else {}
+    pid2cost = {}
+    for p in patient_paths:
+        pid = utils_lung.extract_pid_dir(p)
+        pid2cost[pid] = estimate_cost(pid2features[pid], pid2blobs.get(pid, 0), **kwargs)
+    return pid2cost
+
+
+def plan_shards(pids, pid2cost, n_shards):
+    """
+    Longest-processing-time-first: the patients, most expensive first, each go to
+    the part with the lowest total cost so far. Patients without a cost estimate
+    get the mean cost. Returns the pids of every part, in decreasing order of cost.
+    """
+    known_costs = [pid2cost[pid] for pid in pids if pid in pid2cost]
+    default_cost = sum(known_costs) / len(known_costs) if known_costs else 1.
+    costs = [(pid2cost.get(pid, default_cost), pid) for pid in pids]
+    # ties are broken by pid, so that every process plans the same parts
+    costs.sort(key=lambda x: (-x[0], x[1]))
+
+    shards = [[] for _ in range(n_shards)]
+    heap = [(0., i) for i in range(n_shards)]
+    for cost, pid in costs:
+        total, i = heapq.heappop(heap)
+        shards[i].append(pid)
+        heapq.heappush(heap, (total + cost, i))
+    return shards
+
+
+def get_shard_cost(pids, pid2cost):
+    return sum(pid2cost.get(pid, 0.) for pid in pids)
+
+
+def save_shard_timing(config_name, part, predicted_cost, wall_time, n_patients):
+    timings_dir = get_plans_dir() + '/%s' % config_name
+    utils.auto_make_dir(timings_dir)
+    with open(timings_dir + '/part%d.json' % part, 'w') as f:
+        json.dump({'part': part, 'predicted_cost': predicted_cost, 'wall_time': wall_time,
+                   'n_patients': n_patients, 'host': utils.hostname()}, f)
+
+
+def report(config_name):
+    """
+    Prints the predicted and the actual wall time of every part. The relative
+    costs are converted to seconds with the overall rate of the finished parts.
+    """
+    timings_dir = get_plans_dir() + '/%s' % config_name
+    timings = []
+    for f in sorted(os.listdir(timings_dir)):
+        if f.endswith('.json'):
+            with open(timings_dir + '/' + f) as fp:
+                timings.append(json.load(fp))
+    total_cost = sum(t['predicted_cost'] for t in timings)
+    seconds_per_cost = sum(t['wall_time'] for t in timings) / total_cost if total_cost else 0.
+
+    print('%-6s %10s %14s %14s %8s' % ('part', 'patients', 'predicted', 'actual', 'ratio'))
+    for t in timings:
+        predicted = t['predicted_cost'] * seconds_per_cost
+        print('%-6d %10d %14s %14s %8.2f' % (t['part'], t['n_patients'], utils.hms(predicted),
+                                             utils.hms(t['wall_time']),
+                                             t['wall_time'] / predicted if predicted else 0.))
+    if timings:
+        wall_times = [t['wall_time'] for t in timings]
+        print('longest part / mean part: %.2f' % (max(wall_times) / (sum(wall_times) / len(wall_times))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("Usage: shard_planner.py <configuration_name>")
+    report(sys.argv[1])
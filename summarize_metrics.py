@@ -0,0 +1,55 @@
+"""
+Summarizes the JSON-lines metrics written by metrics.StageMetrics.
+
+For every run in the file: wall time, samples and samples/s, and per stage the
+number of calls, the total time and its share of the wall time, the mean
+latency, the median of the p50s and the worst p95 over the flushes, and the
+peak RSS for profiled runs.
+
+Usage: python summarize_metrics.py <metrics.jsonl> [<metrics.jsonl> ...]
+"""
+import json
+import sys
+from collections import OrderedDict
+
+import numpy as np
+
+
+def summarize(path):
+    runs = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                runs.setdefault(record['run'], []).append(record)
+
+    for run, records in runs.items():
+        wall = sum(r['wall'] for r in records)
+        samples = sum(r['samples'] for r in records)
+        print(run)
+        print('  wall time %.1f s, %d samples, %.2f samples/s' % (wall, samples, samples / wall if wall else 0.))
+
+        stages = OrderedDict()
+        for r in records:
+            for stage, s in r['stages'].items():
+                stages.setdefault(stage, []).append(s)
+
+        print('  %-20s %8s %10s %7s %10s %10s %10s %12s' % ('stage', 'calls', 'total s', 'share', 'mean ms',
+                                                          'p50 ms', 'p95 ms', 'peak RSS MB'))
+        for stage, stats in sorted(stages.items(), key=lambda x: -sum(s['total'] for s in x[1])):
+            n = sum(s['n'] for s in stats)
+            total = sum(s['total'] for s in stats)
+            peak_rss = [s['peak_rss_mb'] for s in stats if 'peak_rss_mb' in s]
+            print('  %-20s %8d %10.1f %6.1f%% %10.2f %10.2f %10.2f %12s' % (
+                stage, n, total, 100. * total / wall if wall else 0., 1000. * total / n if n else 0.,
+                1000. * np.median([s['p50'] for s in stats]), 1000. * max(s['p95'] for s in stats),
+                '%.0f' % max(peak_rss) if peak_rss else '-'))
+        print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("Usage: summarize_metrics.py <metrics.jsonl> [<metrics.jsonl> ...]")
+    for path in sys.argv[1:]:
+        summarize(path)
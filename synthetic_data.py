@@ -0,0 +1,274 @@
+"""
+Synthetic CT data for benchmarks and smoke runs without the LUNA/DSB data.
+
+make_ct_volume builds an int16 HU volume with a body, two lungs and spherical
+nodules inside the lungs. write_dicom_series and write_mhd store it the way
+the DSB and LUNA scans come, and make_dataset lays out a complete data tree
+(DICOM patients, LUNA .mhd scans, labels, splits, candidate files and the
+SETTINGS.json that pathfinder reads) under one directory:
+
+    paths = synthetic_data.make_dataset('/tmp/lung-synthetic')
+    synthetic_data.activate(paths['root'])
+    import pathfinder  # now points into /tmp/lung-synthetic
+
+Coordinates follow the rest of the code: volumes and voxel coordinates are
+zyx, LUNA world coordinates in the csv files are xyz.
+"""
+import csv
+import json
+import os
+import uuid
+
+import numpy as np
+
+import utils
+
+DEFAULT_SHAPE = (160, 512, 512)
+DEFAULT_PIXEL_SPACING = (2.5, 0.7, 0.7)
+RESCALE_INTERCEPT = -1024
+_UID_ROOT = '1.2.826.0.1.3680043.9.7307'
+
+
+def make_ct_volume(shape=DEFAULT_SHAPE, pixel_spacing=DEFAULT_PIXEL_SPACING, n_nodules=5, rng=None):
+    """
+    Returns an int16 HU volume and its nodules as a (n_nodules, 4) array of
+    zyx voxel coordinates and diameters in mm.
+    """
+    rng = np.random.RandomState(317070) if rng is None else rng
+    shape = np.asarray(shape)
+    pixel_spacing = np.asarray(pixel_spacing, dtype='float32')
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    yc, xc = shape[1] / 2., shape[2] / 2.
+
+    volume = np.full(tuple(shape), -1000, dtype='int16')
+    body = ((y - yc) / (0.42 * shape[1])) ** 2 + ((x - xc) / (0.46 * shape[2])) ** 2 <= 1.
+    volume[np.broadcast_to(body, volume.shape)] = 40
+
+    lung_centers = []
+    lungs = np.zeros(tuple(shape), dtype='bool')
+    zc = shape[0] / 2.
+    for side in (-1, 1):
+        center = np.array([zc, yc, xc + side * 0.22 * shape[2]])
+        radii = np.array([0.45 * shape[0], 0.3 * shape[1], 0.17 * shape[2]])
+        lungs |= (((z - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2
+                  + ((x - center[2]) / radii[2]) ** 2) <= 1.
+        lung_centers.append((center, radii))
+    volume[lungs] = -850
+
+    nodules = []
+    for i in range(n_nodules):
+        center, radii = lung_centers[i % 2]
+        zyx = center + rng.uniform(-0.5, 0.5, size=3) * radii
+        diameter_mm = rng.uniform(4., 25.)
+        radius_vox = diameter_mm / 2. / pixel_spacing
+        lo = np.maximum(np.floor(zyx - radius_vox), 0).astype('int')
+        hi = np.minimum(np.ceil(zyx + radius_vox) + 1, shape).astype('int')
+        zz, yy, xx = np.ogrid[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        sphere = (((zz - zyx[0]) / radius_vox[0]) ** 2 + ((yy - zyx[1]) / radius_vox[1]) ** 2
+                  + ((xx - zyx[2]) / radius_vox[2]) ** 2) <= 1.
+        volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]][sphere] = 30
+        nodules.append(np.append(zyx, diameter_mm))
+
+    for iz in range(shape[0]):
+        volume[iz] += rng.normal(0, 20, size=volume.shape[1:]).astype('int16')
+    np.clip(volume, -1000, 3000, out=volume)
+    return volume, np.asarray(nodules, dtype='float32').reshape(-1, 4)
+
+
+def make_candidates(nodules, shape, n_false=50, n_properties=0, rng=None):
+    """
+    Candidate rows as the detection scripts store them: zyx voxel coordinates,
+    diameter, a score (high for the true nodules) and n_properties extra
+    columns, sorted by decreasing score.
+    """
+    rng = np.random.RandomState(42) if rng is None else rng
+    false_zyx = rng.uniform(0.1, 0.9, size=(n_false, 3)) * np.asarray(shape)
+    zyx = np.concatenate([nodules[:, :3], false_zyx])
+    diameters = np.concatenate([nodules[:, 3], rng.uniform(2., 10., size=n_false)])
+    scores = np.concatenate([rng.uniform(0.6, 1., size=len(nodules)), rng.uniform(0., 0.6, size=n_false)])
+    candidates = np.column_stack([zyx, diameters, scores, rng.uniform(size=(len(zyx), n_properties))])
+    return candidates[np.argsort(-scores)]
+
+
+def _uid():
+    return '%s.%d' % (_UID_ROOT, uuid.uuid4().int)
+
+
+def write_dicom_series(volume, pixel_spacing, patient_dir, n_series=1, patient_id=None):
+    """
+    Writes volume (zyx, HU) as one DICOM file per slice with shuffled file
+    names. With n_series > 1 the same slices are stored again as extra series,
+    like the DSB patients with multiple series.
+    """
+    from dicom.dataset import Dataset, FileDataset
+
+    utils.auto_make_dir(patient_dir)
+    patient_id = patient_id or os.path.basename(patient_dir.rstrip('/'))
+    study_uid = _uid()
+    nz, ny, nx = volume.shape
+    origin = (-nx * pixel_spacing[2] / 2., -ny * pixel_spacing[1] / 2., 0.)
+    for s in range(n_series):
+        series_uid = _uid()
+        for iz in range(nz):
+            sop_uid = _uid()
+            file_meta = Dataset()
+            file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+            file_meta.MediaStorageSOPInstanceUID = sop_uid
+            file_meta.TransferSyntaxUID = '1.2.840.10008.1.2'
+            path = patient_dir + '/%s.dcm' % uuid.uuid4().hex
+            ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+            ds.is_little_endian = True
+            ds.is_implicit_VR = True
+            ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+            ds.SOPInstanceUID = sop_uid
+            ds.StudyInstanceUID = study_uid
+            ds.SeriesInstanceUID = series_uid
+            ds.PatientID = patient_id
+            ds.Modality = 'CT'
+            ds.InstanceNumber = s * nz + nz - iz
+            z_position = origin[2] + iz * pixel_spacing[0]
+            ds.ImagePositionPatient = [origin[0], origin[1], z_position]
+            ds.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+            ds.SliceLocation = z_position
+            ds.SliceThickness = float(pixel_spacing[0])
+            ds.PixelSpacing = [float(pixel_spacing[1]), float(pixel_spacing[2])]
+            ds.Rows, ds.Columns = ny, nx
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = 'MONOCHROME2'
+            ds.BitsAllocated = 16
+            ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 1
+            ds.RescaleIntercept = RESCALE_INTERCEPT
+            ds.RescaleSlope = 1
+            ds.PixelData = (volume[iz].astype('int32') - RESCALE_INTERCEPT).astype('<i2').tobytes()
+            ds.save_as(path)
+
+
+def write_mhd(volume, pixel_spacing, path, origin=(-200., -180., -180.)):
+    """
+    Writes volume (zyx) as a .mhd/.raw pair, origin and spacing given in zyx.
+    """
+    import SimpleITK as sitk
+    itk_image = sitk.GetImageFromArray(volume)
+    itk_image.SetSpacing([float(s) for s in reversed(pixel_spacing)])
+    itk_image.SetOrigin([float(o) for o in reversed(origin)])
+    sitk.WriteImage(itk_image, path)
+
+
+def _write_csv(path, header, rows):
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def make_dataset(root, n_dsb=4, n_luna=2, shape=DEFAULT_SHAPE, pixel_spacing=DEFAULT_PIXEL_SPACING,
+                 n_false_candidates=50, seed=0):
+    """
+    Builds a synthetic data tree under root and returns the paths in it.
+    An existing tree with the same parameters is reused.
+    """
+    root = os.path.abspath(root)
+    params = {'n_dsb': n_dsb, 'n_luna': n_luna, 'shape': list(shape), 'pixel_spacing': list(pixel_spacing),
+              'n_false_candidates': n_false_candidates, 'seed': seed}
+    paths = {'root': root,
+             'dsb': root + '/dsb/stage1',
+             'candidates': root + '/candidates',
+             'luna': root + '/luna/scans',
+             'luna_seg': root + '/luna/seg',
+             'luna_nodule_annotations': root + '/luna/nodule_annotations',
+             'metadata': root + '/metadata',
+             'labels': root + '/dsb/stage1_labels.csv',
+             'test_labels': root + '/dsb/test_labels.csv',
+             'sample_submission': root + '/dsb/stage1_sample_submission.csv',
+             'validation_split': root + '/dsb/validation_split.pkl',
+             'final_split': root + '/dsb/final_split.pkl',
+             'lb_mixed_split': root + '/dsb/validation_lb_mixed_split.pkl',
+             'luna_labels': root + '/luna/annotations.csv',
+             'luna_candidates': root + '/luna/candidates_V2.csv',
+             'luna_validation_split': root + '/luna/validation_split.pkl',
+             'luna_properties': root + '/luna/annotations_extended.csv'}
+
+    params_path = root + '/dataset.json'
+    if os.path.isfile(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return paths
+
+    for key in ('dsb', 'candidates', 'luna', 'luna_seg', 'luna_nodule_annotations', 'metadata'):
+        utils.auto_make_dir(paths[key])
+
+    rng = np.random.RandomState(seed)
+
+    dsb_pids = ['%032x' % rng.randint(2 ** 31) for _ in range(n_dsb)]
+    for pid in dsb_pids:
+        volume, nodules = make_ct_volume(shape, pixel_spacing, rng=rng)
+        write_dicom_series(volume, pixel_spacing, paths['dsb'] + '/' + pid)
+        utils.save_pkl(make_candidates(nodules, shape, n_false_candidates, rng=rng),
+                       paths['candidates'] + '/%s.pkl' % pid)
+
+    labels = [(pid, i % 2) for i, pid in enumerate(dsb_pids)]
+    _write_csv(paths['labels'], ['id', 'cancer'], labels)
+    _write_csv(paths['sample_submission'], ['id', 'cancer'], [(pid, 0.5) for pid in dsb_pids])
+    with open(paths['test_labels'], 'w') as f:
+        f.write('id;cancer\n')
+        f.writelines('%s;%d\n' % label for label in labels)
+    n_train = max(n_dsb - 1, 1)
+    split = {'training': dsb_pids[:n_train], 'validation': dsb_pids[n_train:], 'test': []}
+    for key in ('validation_split', 'final_split', 'lb_mixed_split'):
+        utils.save_pkl(split, paths[key])
+
+    luna_annotations, luna_candidates = [], []
+    luna_pids = ['1.3.6.1.4.1.14519.5.2.1.6279.6001.%d' % rng.randint(2 ** 31) for _ in range(n_luna)]
+    origin = np.array([-200., -180., -180.])
+    for pid in luna_pids:
+        volume, nodules = make_ct_volume(shape, pixel_spacing, rng=rng)
+        write_mhd(volume, pixel_spacing, paths['luna'] + '/%s.mhd' % pid, origin)
+        for zyxd in nodules:
+            world_zyx = origin + zyxd[:3] * np.asarray(pixel_spacing)
+            luna_annotations.append((pid, world_zyx[2], world_zyx[1], world_zyx[0], zyxd[3]))
+            luna_candidates.append((pid, world_zyx[2], world_zyx[1], world_zyx[0], 1))
+        for zyx in rng.uniform(0.1, 0.9, size=(n_false_candidates, 3)) * np.asarray(shape):
+            world_zyx = origin + zyx * np.asarray(pixel_spacing)
+            luna_candidates.append((pid, world_zyx[2], world_zyx[1], world_zyx[0], 0))
+    _write_csv(paths['luna_labels'], ['seriesuid', 'coordX', 'coordY', 'coordZ', 'diameter_mm'], luna_annotations)
+    _write_csv(paths['luna_candidates'], ['seriesuid', 'coordX', 'coordY', 'coordZ', 'class'], luna_candidates)
+    _write_csv(paths['luna_properties'],
+               ['seriesuid', 'coordX', 'coordY', 'coordZ', 'diameter_mm', 'calcification', 'internalStructure',
+                'lobulation', 'malignancy', 'margin', 'sphericity', 'spiculation', 'subtlety', 'texture'],
+               [a + (6, 1, 1, 3, 3, 3, 1, 3, 5) for a in luna_annotations])
+    utils.save_pkl({'train': luna_pids[:-1] or luna_pids, 'valid': luna_pids[-1:]}, paths['luna_validation_split'])
+
+    settings = {'STAGE': 1,
+                'DATA_PATH_1': paths['dsb'], 'DATA_PATH_2': paths['dsb'],
+                'METADATA_PATH_1': paths['metadata'], 'METADATA_PATH_2': paths['metadata'],
+                'SAMPLE_SUBMISSION_PATH_1': paths['sample_submission'],
+                'SAMPLE_SUBMISSION_PATH_2': paths['sample_submission'],
+                'LABELS_PATH': paths['labels'],
+                'TEST_LABELS_PATH': paths['test_labels'],
+                'VALIDATION_SPLIT_PATH': paths['validation_split'],
+                'FINAL_SPLIT_PATH': paths['final_split'],
+                'LUNA_DATA_PATH': paths['luna'],
+                'LUNA_SEG_DATA_PATH': paths['luna_seg'],
+                'LUNA_LABELS_PATH': paths['luna_labels'],
+                'LUNA_CANDIDATES_PATH': paths['luna_candidates'],
+                'LUNA_VALIDATION_SPLIT_PATH': paths['luna_validation_split'],
+                'LUNA_NODULE_ANNOTATIONS': paths['luna_nodule_annotations'],
+                'VALIDATION_LB_MIXED_SPLIT_PATH': paths['lb_mixed_split'],
+                'LUNA_PROPERTIES_PATH': paths['luna_properties']}
+    for name in ('SETTINGS.json', 'SETTINGS_user.json'):
+        with open(root + '/' + name, 'w') as f:
+            json.dump(settings, f, indent=2)
+
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return paths
+
+
+def activate(root):
+    """
+    Makes pathfinder, when it is imported afterwards, read the settings of the synthetic data tree.
+    pathfinder reads SETTINGS.json from the working directory, so this changes into root.
+    """
+    os.chdir(os.path.abspath(root))
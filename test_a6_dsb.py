@@ -5,6 +5,7 @@ import time
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 from datetime import datetime, timedelta
 import utils
 import logger
@@ -13,6 +14,7 @@ import buffering
 from configuration import config, set_configuration
 import pathfinder
 import utils_plots
+import metrics
 
 theano.config.warn_float64 = 'raise'
 
@@ -73,13 +75,13 @@ givens_valid[model.l_in.input_var] = x_shared
 givens_valid[model.l_target.input_var] = y_shared
 
 # theano functions
-iter_train = theano.function([], train_loss, givens=givens_train, updates=updates)
-iter_validate = theano.function([], nn.layers.get_output(model.l_out, deterministic=True), givens=givens_valid,
-                                on_unused_input='ignore')
+iter_train = compile_cache.function([], train_loss, givens=givens_train, updates=updates)
+iter_validate = compile_cache.function([], nn.layers.get_output(model.l_out, deterministic=True), givens=givens_valid,
+                                       on_unused_input='ignore')
 
 if config().restart_from_save:
     print('Load model parameters for resuming')
-    resume_metadata = utils.load_pkl(config().restart_from_save)
+    resume_metadata = utils.load_model_metadata(config().restart_from_save)
     nn.layers.set_all_param_values(model.l_out, resume_metadata['param_values'])
     start_chunk_idx = resume_metadata['chunks_since_start'] + 1
     chunk_idxs = range(start_chunk_idx, config().max_nchunks)
@@ -106,14 +108,15 @@ print('n chunks per epoch', config().nchunks_per_epoch)
 
 print()
 print('Train model')
+stage_metrics = metrics.open_metrics(expid)
 chunk_idx = 0
 start_time = time.time()
 prev_time = start_time
 tmp_losses_train = []
 losses_train_print = []
 
-for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffering.buffered_gen_threaded(
-        valid_data_iterator.generate())):
+for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, stage_metrics.iterate(
+        buffering.buffered_gen_threaded(valid_data_iterator.generate()))):
     if chunk_idx in learning_rate_schedule:
         lr = np.float32(learning_rate_schedule[chunk_idx])
         print('  setting learning rate to %.7f' % lr)
@@ -121,10 +124,12 @@ for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffe
         learning_rate.set_value(lr)
 
     # load chunk to GPU
-    x_shared.set_value(x_chunk_train)
-    y_shared.set_value(y_chunk_train)
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x_chunk_train)
+        y_shared.set_value(y_chunk_train)
 
-    predictions = iter_validate()
+    with stage_metrics.timer('predict_fn'):
+        predictions = iter_validate()
     print(predictions.shape)
 
     if predictions.shape != x_chunk_train.shape:
@@ -132,13 +137,18 @@ for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffe
         pad_width = [(p, p) for p in pad_width]
         predictions = np.pad(predictions, pad_width=pad_width, mode='constant')
 
-    for i in range(x_chunk_train.shape[0]):
-        pid = id_train[i]
-        for j in range(x_chunk_train.shape[1]):
-            utils_plots.plot_slice_3d_3(input=x_chunk_train[i, j, 0],
-                                        mask=predictions[i, j, 0],
-                                        prediction=predictions[i, j, 0],
-                                        pid='-'.join([str(pid), str(j)]),
-                                        img_dir=outputs_path,
-                                        idx=np.array(x_chunk_train[i, j, 0].shape) / 2,
-                                        axis=0)
+    with stage_metrics.timer('plot'):
+        for i in range(x_chunk_train.shape[0]):
+            pid = id_train[i]
+            for j in range(x_chunk_train.shape[1]):
+                utils_plots.plot_slice_3d_3(input=x_chunk_train[i, j, 0],
+                                            mask=predictions[i, j, 0],
+                                            prediction=predictions[i, j, 0],
+                                            pid='-'.join([str(pid), str(j)]),
+                                            img_dir=outputs_path,
+                                            idx=np.array(x_chunk_train[i, j, 0].shape) / 2,
+                                            axis=0)
+    stage_metrics.add_samples(len(x_chunk_train))
+    stage_metrics.flush(chunk_idx)
+
+stage_metrics.close(chunk_idx)
@@ -3,9 +3,11 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import utils
 import logger
 import buffering
+import metrics
 from configuration import config, set_configuration
 import pathfinder
 import utils_lung
@@ -26,7 +28,7 @@ set = sys.argv[2] if len(sys.argv) == 3 else 'test'
 metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
 metadata_path = utils.find_model_metadata(metadata_dir, config_name)
 
-metadata = utils.load_pkl(metadata_path)
+metadata = utils.load_model_metadata(metadata_path)
 expid = metadata['experiment_id']
 
 # logs
@@ -66,7 +68,9 @@ for layer in all_layers:
 nn.layers.set_all_param_values(model.l_out, metadata['param_values'])
 
 # theano functions
-iter_test = theano.function([model.l_in.input_var], nn.layers.get_output(model.l_out, deterministic=True))
+iter_test = compile_cache.function([model.l_in.input_var], nn.layers.get_output(model.l_out, deterministic=True))
+
+stage_metrics = metrics.open_metrics('%s-%s' % (expid, set))
 
 if set == 'test':
     pid2label = utils_lung.read_test_labels(pathfinder.TEST_LABELS_PATH)
@@ -77,13 +81,17 @@ if set == 'test':
     print('n test: %d' % data_iterator.nsamples)
 
     pid2prediction = {}
-    for i, (x_test, _, id_test) in enumerate(buffering.buffered_gen_threaded(
-            data_iterator.generate())):
-        predictions = iter_test(x_test)
+    for i, (x_test, _, id_test) in enumerate(stage_metrics.iterate(buffering.buffered_gen_threaded(
+            data_iterator.generate()))):
+        with stage_metrics.timer('predict_fn'):
+            predictions = iter_test(x_test)
+        buffering.release(x_test)
         pid = id_test[0]
         print(predictions)
         pid2prediction[pid] = predictions[1] if predictions.shape[-1] == 2 else predictions[0]
         print(i, pid, predictions, pid2label[pid])
+        stage_metrics.add_samples(1)
+        stage_metrics.flush(i, pid=pid)
 
     utils.save_pkl(pid2prediction, output_pkl_file)
     print('Saved validation predictions into pkl', os.path.basename(output_pkl_file))
@@ -104,13 +112,17 @@ elif set == 'valid':
     print('n valid: %d' % data_iterator.nsamples)
 
     pid2prediction, pid2label = {}, {}
-    for i, (x_test, y_test, id_test) in enumerate(buffering.buffered_gen_threaded(
-            data_iterator.generate())):
-        predictions = iter_test(x_test)
+    for i, (x_test, y_test, id_test) in enumerate(stage_metrics.iterate(buffering.buffered_gen_threaded(
+            data_iterator.generate()))):
+        with stage_metrics.timer('predict_fn'):
+            predictions = iter_test(x_test)
+        buffering.release(x_test)
         pid = id_test[0]
         pid2prediction[pid] = predictions[0, 1] if predictions.shape[-1] == 2 else predictions[0]
         pid2label[pid] = y_test[0]
         print(i, pid, predictions, pid2label[pid])
+        stage_metrics.add_samples(1)
+        stage_metrics.flush(i, pid=pid)
 
     utils.save_pkl(pid2prediction, output_pkl_file)
     print('Saved validation predictions into pkl', os.path.basename(output_pkl_file))
@@ -127,22 +139,26 @@ elif set == 'tta_test':
 
 
     pid2prediction = {}
-    for i, (x_test, _, id_test) in enumerate(buffering.buffered_gen_threaded(
-            data_iterator.generate())):
+    for i, (x_test, _, id_test) in enumerate(stage_metrics.iterate(buffering.buffered_gen_threaded(
+            data_iterator.generate()))):
         preds = []
         for bidx, pos in enumerate(range(0,x_test.shape[0],16)):
             print(bidx)
-            predictions = iter_test(x_test[pos:pos+16])
+            with stage_metrics.timer('predict_fn'):
+                predictions = iter_test(x_test[pos:pos+16])
             predictions = predictions[:, 1] if predictions.shape[-1] == 2 else predictions
             #print("predictions", predictions)
             preds.append(predictions)
         
         preds = np.concatenate(preds)
+        buffering.release(x_test)
         pred = np.average(preds)
         pid = id_test
 
         pid2prediction[pid] = pred
         print(i, pid, pred, pid2label[pid])
+        stage_metrics.add_samples(1)
+        stage_metrics.flush(i, pid=pid)
 
 
 
@@ -163,3 +179,5 @@ elif set == 'tta_test':
 
 else:
     raise ValueError('wrong set argument')
+
+stage_metrics.close()
@@ -3,6 +3,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import buffering
 import pathfinder
 import utils
@@ -10,6 +11,7 @@ from configuration import config, set_configuration
 from utils_plots import plot_slice_3d_3
 import utils_lung
 import logger
+import metrics
 
 theano.config.warn_float64 = 'raise'
 
@@ -23,7 +25,7 @@ set_configuration('configs_fpred_patch', config_name)
 metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
 metadata_path = utils.find_model_metadata(metadata_dir, config_name)
 
-metadata = utils.load_pkl(metadata_path)
+metadata = utils.load_model_metadata(metadata_path)
 expid = metadata['experiment_id']
 
 # logs
@@ -63,8 +65,8 @@ givens_valid[model.l_in.input_var] = x_shared
 givens_valid[model.l_target.input_var] = y_shared
 
 # theano functions
-iter_get_predictions = theano.function([], [valid_loss, nn.layers.get_output(model.l_out, deterministic=True)],
-                                       givens=givens_valid)
+iter_get_predictions = compile_cache.function([], [valid_loss, nn.layers.get_output(model.l_out, deterministic=True)],
+                                              givens=givens_valid)
 valid_data_iterator = config().valid_data_iterator
 
 print()
@@ -75,12 +77,17 @@ n_tp, n_tn, n_fp, n_fn = 0, 0, 0, 0
 n_pos = 0
 n_neg = 0
 
+stage_metrics = metrics.open_metrics('%s-test' % expid)
 validation_losses = []
-for n, (x_chunk, y_chunk, id_chunk) in enumerate(buffering.buffered_gen_threaded(valid_data_iterator.generate())):
+for n, (x_chunk, y_chunk, id_chunk) in enumerate(
+        stage_metrics.iterate(buffering.buffered_gen_threaded(valid_data_iterator.generate()))):
     # load chunk to GPU
-    x_shared.set_value(x_chunk)
-    y_shared.set_value(y_chunk)
-    loss, predictions = iter_get_predictions()
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x_chunk)
+        y_shared.set_value(y_chunk)
+    buffering.release(x_chunk)
+    with stage_metrics.timer('predict_fn'):
+        loss, predictions = iter_get_predictions()
     validation_losses.append(loss)
     targets = y_chunk[0, 0]
     p1 = predictions[0][1]
@@ -98,6 +105,8 @@ for n, (x_chunk, y_chunk, id_chunk) in enumerate(buffering.buffered_gen_threaded
         n_neg += 1
 
     print(id_chunk, targets, p1, loss)
+    stage_metrics.add_samples(1)
+    stage_metrics.flush(n, loss=float(loss))
 
 print('Validation loss', np.mean(validation_losses))
 print('TP', n_tp)
@@ -106,3 +115,4 @@ print('FP', n_fp)
 print('FN', n_fn)
 print('n neg', n_neg)
 print('n pos', n_pos)
+stage_metrics.close()
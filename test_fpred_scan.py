@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import pathfinder
 import utils
 from configuration import config, set_configuration
@@ -10,6 +11,7 @@ import theano.tensor as T
 import utils_lung
 import blobs_detection
 import logger
+import metrics
 from collections import defaultdict
 
 theano.config.warn_float64 = 'raise'
@@ -37,10 +39,10 @@ x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
 givens_valid = {}
 givens_valid[model.l_in.input_var] = x_shared
 
-get_predictions_patch = theano.function([],
-                                        nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens_valid,
-                                        on_unused_input='ignore')
+get_predictions_patch = compile_cache.function([],
+                                               nn.layers.get_output(model.l_out, deterministic=True),
+                                               givens=givens_valid,
+                                               on_unused_input='ignore')
 
 data_iterator = config().data_iterator
 
@@ -50,20 +52,32 @@ print('n samples: %d' % data_iterator.nsamples)
 
 nblob2prob, nblob2label = {}, {}
 pid2candidates = defaultdict(list)
-for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
+stage_metrics = metrics.open_metrics(config_name)
+prev_pid = None
+for n, (x, candidate_zyxd, id) in enumerate(stage_metrics.iterate(data_iterator.generate())):
     pid = id[0]
-    x_shared.set_value(x)
-    predictions = get_predictions_patch()
+    if pid != prev_pid and prev_pid is not None:
+        stage_metrics.flush(len(pid2candidates) - 1, pid=prev_pid)
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x)
+    with stage_metrics.timer('predict_fn'):
+        predictions = get_predictions_patch()
+    stage_metrics.add_samples(1)
     label = candidate_zyxd[-1]
     p1 = predictions[0][1]
     nblob2prob[n] = p1
     nblob2label[n] = label
     candidate_zyxdp = np.append(candidate_zyxd, [[p1]])
     pid2candidates[pid].append(candidate_zyxdp)
+    prev_pid = pid
 
+if prev_pid is not None:
+    stage_metrics.flush(len(pid2candidates) - 1, pid=prev_pid)
 
-for k in pid2candidates.iterkeys():
+
+for k in pid2candidates.keys():
     candidates = np.asarray(pid2candidates[k])
-    candidates_wo_dupes = utils_lung.filter_close_neighbors(candidates)
-    a = np.asarray(sorted(candidates_wo_dupes, key=lambda x: x[-1], reverse=True))
+    a = utils_lung.filter_close_neighbors(candidates)
     utils.save_pkl(a, outputs_path + '/%s.pkl' % k)
+
+stage_metrics.close()
@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import os
 
 import pathfinder
@@ -12,6 +13,9 @@ import theano.tensor as T
 import utils_lung
 import blobs_detection
 import logger
+import work_queue
+import metrics
+import profiling
 from collections import defaultdict
 
 theano.config.warn_float64 = 'raise'
@@ -41,14 +45,18 @@ x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
 givens_valid = {}
 givens_valid[model.l_in.input_var] = x_shared
 
-get_predictions_patch = theano.function([],
-                                        nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens_valid,
-                                        on_unused_input='ignore')
+get_predictions_patch = compile_cache.function([],
+                                               nn.layers.get_output(model.l_out, deterministic=True),
+                                               givens=givens_valid,
+                                               on_unused_input='ignore')
 
 
+stage_metrics = metrics.open_metrics(config_name)
+
 if tta == 'tta':
     data_iterator = config().tt_data_iterator
+    queue = work_queue.WorkQueue(work_queue.get_queue_dir(config_name), data_iterator.id2candidates_path.keys())
+    data_iterator.work_queue = queue
 
     #existing_preds = [f.rsplit('.') for f in os.listdir(outputs_path)]
     #print(existing_preds)
@@ -58,9 +66,10 @@ if tta == 'tta':
     print('n samples: %d' % data_iterator.nsamples)
 
     prev_pid = None
+    lost_pid = None
     candidates = []
     patients_count = 0
-    for n, (x, candidate_zyxd, pid) in enumerate(data_iterator.generate()):
+    for n, (x, candidate_zyxd, pid) in enumerate(stage_metrics.iterate(profiling.profile_iterator(data_iterator.generate()))):
 
         if pid != prev_pid and prev_pid is not None:
             print(patients_count, prev_pid, len(candidates))
@@ -68,19 +77,31 @@ if tta == 'tta':
             a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
             utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
             print('saved predictions')
+            queue.complete(prev_pid)
+            stage_metrics.flush(patients_count, pid=prev_pid)
             patients_count += 1
             candidates = []
+
+        if pid == lost_pid:
+            continue
+        if not queue.renew(pid):
+            # the worker that took it over saves the predictions of this patient
+            lost_pid, prev_pid, candidates = pid, None, []
+            continue
         
         preds = []
         for bidx, pos in enumerate(range(0,x.shape[0],16)):
             print(bidx)
             x_batch = x[pos:pos+16]
-            x_shared.set_value(x)
-            predictions = get_predictions_patch()
+            with stage_metrics.timer('set_value'):
+                x_shared.set_value(x)
+            with stage_metrics.timer('predict_fn'):
+                predictions = get_predictions_patch()
             predictions = predictions[:, 1] if predictions.shape[-1] == 2 else predictions
             #print("predictions", predictions)
             preds.append(predictions)
         
+        stage_metrics.add_samples(1)
         preds = np.concatenate(preds)
         pred = np.average(preds)
         candidate_zyxdp = np.append(candidate_zyxd, [[pred]])
@@ -88,14 +109,19 @@ if tta == 'tta':
 
         prev_pid = pid
 
-    # save the last one
-    print(patients_count, prev_pid, len(candidates))
-    candidates = np.asarray(candidates)
-    a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-    utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
-    print('saved predictions')
+    # save the last one, other workers may have leased all the patients
+    if prev_pid is not None:
+        print(patients_count, prev_pid, len(candidates))
+        candidates = np.asarray(candidates)
+        a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
+        utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+        print('saved predictions')
+        queue.complete(prev_pid)
+        stage_metrics.flush(patients_count, pid=prev_pid)
 else:
     data_iterator = config().data_iterator
+    queue = work_queue.WorkQueue(work_queue.get_queue_dir(config_name), data_iterator.id2candidates_path.keys())
+    data_iterator.work_queue = queue
 
     #existing_preds = [f.rsplit('.') for f in os.listdir(outputs_path)]
     #print(existing_preds)
@@ -105,9 +131,10 @@ else:
     print('n samples: %d' % data_iterator.nsamples)
 
     prev_pid = None
+    lost_pid = None
     candidates = []
     patients_count = 0
-    for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
+    for n, (x, candidate_zyxd, id) in enumerate(stage_metrics.iterate(profiling.profile_iterator(data_iterator.generate()))):
         pid = id[0]
 
         if pid != prev_pid and prev_pid is not None:
@@ -116,20 +143,37 @@ else:
             a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
             utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
             print('saved predictions')
+            queue.complete(prev_pid)
+            stage_metrics.flush(patients_count, pid=prev_pid)
             patients_count += 1
             candidates = []
 
-        x_shared.set_value(x)
-        predictions = get_predictions_patch()
+        if pid == lost_pid:
+            continue
+        if not queue.renew(pid):
+            # the worker that took it over saves the predictions of this patient
+            lost_pid, prev_pid, candidates = pid, None, []
+            continue
+
+        with stage_metrics.timer('set_value'):
+            x_shared.set_value(x)
+        with stage_metrics.timer('predict_fn'):
+            predictions = get_predictions_patch()
+        stage_metrics.add_samples(1)
         p1 = predictions[0][1]
         candidate_zyxdp = np.append(candidate_zyxd, [[p1]])
         candidates.append(candidate_zyxdp)
 
         prev_pid = pid
 
-    # save the last one
-    print(patients_count, prev_pid, len(candidates))
-    candidates = np.asarray(candidates)
-    a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-    utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
-    print('saved predictions')
+    # save the last one, other workers may have leased all the patients
+    if prev_pid is not None:
+        print(patients_count, prev_pid, len(candidates))
+        candidates = np.asarray(candidates)
+        a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
+        utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+        print('saved predictions')
+        queue.complete(prev_pid)
+        stage_metrics.flush(patients_count, pid=prev_pid)
+
+stage_metrics.close()
@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import os
 
 import pathfinder
@@ -12,6 +13,8 @@ import theano.tensor as T
 import utils_lung
 import blobs_detection
 import logger
+import metrics
+import profiling
 from collections import defaultdict
 
 theano.config.warn_float64 = 'raise'
@@ -39,12 +42,13 @@ x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
 givens_valid = {}
 givens_valid[model.l_in.input_var] = x_shared
 
-get_predictions_patch = theano.function([],
-                                        nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens_valid,
-                                        on_unused_input='ignore')
+get_predictions_patch = compile_cache.function([],
+                                               nn.layers.get_output(model.l_out, deterministic=True),
+                                               givens=givens_valid,
+                                               on_unused_input='ignore')
 
 data_iterator = config().data_iterator
+stage_metrics = metrics.open_metrics(config_name)
 
 #existing_preds = [f.rsplit('.') for f in os.listdir(outputs_path)]
 #print(existing_preds)
@@ -57,19 +61,23 @@ prev_pid = None
 candidates = []
 patients_count = 0
 max_malignancy = 0.
-for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
+for n, (x, candidate_zyxd, id) in enumerate(stage_metrics.iterate(profiling.profile_iterator(data_iterator.generate()))):
     pid = id[0]
 
     if pid != prev_pid and prev_pid is not None:
         print(patients_count, prev_pid, len(candidates))
         candidates = np.asarray(candidates)
         utils.save_pkl(candidates, outputs_path + '/%s.pkl' % prev_pid)
+        stage_metrics.flush(patients_count, pid=prev_pid)
         patients_count += 1
         candidates = []
 
     #print('x.shape', x.shape)
-    x_shared.set_value(x)
-    predictions = get_predictions_patch()
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x)
+    with stage_metrics.timer('predict_fn'):
+        predictions = get_predictions_patch()
+    stage_metrics.add_samples(1)
     #print('predictions.shape', predictions.shape)
     #print('candidate_zyxd', candidate_zyxd.shape)
 
@@ -83,3 +91,4 @@ for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
 print(patients_count, prev_pid, len(candidates))
 candidates = np.asarray(candidates)
 utils.save_pkl(candidates, outputs_path + '/%s.pkl' % prev_pid)
+stage_metrics.close(patients_count)
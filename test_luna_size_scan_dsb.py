@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import os
 
 import pathfinder
@@ -12,6 +13,7 @@ import theano.tensor as T
 import utils_lung
 import blobs_detection
 import logger
+import metrics
 from collections import defaultdict
 
 theano.config.warn_float64 = 'raise'
@@ -39,10 +41,10 @@ x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
 givens_valid = {}
 givens_valid[model.l_in.input_var] = x_shared
 
-get_predictions_patch = theano.function([],
-                                        nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens_valid,
-                                        on_unused_input='ignore')
+get_predictions_patch = compile_cache.function([],
+                                               nn.layers.get_output(model.l_out, deterministic=True),
+                                               givens=givens_valid,
+                                               on_unused_input='ignore')
 
 data_iterator = config().data_iterator
 
@@ -53,11 +55,12 @@ print()
 print('Data')
 print('n samples: %d' % data_iterator.nsamples)
 
+stage_metrics = metrics.open_metrics(config_name)
 prev_pid = None
 candidates = []
 patients_count = 0
 max_malignancy = 0.
-for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
+for n, (x, candidate_zyxd, id) in enumerate(stage_metrics.iterate(data_iterator.generate())):
     pid = id[0]
 
     if pid != prev_pid and prev_pid is not None:
@@ -67,11 +70,15 @@ for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
         print('max malignancies', a[:10,-1])
         utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
         print('saved predictions')
+        stage_metrics.flush(patients_count, pid=prev_pid)
         patients_count += 1
         candidates = []
 
-    x_shared.set_value(x)
-    predictions = get_predictions_patch()
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x)
+    with stage_metrics.timer('predict_fn'):
+        predictions = get_predictions_patch()
+    stage_metrics.add_samples(1)
     #print('predictions.shape', predictions.shape)
     total_malignancy = np.sum(config().malignancy_weights*predictions)
 
@@ -89,3 +96,5 @@ candidates = np.asarray(candidates)
 a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
 utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
 print('saved predictions')
+stage_metrics.flush(patients_count, pid=prev_pid)
+stage_metrics.close()
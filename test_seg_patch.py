@@ -3,6 +3,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import buffering
 import pathfinder
 import utils
@@ -10,6 +11,7 @@ from configuration import config, set_configuration
 from utils_plots import plot_slice_3d_3
 import utils_lung
 import logger
+import metrics
 
 theano.config.warn_float64 = 'raise'
 
@@ -23,7 +25,7 @@ set_configuration('configs_seg_patch', config_name)
 metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
 metadata_path = utils.find_model_metadata(metadata_dir, config_name)
 
-metadata = utils.load_pkl(metadata_path)
+metadata = utils.load_model_metadata(metadata_path)
 expid = metadata['experiment_id']
 
 # logs
@@ -61,19 +63,23 @@ givens_valid = {}
 givens_valid[model.l_in.input_var] = x_shared
 
 # theano functions
-iter_get_predictions = theano.function([], nn.layers.get_output(model.l_out, deterministic=True), givens=givens_valid)
+iter_get_predictions = compile_cache.function([], nn.layers.get_output(model.l_out, deterministic=True), givens=givens_valid)
 valid_data_iterator = config().valid_data_iterator
 
 print()
 print('Data')
 print('n validation: %d' % valid_data_iterator.nsamples)
 
+stage_metrics = metrics.open_metrics('%s-test' % expid)
 valid_losses_dice = []
 tp = 0
-for n, (x_chunk, y_chunk, id_chunk) in enumerate(buffering.buffered_gen_threaded(valid_data_iterator.generate())):
+for n, (x_chunk, y_chunk, id_chunk) in enumerate(
+        stage_metrics.iterate(buffering.buffered_gen_threaded(valid_data_iterator.generate()))):
     # load chunk to GPU
-    x_shared.set_value(x_chunk)
-    predictions = iter_get_predictions()
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x_chunk)
+    with stage_metrics.timer('predict_fn'):
+        predictions = iter_get_predictions()
     targets = y_chunk
     inputs = x_chunk
 
@@ -90,10 +96,14 @@ for n, (x_chunk, y_chunk, id_chunk) in enumerate(buffering.buffered_gen_threaded
     else:
         print('not detected!!!!')
 
-    for k in range(predictions.shape[0]):
-        plot_slice_3d_3(input=inputs[k, 0], mask=targets[k, 0], prediction=predictions[k, 0],
-                        axis=0, pid='-'.join([str(n), str(k), str(id_chunk[k])]),
-                        img_dir=outputs_path)
+    with stage_metrics.timer('plot'):
+        for k in range(predictions.shape[0]):
+            plot_slice_3d_3(input=inputs[k, 0], mask=targets[k, 0], prediction=predictions[k, 0],
+                            axis=0, pid='-'.join([str(n), str(k), str(id_chunk[k])]),
+                            img_dir=outputs_path)
+    stage_metrics.add_samples(len(x_chunk))
+    stage_metrics.flush(n, dice=float(dice))
 
 print('Dice index validation loss', np.mean(valid_losses_dice))
 print('TP', tp)
+stage_metrics.close()
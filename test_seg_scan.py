@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import pathfinder
 import utils
 from configuration import config, set_configuration
@@ -12,6 +13,7 @@ import logger
 import time
 import multiprocessing as mp
 import buffering
+import metrics
 
 
 def extract_candidates(predictions_scan, annotations, tf_matrix, pid, outputs_path):
@@ -84,10 +86,10 @@ n_windows = config().n_windows
 givens = {}
 givens[model.l_in.input_var] = x_shared
 
-get_predictions_patch = theano.function([],
-                                        nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens,
-                                        on_unused_input='ignore')
+get_predictions_patch = compile_cache.function([],
+                                               nn.layers.get_output(model.l_out, deterministic=True),
+                                               givens=givens,
+                                               on_unused_input='ignore')
 
 valid_data_iterator = config().valid_data_iterator
 
@@ -95,22 +97,26 @@ print()
 print('Data')
 print('n samples: %d' % valid_data_iterator.nsamples)
 
+stage_metrics = metrics.open_metrics(config_name)
 start_time = time.time()
 for n, (x, y, lung_mask, annotations, tf_matrix, pid) in enumerate(
-        buffering.buffered_gen_threaded(valid_data_iterator.generate(), buffer_size=2)):
+        stage_metrics.iterate(buffering.buffered_gen_threaded(valid_data_iterator.generate(), buffer_size=2))):
     print('-------------------------------------')
     print(n, pid)
 
-    predictions_scan = np.zeros((1, 1, n_windows * stride, n_windows * stride, n_windows * stride))
+    predictions_scan = np.zeros((1, 1, n_windows * stride, n_windows * stride, n_windows * stride),
+                                dtype='float32')
 
     for iz in range(n_windows):
         for iy in range(n_windows):
             for ix in range(n_windows):
                 start_time_patch = time.time()
-                x_shared.set_value(x[:, :, iz * stride:(iz * stride) + window_size,
-                                   iy * stride:(iy * stride) + window_size,
-                                   ix * stride:(ix * stride) + window_size])
-                predictions_patch = get_predictions_patch()
+                with stage_metrics.timer('set_value'):
+                    x_shared.set_value(x[:, :, iz * stride:(iz * stride) + window_size,
+                                       iy * stride:(iy * stride) + window_size,
+                                       ix * stride:(ix * stride) + window_size])
+                with stage_metrics.timer('predict_fn'):
+                    predictions_patch = get_predictions_patch()
 
                 predictions_scan[0, 0,
                 iz * stride:(iz + 1) * stride,
@@ -125,21 +131,26 @@ for n, (x, y, lung_mask, annotations, tf_matrix, pid) in enumerate(
     if lung_mask is not None:
         predictions_scan *= lung_mask
 
-    for nodule_n, zyxd in enumerate(annotations):
-        plot_slice_3d_4(input=x[0, 0], mask=y[0, 0], prediction=predictions_scan[0, 0],
-                        lung_mask=lung_mask[0, 0] if lung_mask is not None else x[0, 0],
-                        axis=0, pid='-'.join([str(n), str(nodule_n), str(pid)]),
-                        img_dir=outputs_path, idx=zyxd)
+    with stage_metrics.timer('plot'):
+        for nodule_n, zyxd in enumerate(annotations):
+            plot_slice_3d_4(input=x[0, 0], mask=y[0, 0], prediction=predictions_scan[0, 0],
+                            lung_mask=lung_mask[0, 0] if lung_mask is not None else x[0, 0],
+                            axis=0, pid='-'.join([str(n), str(nodule_n), str(pid)]),
+                            img_dir=outputs_path, idx=zyxd)
     print('saved plot')
     print('time since start:', (time.time() - start_time) / 60.)
 
-    jobs = [job for job in jobs if job.is_alive]
-    if len(jobs) >= 3:
-        jobs[0].join()
-        del jobs[0]
-    jobs.append(
-        mp.Process(target=extract_candidates, args=(predictions_scan, annotations, tf_matrix, pid, outputs_path)))
-    jobs[-1].daemon = True
-    jobs[-1].start()
+    with stage_metrics.timer('blobs_handoff'):
+        jobs = [job for job in jobs if job.is_alive]
+        if len(jobs) >= 3:
+            jobs[0].join()
+            del jobs[0]
+        jobs.append(
+            mp.Process(target=extract_candidates, args=(predictions_scan, annotations, tf_matrix, pid, outputs_path)))
+        jobs[-1].daemon = True
+        jobs[-1].start()
+    stage_metrics.add_samples(1)
+    stage_metrics.flush(n, pid=pid)
 
 for job in jobs: job.join()
+stage_metrics.close()
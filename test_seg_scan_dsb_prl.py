@@ -2,6 +2,7 @@ import sys
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 import pathfinder
 import utils
 from configuration import config, set_configuration
@@ -11,9 +12,13 @@ import logger
 import time
 import multiprocessing as mp
 import buffering
+import utils_lung
+import work_queue
+import metrics
+import shard_planner
 
 
-def extract_candidates(predictions_scan, tf_matrix, pid, outputs_path):
+def extract_candidates(predictions_scan, tf_matrix, pid, outputs_path, queue):
     print('computing blobs')
     start_time = time.time()
     blobs = blobs_detection.blob_dog(predictions_scan[0, 0], min_sigma=1, max_sigma=15, threshold=0.1)
@@ -29,6 +34,7 @@ def extract_candidates(predictions_scan, tf_matrix, pid, outputs_path):
     blobs = np.asarray(blobs_original_voxel_coords)
     print(blobs.shape)
     utils.save_pkl(blobs, outputs_path + '/%s.pkl' % pid)
+    queue.complete(pid)
 
 
 jobs = []
@@ -68,33 +74,38 @@ n_windows = config().n_windows
 givens = {}
 givens[model.l_in.input_var] = x_shared
 
-get_predictions_patch = theano.function([],
-                                        nn.layers.get_output(model.l_out, deterministic=True),
-                                        givens=givens,
-                                        on_unused_input='ignore')
+get_predictions_patch = compile_cache.function([],
+                                               nn.layers.get_output(model.l_out, deterministic=True),
+                                               givens=givens,
+                                               on_unused_input='ignore')
 
 data_iterator = config().data_iterators[data_iterator_part]
+queue = work_queue.WorkQueue(work_queue.get_queue_dir(config_name),
+                             [utils_lung.extract_pid_dir(p) for p in data_iterator.patient_paths])
 
 print()
 print('Data')
 print('n samples: %d' % data_iterator.nsamples)
 
+stage_metrics = metrics.open_metrics('%s-part%d' % (config_name, data_iterator_part))
 start_time = time.time()
 for n, (x, lung_mask, tf_matrix, pid) in enumerate(
-        buffering.buffered_gen_threaded(data_iterator.generate(), buffer_size=2)):
+        stage_metrics.iterate(buffering.buffered_gen_threaded(data_iterator.generate(), buffer_size=2))):
     print('-------------------------------------')
     print(n, pid)
 
-    predictions_scan = np.zeros((1, 1, n_windows * stride, n_windows * stride, n_windows * stride))
+    predictions_scan = np.zeros((1, 1, n_windows * stride, n_windows * stride, n_windows * stride),
+                                dtype='float32')
 
     for iz in range(n_windows):
         for iy in range(n_windows):
             for ix in range(n_windows):
-                start_time_patch = time.time()
-                x_shared.set_value(x[:, :, iz * stride:(iz * stride) + window_size,
-                                   iy * stride:(iy * stride) + window_size,
-                                   ix * stride:(ix * stride) + window_size])
-                predictions_patch = get_predictions_patch()
+                with stage_metrics.timer('set_value'):
+                    x_shared.set_value(x[:, :, iz * stride:(iz * stride) + window_size,
+                                       iy * stride:(iy * stride) + window_size,
+                                       ix * stride:(ix * stride) + window_size])
+                with stage_metrics.timer('predict_fn'):
+                    predictions_patch = get_predictions_patch()
 
                 predictions_scan[0, 0,
                 iz * stride:(iz + 1) * stride,
@@ -102,7 +113,7 @@ for n, (x, lung_mask, tf_matrix, pid) in enumerate(
                 ix * stride:(ix + 1) * stride] = predictions_patch
 
     if predictions_scan.shape != x.shape:
-        pad_width = (np.asarray(x.shape) - np.asarray(predictions_scan.shape)) / 2
+        pad_width = (np.asarray(x.shape) - np.asarray(predictions_scan.shape)) // 2
         pad_width = [(p, p) for p in pad_width]
         predictions_scan = np.pad(predictions_scan, pad_width=pad_width, mode='constant')
 
@@ -112,13 +123,21 @@ for n, (x, lung_mask, tf_matrix, pid) in enumerate(
     print('saved plot')
     print('time since start:', (time.time() - start_time) / 60.)
 
-    jobs = [job for job in jobs if job.is_alive]
-    if len(jobs) >= 3:
-        jobs[0].join()
-        del jobs[0]
-    jobs.append(
-        mp.Process(target=extract_candidates, args=(predictions_scan, tf_matrix, pid, outputs_path)))
-    jobs[-1].daemon = True
-    jobs[-1].start()
+    with stage_metrics.timer('blobs_handoff'):
+        jobs = [job for job in jobs if job.is_alive]
+        if len(jobs) >= 3:
+            jobs[0].join()
+            del jobs[0]
+        jobs.append(
+            mp.Process(target=extract_candidates, args=(predictions_scan, tf_matrix, pid, outputs_path, queue)))
+        jobs[-1].daemon = True
+        jobs[-1].start()
+    stage_metrics.add_samples(1)
+    stage_metrics.flush(n, pid=pid)
 
 for job in jobs: job.join()
+stage_metrics.close()
+
+if data_iterator.predicted_cost is not None:
+    shard_planner.save_shard_timing(config_name, data_iterator_part, data_iterator.predicted_cost,
+                                    time.time() - start_time, data_iterator.nsamples)
@@ -1,16 +1,18 @@
-import pickle
 import string
 import sys
 import time
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 from datetime import datetime, timedelta
 from collections import defaultdict
 import utils
 import logger
 import theano.tensor as T
 import buffering
+import checkpoints
+import metrics
 from configuration import config, set_configuration
 import pathfinder
 
@@ -28,7 +30,7 @@ print()
 
 # metadata
 metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
-metadata_path = metadata_dir + '/%s.pkl' % expid
+metadata_path = metadata_dir + '/%s.npz' % expid
 
 # logs
 logs_dir = utils.get_dir_path('logs', pathfinder.METADATA_PATH)
@@ -82,17 +84,17 @@ train_objectives = [config().d_objectives[obj_name] for obj_name in config().ord
 test_objectives = [config().d_objectives_deterministic[obj_name] for obj_name in config().order_objectives]
 # theano functions
 print(givens_train)
-iter_train = theano.function([idx], train_objectives, givens=givens_train, updates=updates)
+iter_train = compile_cache.function([idx], train_objectives, givens=givens_train, updates=updates)
 
 print('test_objectives')
 print(config().d_objectives_deterministic)
 print('givens_valid')
 print(givens_valid)
-iter_validate = theano.function([], test_objectives, givens=givens_valid)
+iter_validate = compile_cache.function([], test_objectives, givens=givens_valid)
 
 if config().restart_from_save:
     print('Load model parameters for resuming')
-    resume_metadata = utils.load_pkl(config().restart_from_save)
+    resume_metadata = utils.load_model_metadata(config().restart_from_save)
     nn.layers.set_all_param_values(model.l_out, resume_metadata['param_values'])
     start_chunk_idx = resume_metadata['chunks_since_start'] + 1
     chunk_idxs = range(start_chunk_idx, config().max_nchunks)
@@ -119,6 +121,9 @@ print('n chunks per epoch', config().nchunks_per_epoch)
 
 print()
 print('Train model')
+git_revision_hash = utils.get_git_revision_hash()
+checkpoint_writer = checkpoints.AsyncCheckpointWriter(metadata_path, getattr(config(), 'keep_last_checkpoints', 3))
+stage_metrics = metrics.open_metrics(expid)
 chunk_idx = 0
 start_time = time.time()
 prev_time = start_time
@@ -127,8 +132,8 @@ tmp_losses_train = defaultdict(list)
 losses_train_print = defaultdict(list)
 
 # use buffering.buffered_gen_threaded()
-for chunk_idx, (x_chunk_train, y_chunk_train, z_chunk_train, id_train) in zip(chunk_idxs, buffering.buffered_gen_threaded(
-        train_data_iterator.generate())):
+for chunk_idx, (x_chunk_train, y_chunk_train, z_chunk_train, id_train) in zip(chunk_idxs, stage_metrics.iterate(
+        buffering.buffered_gen_threaded(train_data_iterator.generate()))):
     if chunk_idx in learning_rate_schedule:
         lr = np.float32(learning_rate_schedule[chunk_idx])
         print('  setting learning rate to %.7f' % lr)
@@ -136,18 +141,22 @@ for chunk_idx, (x_chunk_train, y_chunk_train, z_chunk_train, id_train) in zip(ch
         learning_rate.set_value(lr)
 
     # load chunk to GPU
-    x_shared.set_value(x_chunk_train)
-    y_shared.set_value(y_chunk_train)
-    if config().need_enable:
-        z_shared.set_value(z_chunk_train)
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x_chunk_train)
+        y_shared.set_value(y_chunk_train)
+        if config().need_enable:
+            z_shared.set_value(z_chunk_train)
+    buffering.release(x_chunk_train, y_chunk_train, z_chunk_train)
 
     # make nbatches_chunk iterations
     for b in range(config().nbatches_chunk):
-        losses = iter_train(b)
+        with stage_metrics.timer('train_fn'):
+            losses = iter_train(b)
         # print(loss)
         for obj_idx, obj_name in enumerate(config().order_objectives):
             tmp_losses_train[obj_name].append(losses[obj_idx])
             losses_train_print[obj_name].append(losses[obj_idx])
+    stage_metrics.add_samples(config().nbatches_chunk * config().batch_size)
 
     if (chunk_idx + 1) % 10 == 0:
         means = []
@@ -156,6 +165,7 @@ for chunk_idx, (x_chunk_train, y_chunk_train, z_chunk_train, id_train) in zip(ch
             means.append(mean)
             print(obj_name, mean)
         print('Chunk %d/%d' % (chunk_idx + 1, config().max_nchunks), sum(means))
+        stage_metrics.flush(chunk_idx, train_loss=float(sum(means)))
         
         losses_train_print = defaultdict(list)
 
@@ -174,18 +184,20 @@ for chunk_idx, (x_chunk_train, y_chunk_train, z_chunk_train, id_train) in zip(ch
 
         # load validation data to GPU
         tmp_losses_valid = defaultdict(list)
-        for i, (x_chunk_valid, y_chunk_valid, z_chunk_valid, ids_batch) in enumerate(
-                buffering.buffered_gen_threaded(valid_data_iterator.generate(),
-                                                buffer_size=2)):
-            x_shared.set_value(x_chunk_valid)
-            y_shared.set_value(y_chunk_valid)
-            if config().need_enable:
-                z_shared.set_value(z_chunk_valid)
-            losses_valid = iter_validate()
-            print(i, losses_valid[0], np.sum(losses_valid))
-            for obj_idx, obj_name in enumerate(config().order_objectives):
-                if z_chunk_valid[0, obj_idx]>0.5:
-                    tmp_losses_valid[obj_name].append(losses_valid[obj_idx])
+        with stage_metrics.timer('validation'):
+            for i, (x_chunk_valid, y_chunk_valid, z_chunk_valid, ids_batch) in enumerate(
+                    buffering.buffered_gen_threaded(valid_data_iterator.generate(),
+                                                    buffer_size=2)):
+                x_shared.set_value(x_chunk_valid)
+                y_shared.set_value(y_chunk_valid)
+                if config().need_enable:
+                    z_shared.set_value(z_chunk_valid)
+                buffering.release(x_chunk_valid, y_chunk_valid)
+                losses_valid = iter_validate()
+                print(i, losses_valid[0], np.sum(losses_valid))
+                for obj_idx, obj_name in enumerate(config().order_objectives):
+                    if z_chunk_valid[0, obj_idx]>0.5:
+                        tmp_losses_valid[obj_name].append(losses_valid[obj_idx])
 
 
         # calculate validation loss across validation set
@@ -214,15 +226,18 @@ for chunk_idx, (x_chunk_train, y_chunk_train, z_chunk_train, id_train) in zip(ch
         print('Chunk %d/%d' % (chunk_idx + 1, config().max_nchunks))
         print('Saving metadata, parameters')
 
-        with open(metadata_path, 'w') as f:
-            pickle.dump({
+        # written in the background, training goes on with the next chunk
+        with stage_metrics.timer('checkpoint'):
+            checkpoint_writer.save({
                 'configuration_file': config_name,
-                'git_revision_hash': utils.get_git_revision_hash(),
+                'git_revision_hash': git_revision_hash,
                 'experiment_id': expid,
                 'chunks_since_start': chunk_idx,
-                'losses_eval_train': losses_eval_train,
-                'losses_eval_valid': losses_eval_valid,
-                'param_values': nn.layers.get_all_param_values(model.l_out)
-            }, f, pickle.HIGHEST_PROTOCOL)
-            print('  saved to %s' % metadata_path)
-            print()
+                'losses_eval_train': dict(losses_eval_train),
+                'losses_eval_valid': dict(losses_eval_valid)
+            }, model.l_out)
+        print()
+
+# wait for the last checkpoint to be written
+checkpoint_writer.close()
+stage_metrics.close(chunk_idx)
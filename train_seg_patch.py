@@ -1,15 +1,17 @@
-import pickle
 import string
 import sys
 import time
 import lasagne as nn
 import numpy as np
 import theano
+import compile_cache
 from datetime import datetime, timedelta
 import utils
 import logger
 import theano.tensor as T
 import buffering
+import checkpoints
+import metrics
 from configuration import config, set_configuration
 import pathfinder
 
@@ -27,7 +29,7 @@ print()
 
 # metadata
 metadata_dir = utils.get_dir_path('models', pathfinder.METADATA_PATH)
-metadata_path = metadata_dir + '/%s.pkl' % expid
+metadata_path = metadata_dir + '/%s.npz' % expid
 
 # logs
 logs_dir = utils.get_dir_path('logs', pathfinder.METADATA_PATH)
@@ -69,18 +71,18 @@ givens_valid[model.l_in.input_var] = x_shared
 givens_valid[model.l_target.input_var] = y_shared
 
 # theano functions
-iter_train = theano.function([idx], train_loss, givens=givens_train, updates=updates)
-iter_get_predictions = theano.function([idx], nn.layers.get_output(model.l_out), givens=givens_train,
-                                       on_unused_input='ignore')
-iter_get_targets = theano.function([idx], nn.layers.get_output(model.l_target), givens=givens_train,
-                                   on_unused_input='ignore')
-iter_get_inputs = theano.function([idx], nn.layers.get_output(model.l_in), givens=givens_train,
-                                  on_unused_input='ignore')
-iter_validate = theano.function([], valid_loss, givens=givens_valid)
+iter_train = compile_cache.function([idx], train_loss, givens=givens_train, updates=updates)
+iter_get_predictions = compile_cache.function([idx], nn.layers.get_output(model.l_out), givens=givens_train,
+                                              on_unused_input='ignore')
+iter_get_targets = compile_cache.function([idx], nn.layers.get_output(model.l_target), givens=givens_train,
+                                          on_unused_input='ignore')
+iter_get_inputs = compile_cache.function([idx], nn.layers.get_output(model.l_in), givens=givens_train,
+                                         on_unused_input='ignore')
+iter_validate = compile_cache.function([], valid_loss, givens=givens_valid)
 
 if config().restart_from_save:
     print('Load model parameters for resuming')
-    resume_metadata = utils.load_pkl(config().restart_from_save)
+    resume_metadata = utils.load_model_metadata(config().restart_from_save)
     nn.layers.set_all_param_values(model.l_out, resume_metadata['param_values'])
     start_chunk_idx = resume_metadata['chunks_since_start'] + 1
     chunk_idxs = range(start_chunk_idx, config().max_nchunks)
@@ -107,14 +109,17 @@ print('n chunks per epoch', config().nchunks_per_epoch)
 
 print()
 print('Train model')
+git_revision_hash = utils.get_git_revision_hash()
+checkpoint_writer = checkpoints.AsyncCheckpointWriter(metadata_path, getattr(config(), 'keep_last_checkpoints', 3))
+stage_metrics = metrics.open_metrics(expid)
 chunk_idx = 0
 start_time = time.time()
 prev_time = start_time
 tmp_losses_train = []
 
 # use buffering.buffered_gen_threaded()
-for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffering.buffered_gen_threaded(
-        train_data_iterator.generate())):
+for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, stage_metrics.iterate(
+        buffering.buffered_gen_threaded(train_data_iterator.generate()))):
     if chunk_idx in learning_rate_schedule:
         lr = np.float32(learning_rate_schedule[chunk_idx])
         print('  setting learning rate to %.7f' % lr)
@@ -122,16 +127,21 @@ for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffe
         learning_rate.set_value(lr)
 
     # load chunk to GPU
-    x_shared.set_value(x_chunk_train)
-    y_shared.set_value(y_chunk_train)
+    with stage_metrics.timer('set_value'):
+        x_shared.set_value(x_chunk_train)
+        y_shared.set_value(y_chunk_train)
+    buffering.release(x_chunk_train, y_chunk_train)
 
     # make nbatches_chunk iterations
     chunk_train_losses = []
     for b in range(config().nbatches_chunk):
-        loss = iter_train(b)
+        with stage_metrics.timer('train_fn'):
+            loss = iter_train(b)
         chunk_train_losses.append(loss)
         tmp_losses_train.append(loss)
+    stage_metrics.add_samples(config().nbatches_chunk * config().batch_size)
     print(chunk_idx, np.mean(chunk_train_losses))
+    stage_metrics.flush(chunk_idx, train_loss=float(np.mean(chunk_train_losses)))
 
     if ((chunk_idx + 1) % config().validate_every) == 0:
         print()
@@ -144,14 +154,16 @@ for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffe
 
         # load validation data to GPU
         tmp_losses_valid = []
-        for i, (x_chunk_valid, y_chunk_valid, ids_batch) in enumerate(
-                buffering.buffered_gen_threaded(valid_data_iterator.generate(),
-                                                buffer_size=2)):
-            x_shared.set_value(x_chunk_valid)
-            y_shared.set_value(y_chunk_valid)
-            l_valid = iter_validate()
-            print(i, l_valid)
-            tmp_losses_valid.append(l_valid)
+        with stage_metrics.timer('validation'):
+            for i, (x_chunk_valid, y_chunk_valid, ids_batch) in enumerate(
+                    buffering.buffered_gen_threaded(valid_data_iterator.generate(),
+                                                    buffer_size=2)):
+                x_shared.set_value(x_chunk_valid)
+                y_shared.set_value(y_chunk_valid)
+                buffering.release(x_chunk_valid, y_chunk_valid)
+                l_valid = iter_validate()
+                print(i, l_valid)
+                tmp_losses_valid.append(l_valid)
 
         # calculate validation loss across validation set
         valid_loss = np.mean(tmp_losses_valid)
@@ -175,15 +187,18 @@ for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, buffe
         print('Chunk %d/%d' % (chunk_idx + 1, config().max_nchunks))
         print('Saving metadata, parameters')
 
-        with open(metadata_path, 'w') as f:
-            pickle.dump({
+        # written in the background, training goes on with the next chunk
+        with stage_metrics.timer('checkpoint'):
+            checkpoint_writer.save({
                 'configuration_file': config_name,
-                'git_revision_hash': utils.get_git_revision_hash(),
+                'git_revision_hash': git_revision_hash,
                 'experiment_id': expid,
                 'chunks_since_start': chunk_idx,
-                'losses_eval_train': losses_eval_train,
-                'losses_eval_valid': losses_eval_valid,
-                'param_values': nn.layers.get_all_param_values(model.l_out)
-            }, f, pickle.HIGHEST_PROTOCOL)
-            print('  saved to %s' % metadata_path)
-            print()
+                'losses_eval_train': list(losses_eval_train),
+                'losses_eval_valid': list(losses_eval_valid)
+            }, model.l_out)
+        print()
+
+# wait for the last checkpoint to be written
+checkpoint_writer.close()
+stage_metrics.close(chunk_idx)
@@ -0,0 +1,273 @@
+"""
+Chunked training loop shared by the training scripts.
+
+Every upload to the GPU holds a chunk of nbatches_chunk batches and theano
+indexes into it with an idx slice, so the transfer and the Python overhead of a
+step are amortized over nbatches_chunk steps. Data iterators that already yield
+whole chunks (batch_size * nbatches_chunk samples) are uploaded as they come.
+Iterators that yield single batches are stacked until a chunk is full; chunk
+indices, learning rate schedules, validate_every and save_every still count
+the items the iterator yields, so the configs keep their meaning.
+
+With config.validate_in_background set, validation runs on parameter
+snapshots in a separate process (see validation_worker.py) while training
+goes on, and its losses are added to losses_eval_valid as they come in. With
+config.cache_validation set, the validation batches are built once and then
+replayed from memory-mapped files (data_iterators.MaterializedDataGenerator).
+"""
+import time
+from datetime import datetime, timedelta
+
+import lasagne as nn
+import numpy as np
+import theano
+import theano.tensor as T
+
+import buffering
+import checkpoints
+import compile_cache
+import data_iterators
+import metrics
+import pathfinder
+import utils
+import validation_worker
+
+
+class ChunkedTrainer(object):
+    def __init__(self, model, train_loss, valid_loss, updates, batch_size, nbatches_chunk=1, stage_metrics=None,
+                 print_valid_batches=False):
+        """
+        :param print_valid_batches: print the targets and ids of every validation batch next to its loss
+        """
+        self.batch_size = batch_size
+        self.print_valid_batches = print_valid_batches
+        self.metrics = stage_metrics if stage_metrics is not None else metrics.NoMetrics()
+        self.nbatches_chunk = nbatches_chunk
+        self.chunk_size = batch_size * nbatches_chunk
+
+        self.x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
+        self.y_shared = nn.utils.shared_empty(dim=len(model.l_target.shape))
+
+        idx = T.lscalar('idx')
+        givens_train = {}
+        givens_train[model.l_in.input_var] = self.x_shared[idx * batch_size:(idx + 1) * batch_size]
+        givens_train[model.l_target.input_var] = self.y_shared[idx * batch_size:(idx + 1) * batch_size]
+
+        givens_valid = {}
+        givens_valid[model.l_in.input_var] = self.x_shared
+        givens_valid[model.l_target.input_var] = self.y_shared
+
+        self.iter_train = compile_cache.function([idx], train_loss, givens=givens_train, updates=updates,
+                                                 name='train')
+        self.iter_validate = compile_cache.function([], valid_loss, givens=givens_valid, name='validate')
+
+    def train_chunk(self, x_chunk, y_chunk):
+        """
+        Uploads a chunk and makes one step per batch in it. Returns the losses.
+        """
+        # the givens slice whole batches, a partial one would train on a smaller batch
+        assert len(x_chunk) % self.batch_size == 0, \
+            'chunk of %d samples is not a multiple of batch_size %d' % (len(x_chunk), self.batch_size)
+        with self.metrics.timer('set_value'):
+            self.x_shared.set_value(x_chunk)
+            self.y_shared.set_value(y_chunk)
+        losses = []
+        for b in range(len(x_chunk) // self.batch_size):
+            with self.metrics.timer('train_fn'):
+                losses.append(self.iter_train(b))
+        self.metrics.add_samples(len(losses) * self.batch_size)
+        return losses
+
+    def validate(self, data_iterator):
+        losses = []
+        for i, (x_chunk_valid, y_chunk_valid, ids_batch) in enumerate(
+                buffering.buffered_gen_threaded(data_iterator.generate(), buffer_size=2)):
+            self.x_shared.set_value(x_chunk_valid)
+            self.y_shared.set_value(y_chunk_valid)
+            l_valid = self.iter_validate()
+            if self.print_valid_batches:
+                print(i, l_valid, y_chunk_valid, ids_batch)
+            else:
+                print(i, l_valid)
+            buffering.release(x_chunk_valid, y_chunk_valid)
+            losses.append(l_valid)
+        return losses
+
+
+def stack_chunks(items):
+    if len(items) == 1:
+        return items[0][0], items[0][1]
+    return np.concatenate([x for x, _ in items]), np.concatenate([y for _, y in items])
+
+
+def get_valid_data_iterator(config, config_name):
+    """
+    The validation iterator of config, replayed from memory-mapped batches after
+    the first pass if config.cache_validation is set (deterministic iterators only).
+    """
+    if getattr(config, 'cache_validation', False):
+        cache_root = utils.get_dir_path('valid-cache', pathfinder.METADATA_PATH)
+        return data_iterators.MaterializedDataGenerator(config.valid_data_iterator, cache_root, config_name)
+    return config.valid_data_iterator
+
+
+def train_model(config, config_name, expid, model, metadata_path, print_every=10, default_nbatches_chunk=1,
+                print_valid_batches=False):
+    """
+    Trains model with the objective, updates, schedules and data iterators of config
+    and checkpoints the parameters and losses to metadata_path (.npz) every
+    config.save_every chunks, in the background.
+    Configs without nbatches_chunk upload default_nbatches_chunk batches at a time.
+    With print_valid_batches, the validation log shows the targets and ids of every batch.
+    """
+    train_loss = config.build_objective(model, deterministic=False)
+    valid_loss = config.build_objective(model, deterministic=True)
+
+    learning_rate_schedule = config.learning_rate_schedule
+    learning_rate = theano.shared(np.float32(learning_rate_schedule[0]))
+    updates = config.build_updates(train_loss, model, learning_rate)
+
+    stage_metrics = metrics.open_metrics(expid)
+    trainer = ChunkedTrainer(model, train_loss, valid_loss, updates, config.batch_size,
+                             getattr(config, 'nbatches_chunk', default_nbatches_chunk), stage_metrics,
+                             print_valid_batches)
+
+    if config.restart_from_save:
+        print('Load model parameters for resuming')
+        resume_metadata = utils.load_model_metadata(config.restart_from_save)
+        nn.layers.set_all_param_values(model.l_out, resume_metadata['param_values'])
+        start_chunk_idx = resume_metadata['chunks_since_start'] + 1
+        chunk_idxs = range(start_chunk_idx, config.max_nchunks)
+
+        lr = np.float32(utils.current_learning_rate(learning_rate_schedule, start_chunk_idx))
+        print('  setting learning rate to %.7f' % lr)
+        learning_rate.set_value(lr)
+        losses_eval_train = resume_metadata['losses_eval_train']
+        losses_eval_valid = resume_metadata['losses_eval_valid']
+    else:
+        chunk_idxs = range(config.max_nchunks)
+        losses_eval_train = []
+        losses_eval_valid = []
+        start_chunk_idx = 0
+
+    train_data_iterator = config.train_data_iterator
+    valid_data_iterator = get_valid_data_iterator(config, config_name)
+
+    print()
+    print('Data')
+    print('n train: %d' % train_data_iterator.nsamples)
+    print('n validation: %d' % valid_data_iterator.nsamples)
+    print('n chunks per epoch', config.nchunks_per_epoch)
+    print('n batches per upload', trainer.nbatches_chunk)
+
+    print()
+    print('Train model')
+    start_time = time.time()
+    prev_time = start_time
+    tmp_losses_train = []
+    losses_train_print = []
+    pending, pending_idxs = [], []
+    git_revision_hash = utils.get_git_revision_hash()
+    checkpoint_writer = checkpoints.AsyncCheckpointWriter(metadata_path, getattr(config, 'keep_last_checkpoints', 3))
+
+    def save_checkpoint(chunk_idx):
+        checkpoint_writer.save({
+            'configuration_file': config_name,
+            'git_revision_hash': git_revision_hash,
+            'experiment_id': expid,
+            'chunks_since_start': chunk_idx,
+            'losses_eval_train': list(losses_eval_train),
+            'losses_eval_valid': list(losses_eval_valid)
+        }, model.l_out)
+
+    validator = None
+    if getattr(config, 'validate_in_background', False):
+        validator = validation_worker.BackgroundValidator(config.__name__, getattr(config, 'validation_device', None))
+
+    def collect_validation_losses(results):
+        for idx, valid_loss in results:
+            print('Validation loss (chunk %d): ' % (idx + 1), valid_loss)
+            losses_eval_valid.append(valid_loss)
+
+    last_chunk_idx = chunk_idxs[-1] if len(chunk_idxs) else -1
+
+    for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in zip(chunk_idxs, stage_metrics.iterate(
+            buffering.buffered_gen_threaded(train_data_iterator.generate()))):
+        pending.append((x_chunk_train, y_chunk_train))
+        pending_idxs.append(chunk_idx)
+        if sum(len(x) for x, _ in pending) < trainer.chunk_size and chunk_idx != last_chunk_idx:
+            continue
+
+        for idx in pending_idxs:
+            if idx in learning_rate_schedule:
+                lr = np.float32(learning_rate_schedule[idx])
+                print('  setting learning rate to %.7f' % lr)
+                print()
+                learning_rate.set_value(lr)
+
+        losses = trainer.train_chunk(*stack_chunks(pending))
+        # the batches were copied by set_value, the data iterator can refill them
+        buffering.release(pending)
+        tmp_losses_train.extend(losses)
+        losses_train_print.extend(losses)
+        idxs, pending, pending_idxs = pending_idxs, [], []
+
+        if validator is not None:
+            collect_validation_losses(validator.poll())
+
+        if any((idx + 1) % print_every == 0 for idx in idxs):
+            print('Chunk %d/%d' % (chunk_idx + 1, config.max_nchunks), np.mean(losses_train_print))
+            stage_metrics.flush(chunk_idx, train_loss=float(np.mean(losses_train_print)))
+            losses_train_print = []
+
+        if any((idx + 1) % config.validate_every == 0 for idx in idxs):
+            print()
+            print('Chunk %d/%d' % (chunk_idx + 1, config.max_nchunks))
+            # calculate mean train loss since the last validation phase
+            mean_train_loss = np.mean(tmp_losses_train)
+            print('Mean train loss: %7f' % mean_train_loss)
+            losses_eval_train.append(mean_train_loss)
+            tmp_losses_train = []
+
+            with stage_metrics.timer('validation'):
+                if validator is not None:
+                    # the loss is added to losses_eval_valid when the validation process reports it
+                    validator.submit(chunk_idx, nn.layers.get_all_param_values(model.l_out))
+                    print('Validation handed to the validation process')
+                else:
+                    # calculate validation loss across validation set
+                    valid_loss = np.mean(trainer.validate(valid_data_iterator))
+                    print('Validation loss: ', valid_loss)
+                    losses_eval_valid.append(valid_loss)
+
+            now = time.time()
+            time_since_start = now - start_time
+            time_since_prev = now - prev_time
+            prev_time = now
+            est_time_left = time_since_start * (config.max_nchunks - chunk_idx + 1.) / (
+                chunk_idx + 1. - start_chunk_idx)
+            eta = datetime.now() + timedelta(seconds=est_time_left)
+            eta_str = eta.strftime("%c")
+            print("  %s since start (%.2f s)" % (utils.hms(time_since_start), time_since_prev))
+            print("  estimated %s to go (ETA: %s)" % (utils.hms(est_time_left), eta_str))
+            print()
+
+        if any((idx + 1) % config.save_every == 0 for idx in idxs):
+            print()
+            print('Chunk %d/%d' % (chunk_idx + 1, config.max_nchunks))
+            print('Saving metadata, parameters')
+
+            with stage_metrics.timer('checkpoint'):
+                save_checkpoint(chunk_idx)
+            print()
+
+    if validator is not None:
+        results = validator.close()
+        collect_validation_losses(results)
+        if results:
+            # store the validation losses that came in after the last save
+            save_checkpoint(last_chunk_idx)
+
+    # wait for the last checkpoint to be written
+    checkpoint_writer.close()
+    stage_metrics.close(last_chunk_idx)
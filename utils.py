@@ -16,7 +16,20 @@ def auto_make_dir(path):
 
 
 def find_model_metadata(metadata_dir, config_name):
-    metadata_paths = glob.glob(metadata_dir + '/%s-*' % config_name)
+    """
+    A pickle converted with checkpoints.py has its .npz next to it: they count as
+    one metadata file and the .npz is returned (like checkpoints.resolve_path).
+    """
+    stem2paths = {}
+    for path in glob.glob(metadata_dir + '/%s-*' % config_name):
+        if path.endswith('.tmp'):
+            continue
+        stem2paths.setdefault(os.path.splitext(path)[0], []).append(path)
+    metadata_paths = []
+    for stem, paths in sorted(stem2paths.items()):
+        if sorted(paths) == [stem + '.npz', stem + '.pkl']:
+            paths = [stem + '.npz']
+        metadata_paths.extend(paths)
     if not metadata_paths:
         raise ValueError('No metadata files for config %s' % config_name)
     elif len(metadata_paths) > 1:
@@ -73,8 +86,15 @@ def get_git_revision_hash():
 
 
 def save_pkl(obj, path):
-    with open(path, 'wb') as f:
-        pickle.dump(obj, f)
+    # through a temporary file, so that a process reading path never sees half a pickle
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def load_pkl(path):
@@ -83,6 +103,16 @@ def load_pkl(path):
     return obj
 
 
+def load_model_metadata(path):
+    """
+    Loads the metadata of a trained model from a checkpoint (.npz) or a pickle.
+    """
+    if path.endswith('.npz'):
+        import checkpoints
+        return checkpoints.load_checkpoint(path)
+    return load_pkl(path)
+
+
 def save_np(obj, path):
     np.save(file=path, arr=obj, fix_imports=True)
 
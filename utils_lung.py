@@ -1,18 +1,21 @@
 import dicom
 import SimpleITK as sitk
 import numpy as np
+import scipy.spatial
 import csv
 import os
 from collections import defaultdict
 import pickle
 import glob
 import utils
+import float32_mode
 
 
 def read_pkl(path):
     d = pickle.load(open(path, "rb"))
     return d['pixel_data'], d['origin'], d['spacing']
 
+@float32_mode.float32_only
 def read_mhd(path):
     itk_data = sitk.ReadImage(path.encode('utf-8'))
     pixel_data = sitk.GetArrayFromImage(itk_data)
@@ -29,6 +32,15 @@ def world2voxel(world_coord, origin, spacing):
 
 def read_dicom(path):
     d = dicom.read_file(path)
+    return np.array(d.pixel_array), get_dicom_metadata(d)
+
+
+def read_dicom_header(path):
+    d = dicom.read_file(path, stop_before_pixels=True)
+    return get_dicom_metadata(d)
+
+
+def get_dicom_metadata(d):
     metadata = {}
     for attr in dir(d):
         if attr[0].isupper() and attr != 'PixelData':
@@ -49,7 +61,7 @@ def read_dicom(path):
     metadata['Columns'] = int(metadata['Columns'])
     metadata['RescaleSlope'] = float(metadata['RescaleSlope'])
     metadata['RescaleIntercept'] = float(metadata['RescaleIntercept'])
-    return np.array(d.pixel_array), metadata
+    return metadata
 
 
 def extract_pid_dir(patient_data_path):
@@ -81,47 +93,139 @@ def get_patient_data(patient_data_path):
     return sid2data, sid2metadata
 
 
-def ct2HU(x, metadata):
-    x = metadata['RescaleSlope'] * x + metadata['RescaleIntercept']
-    x[x < -1000] = -1000
-    return x
+def ct2HU(x, metadata, out=None):
+    """
+    HU as int16, clipped below at -1000. The rescale is exact in integer arithmetic for integer
+    slopes and intercepts (the usual 1 and -1024), other values are rounded to whole HU.
+    """
+    slope, intercept = metadata['RescaleSlope'], metadata['RescaleIntercept']
+    if slope == int(slope) and intercept == int(intercept):
+        x = np.asarray(x, dtype='int32') * int(slope) + int(intercept)
+    else:
+        x = np.rint(np.asarray(x, dtype='float32') * np.float32(slope) + np.float32(intercept))
+    if out is None:
+        out = np.empty(x.shape, dtype='int16')
+    np.clip(x, -1000, np.iinfo('int16').max, out=x)
+    out[...] = x
+    return out
 
 
+@float32_mode.float32_only
 def read_dicom_scan(patient_data_path):
     sid2data, sid2metadata = get_patient_data(patient_data_path)
-    sid2position = {}
-    for sid in sid2data.keys():
-        sid2position[sid] = get_slice_position(sid2metadata[sid])
-    sids_sorted = sorted(sid2position.items(), key=lambda x: x[1])
-    sids_sorted = [s[0] for s in sids_sorted]
-    z_pixel_spacing = []
-    for s1, s2 in zip(sids_sorted[1:], sids_sorted[:-1]):
-        z_pixel_spacing.append(sid2position[s1] - sid2position[s2])
-    z_pixel_spacing = np.array(z_pixel_spacing)
-    try:
-        assert np.all((z_pixel_spacing - z_pixel_spacing[0]) < 0.01)
-    except:
-        print('This patient has multiple series, we will remove one')
-        sids_sorted_2 = []
-        for s1, s2 in zip(sids_sorted[::2], sids_sorted[1::2]):
-            if sid2metadata[s1]["InstanceNumber"] > sid2metadata[s2]["InstanceNumber"]:
-                sids_sorted_2.append(s1)
-            else:
-                sids_sorted_2.append(s2)
-        sids_sorted = sids_sorted_2
-        z_pixel_spacing = []
-        for s1, s2 in zip(sids_sorted[1:], sids_sorted[:-1]):
-            z_pixel_spacing.append(sid2position[s1] - sid2position[s2])
-        z_pixel_spacing = np.array(z_pixel_spacing)
-        assert np.all((z_pixel_spacing - z_pixel_spacing[0]) < 0.01)
+    sids_sorted, pixel_spacing = sort_dicom_scan(sid2metadata)
+    img = np.empty((len(sids_sorted),) + sid2data[sids_sorted[0]].shape, dtype='int16')
+    for i, sid in enumerate(sids_sorted):
+        ct2HU(sid2data[sid], sid2metadata[sid], out=img[i])
+    return img, pixel_spacing
+
+
+def read_dicom_scan_header(patient_data_path):
+    """
+    Shape and pixel spacing of the scan read_dicom_scan returns, from the slice headers only.
+    """
+    sid2metadata = {}
+    for s in os.listdir(patient_data_path):
+        sid2metadata[s.split('.')[0]] = read_dicom_header(patient_data_path + '/' + s)
+    sids_sorted, pixel_spacing = sort_dicom_scan(sid2metadata)
+    metadata = sid2metadata[sids_sorted[0]]
+    return {'shape': (len(sids_sorted), metadata['Rows'], metadata['Columns']),
+            'pixel_spacing': pixel_spacing}
+
+
+def get_dicom_header_cache_dir():
+    import pathfinder
+    return utils.get_dir_path('dicom_headers', pathfinder.METADATA_PATH)
+
+
+def load_dicom_scan_header(patient_data_path, cache_dir=None):
+    """
+    read_dicom_scan_header, cached as <cache_dir>/<pid>.pkl (default <METADATA_PATH>/dicom_headers)
+    """
+    if cache_dir is None:
+        cache_dir = get_dicom_header_cache_dir()
+    cache_path = cache_dir + '/%s.pkl' % extract_pid_dir(patient_data_path)
+    if os.path.isfile(cache_path):
+        return utils.load_pkl(cache_path)
+    header = read_dicom_scan_header(patient_data_path)
+    utils.save_pkl(header, cache_path)
+    return header
+
+
+def sort_dicom_scan(sid2metadata):
+    """
+    Orders the slices of a scan by position, keeping one series if there are several.
+    :return: the sorted slice ids and the zyx pixel spacing
+    """
+    sids = select_series(sid2metadata)
+    positions = get_slice_positions([sid2metadata[sid] for sid in sids])
+    order = np.argsort(positions, kind='mergesort')
+    sids_sorted = [sids[k] for k in order]
+    z_pixel_spacing = np.diff(positions[order])
+    assert np.all((z_pixel_spacing - z_pixel_spacing[0]) < 0.01)
 
     pixel_spacing = np.array((z_pixel_spacing[0],
                               sid2metadata[sids_sorted[0]]['PixelSpacing'][0],
-                              sid2metadata[sids_sorted[0]]['PixelSpacing'][1]))
+                              sid2metadata[sids_sorted[0]]['PixelSpacing'][1]), dtype='float32')
+    return sids_sorted, pixel_spacing
 
-    img = np.stack([ct2HU(sid2data[sid], sid2metadata[sid]) for sid in sids_sorted])
 
-    return img, pixel_spacing
+def has_uniform_spacing(positions, tolerance=0.01):
+    z_pixel_spacing = np.diff(np.sort(positions))
+    return len(z_pixel_spacing) == 0 or np.all(np.abs(z_pixel_spacing - z_pixel_spacing[0]) < tolerance)
+
+
+def select_series(sid2metadata):
+    """
+    The slice ids of one series of a scan: the largest SeriesInstanceUID, and if its slices are not
+    evenly spaced, of the slices at the same position the one with the highest InstanceNumber, or
+    else the longest run of InstanceNumbers with a constant step in position.
+    Ties go to the series with the highest InstanceNumbers.
+    """
+    sids = sorted(sid2metadata.keys())
+    instance_numbers = np.array([sid2metadata[sid]['InstanceNumber'] for sid in sids])
+    series_uids = np.array([str(sid2metadata[sid].get('SeriesInstanceUID', '')) for sid in sids])
+
+    uids, uid_idxs = np.unique(series_uids, return_inverse=True)
+    if len(uids) > 1:
+        print('This patient has multiple series, we will keep the largest')
+        sizes = np.bincount(uid_idxs)
+        max_numbers = np.full(len(uids), -np.inf)
+        np.maximum.at(max_numbers, uid_idxs, instance_numbers)
+        keep = uid_idxs == np.lexsort((max_numbers, sizes))[-1]
+        sids = [sid for sid, k in zip(sids, keep) if k]
+        instance_numbers = instance_numbers[keep]
+
+    positions = get_slice_positions([sid2metadata[sid] for sid in sids])
+    if has_uniform_spacing(positions):
+        return sids
+
+    print('The slices of this patient are not evenly spaced, we will remove some')
+    # slices at the same position: keep the one with the highest InstanceNumber
+    order = np.lexsort((-instance_numbers, positions))
+    first_at_position = np.concatenate(([True], np.diff(positions[order]) >= 0.01))
+    keep = order[first_at_position]
+    if has_uniform_spacing(positions[keep]):
+        return [sids[k] for k in np.sort(keep)]
+
+    # interleaved series: split the slices, in InstanceNumber order, where the step in position changes
+    order = np.argsort(instance_numbers, kind='mergesort')
+    steps = np.diff(positions[order])
+    starts = np.flatnonzero(np.concatenate(([True], np.abs(np.diff(steps)) >= 0.01, [True])))
+    # a run of slices starts[r]..starts[r + 1], as starts index steps, ends one slice later
+    run_lengths = np.diff(starts)
+    r = np.lexsort((instance_numbers[order][starts[1:]], run_lengths))[-1]
+    return [sids[k] for k in np.sort(order[starts[r]:starts[r + 1] + 1])]
+
+
+def get_slice_positions(slices_metadata):
+    """
+    get_slice_position of every slice
+    """
+    orientations = np.array([m['ImageOrientationPatient'] for m in slices_metadata], dtype='float64')
+    positions = np.array([m['ImagePositionPatient'] for m in slices_metadata], dtype='float64')
+    normal_vectors = np.cross(orientations[:, :3], orientations[:, 3:])
+    return np.sum(positions * normal_vectors, axis=1)
 
 
 def sort_slices_position(patient_data):
@@ -151,58 +255,32 @@ def get_slice_position(slice_metadata):
 
 def slice_location_finder(sid2metadata):
     """
+    Positions of the slices along the main axis of their middle pixels, found with PCA and
+    oriented like the slice normals, the lowest at 0.
     :param slicepath2metadata: dict with arbitrary keys, and metadata values
     :return:
     """
-
-    sid2midpix = {}
-    sid2position = {}
-
-    for sid in sid2metadata:
-        metadata = sid2metadata[sid]
-        image_orientation = metadata["ImageOrientationPatient"]
-        image_position = metadata["ImagePositionPatient"]
-        pixel_spacing = metadata["PixelSpacing"]
-        rows = metadata['Rows']
-        columns = metadata['Columns']
-
-        # calculate value of middle pixel
-        F = np.array(image_orientation).reshape((2, 3))
-        # reversed order, as per http://nipy.org/nibabel/dicom/dicom_orientation.html
-        i, j = columns / 2.0, rows / 2.0
-        im_pos = np.array([[i * pixel_spacing[0], j * pixel_spacing[1]]], dtype='float32')
-        pos = np.array(image_position).reshape((1, 3))
-        position = np.dot(im_pos, F) + pos
-        sid2midpix[sid] = position[0, :]
-
-    if len(sid2midpix) <= 1:
-        for sp, midpix in sid2midpix.iteritems():
-            sid2position[sp] = 0.
-    else:
-        # find the keys of the 2 points furthest away from each other
-        max_dist = -1.0
-        max_dist_keys = []
-        for sp1, midpix1 in sid2midpix.iteritems():
-            for sp2, midpix2 in sid2midpix.iteritems():
-                if sp1 == sp2:
-                    continue
-                distance = np.sqrt(np.sum((midpix1 - midpix2) ** 2))
-                if distance > max_dist:
-                    max_dist_keys = [sp1, sp2]
-                    max_dist = distance
-        # project the others on the line between these 2 points
-        # sort the keys, so the order is more or less the same as they were
-        # max_dist_keys.sort(key=lambda x: int(re.search(r'/sax_(\d+)\.pkl$', x).group(1)))
-        p_ref1 = sid2midpix[max_dist_keys[0]]
-        p_ref2 = sid2midpix[max_dist_keys[1]]
-        v1 = p_ref2 - p_ref1
-        v1 /= np.linalg.norm(v1)
-
-        for sp, midpix in sid2midpix.iteritems():
-            v2 = midpix - p_ref1
-            sid2position[sp] = np.inner(v1, v2)
-
-    return sid2position
+    sids = list(sid2metadata.keys())
+    if len(sids) <= 1:
+        return dict((sid, 0.) for sid in sids)
+
+    slices_metadata = [sid2metadata[sid] for sid in sids]
+    orientations = np.array([m['ImageOrientationPatient'] for m in slices_metadata], dtype='float64')
+    image_positions = np.array([m['ImagePositionPatient'] for m in slices_metadata], dtype='float64')
+    pixel_spacings = np.array([m['PixelSpacing'] for m in slices_metadata], dtype='float64')
+    # middle pixel, columns / 2 along the rows and rows / 2 along the columns as per
+    # http://nipy.org/nibabel/dicom/dicom_orientation.html
+    half_size = np.array([[m['Columns'] / 2.0, m['Rows'] / 2.0] for m in slices_metadata])
+    im_pos = half_size * pixel_spacings
+    midpix = image_positions + im_pos[:, :1] * orientations[:, :3] + im_pos[:, 1:] * orientations[:, 3:]
+
+    centered = midpix - midpix.mean(axis=0)
+    axis = np.linalg.svd(centered, full_matrices=False)[2][0]
+    if np.dot(axis, np.cross(orientations[0, :3], orientations[0, 3:])) < 0:
+        axis = -axis
+    positions = centered.dot(axis)
+    positions -= positions.min()
+    return dict(zip(sids, positions))
 
 
 def get_patient_data_paths(data_dir):
@@ -283,34 +361,63 @@ def write_submission(pid2prediction, submission_path):
     f.close()
 
 
-def filter_close_neighbors(candidates, min_dist=16):
-    #TODO pixelspacing should be added , it is now hardcoded 
-    candidates_wo_dupes = set()
-    no_pairs = 0
-    for can1 in candidates:
-        found_close_candidate = False
-        swap_candidate = None
-        for can2 in candidates_wo_dupes:
-            if (can1 == can2).all():
-                raise "Candidate should not be in the target array yet"
-            else:
-                delta = can1[:3] - can2[:3]
-                delta[0] = 2.5*delta[0] #zyx coos
-                dist = np.sum(delta**2)**(1./2)
-                if dist<min_dist:
-                    no_pairs += 1
-                    print('Warning: there is a pair nodules close together',  can1[:3], can2[:3])
-                    found_close_candidate = True
-                    if can1[4]>can2[4]:
-                        swap_candidate = can2
-                    break
-        if not found_close_candidate:
-            candidates_wo_dupes.add(tuple(can1))
-        elif swap_candidate:
-            candidates_wo_dupes.remove(swap_candidate)
-            candidates_wo_dupes.add(tuple(can1))
-    print('n candidates filtered out', no_pairs)
-    return candidates_wo_dupes
+def filter_close_neighbors(candidates, min_dist=16, pixel_spacing=(2.5, 1., 1.), scores=None):
+    """
+    Non-maximum suppression of candidates closer than min_dist mm to a higher scoring one.
+    :param candidates: rows of zyx voxel coordinates followed by other columns, the score in column 4
+    :param pixel_spacing: zyx voxel size in mm, the default weighs z like the old hardcoded 2.5 factor
+    :param scores: score per candidate, instead of column 4
+    :return: float32 array of the kept candidates, by decreasing score
+    """
+    candidates = np.asarray(candidates, dtype='float32')
+    if len(candidates) == 0:
+        return candidates.reshape((0,) + candidates.shape[1:])
+    scores = candidates[:, 4] if scores is None else np.asarray(scores)
+    order = np.argsort(-scores, kind='mergesort')
+    candidates = candidates[order]
+
+    coords_mm = candidates[:, :3] * np.asarray(pixel_spacing, dtype='float32')
+    tree = scipy.spatial.cKDTree(coords_mm)
+    # query_pairs includes the pairs at exactly min_dist, the suppression radius is exclusive
+    pairs = tree.query_pairs(np.nextafter(min_dist, 0), output_type='ndarray')
+
+    keep = np.ones(len(candidates), dtype='bool')
+    if len(pairs):
+        # every pair as (higher scoring, lower scoring), grouped by the higher scoring one
+        pairs = np.sort(pairs, axis=1)
+        pairs = pairs[np.argsort(pairs[:, 0], kind='mergesort')]
+        starts = np.searchsorted(pairs[:, 0], np.arange(len(candidates) + 1))
+        for i in np.unique(pairs[:, 0]):
+            if keep[i]:
+                keep[pairs[starts[i]:starts[i + 1], 1]] = False
+
+    print('n candidates filtered out', len(candidates) - np.sum(keep))
+    return candidates[keep]
+
+
+def logodds2p(lo):
+    lo = np.asarray(lo, dtype='float64')
+    # 0 and 1 beyond +-500 to prevent under- and overflow
+    p = 1. / (1. + np.exp(-np.clip(lo, -500., 500.)))
+    return np.where(lo < -500, 0., np.where(lo > 500, 1., p))
+
+
+def rank_candidates(candidates, scores, n_selection=None):
+    """
+    Rows [z, y, x, score] of the candidates with the n_selection highest scores, by decreasing score.
+    Equal scores keep the order of the candidates.
+    """
+    candidates = np.asarray(candidates)
+    scores = np.asarray(scores, dtype='float64').reshape(-1)
+    # a stable sort, so the ties at the n_selection boundary are decided by order as well
+    idxs = np.argsort(-scores, kind='mergesort')
+    if n_selection:
+        idxs = idxs[:n_selection]
+    ranked = np.empty((len(idxs), 4), dtype='float32')
+    ranked[:, :3] = candidates[idxs, :3]
+    ranked[:, 3] = scores[idxs]
+    return ranked
+
 
 def dice_index(predictions, targets, epsilon=1e-12):
     predictions = np.asarray(predictions).flatten()
@@ -337,7 +444,7 @@ def get_generated_pids(predictions_dir):
 def evaluate_log_loss(pid2prediction, pid2label):
     predictions, labels = [], []
     assert set(pid2prediction.keys()) == set(pid2label.keys())
-    for k, v in pid2prediction.iteritems():
+    for k, v in pid2prediction.items():
         predictions.append(v)
         labels.append(pid2label[k])
     return log_loss(labels, predictions)
@@ -0,0 +1,113 @@
+"""
+Validation in a separate process, so that training does not stop for it.
+
+The worker builds the model of the configuration and compiles its own
+validation function. The training loop hands it parameter snapshots and picks
+up the validation losses whenever they are ready. At most one snapshot waits
+next to the one being validated: a submit blocks until the worker has taken the
+previous one, so a slow validation does not pile up copies of the model. The
+worker is started with 'spawn' and imports theano only after it sets the
+device, so it can run on another GPU or on the CPU (config.validation_device)
+and does not share the CUDA context of the training process.
+"""
+import multiprocessing as mp
+import os
+import queue
+
+
+def _validation_process(config_module_name, device, params_queue, results_queue):
+    if device is not None:
+        theano_flags = os.environ.get('THEANO_FLAGS')
+        os.environ['THEANO_FLAGS'] = '%s,device=%s' % (theano_flags, device) if theano_flags else 'device=%s' % device
+
+    import lasagne as nn
+    import numpy as np
+
+    import buffering
+    import compile_cache
+    import training
+    from configuration import config, set_configuration
+
+    set_configuration(*config_module_name.rsplit('.', 1))
+    model = config().build_model()
+    valid_loss = config().build_objective(model, deterministic=True)
+
+    x_shared = nn.utils.shared_empty(dim=len(model.l_in.shape))
+    y_shared = nn.utils.shared_empty(dim=len(model.l_target.shape))
+    givens_valid = {}
+    givens_valid[model.l_in.input_var] = x_shared
+    givens_valid[model.l_target.input_var] = y_shared
+    iter_validate = compile_cache.function([], valid_loss, givens=givens_valid, name='validate')
+
+    valid_data_iterator = training.get_valid_data_iterator(config(), config_module_name.rsplit('.', 1)[1])
+
+    for chunk_idx, param_values in iter(params_queue.get, None):
+        nn.layers.set_all_param_values(model.l_out, param_values)
+        losses = []
+        for x_chunk_valid, y_chunk_valid, ids_batch in buffering.buffered_gen_threaded(
+                valid_data_iterator.generate(), buffer_size=2):
+            x_shared.set_value(x_chunk_valid)
+            y_shared.set_value(y_chunk_valid)
+            buffering.release(x_chunk_valid, y_chunk_valid)
+            losses.append(iter_validate())
+        results_queue.put((chunk_idx, float(np.mean(losses))))
+
+
+class BackgroundValidator(object):
+    def __init__(self, config_module_name, device=None):
+        ctx = mp.get_context('spawn')
+        # one snapshot waiting, the worker holds the one it validates
+        self._params_queue = ctx.Queue(maxsize=1)
+        self._results_queue = ctx.Queue()
+        self._process = ctx.Process(target=_validation_process,
+                                    args=(config_module_name, device, self._params_queue, self._results_queue))
+        self._process.daemon = True
+        self._process.start()
+        self.n_pending = 0
+
+    def submit(self, chunk_idx, param_values):
+        """
+        Queues the validation of a parameter snapshot taken after chunk chunk_idx.
+        Blocks while the previous snapshot is still waiting for the worker.
+        """
+        while True:
+            try:
+                self._params_queue.put((chunk_idx, param_values), timeout=10)
+                break
+            except queue.Full:
+                if not self._process.is_alive():
+                    raise RuntimeError('validation process died')
+        self.n_pending += 1
+
+    def poll(self):
+        """
+        Returns the (chunk_idx, validation loss) pairs that finished since the last call.
+        """
+        results = []
+        while self.n_pending:
+            try:
+                results.append(self._results_queue.get_nowait())
+            except queue.Empty:
+                break
+            self.n_pending -= 1
+        return results
+
+    def close(self):
+        """
+        Waits for the pending validations and stops the worker. Returns their results.
+        """
+        results = []
+        while self.n_pending:
+            try:
+                results.append(self._results_queue.get(timeout=10))
+            except queue.Empty:
+                if not self._process.is_alive():
+                    break
+                continue
+            self.n_pending -= 1
+        if self.n_pending:
+            print('validation process died with %d validations pending' % self.n_pending)
+        if self._process.is_alive():
+            self._params_queue.put(None)
+        self._process.join()
+        return results
@@ -0,0 +1,159 @@
+"""
+Work queue on a (shared) filesystem for scan-level inference.
+
+Instead of splitting the patients into static parts, any number of workers, on
+one or several nodes sharing the filesystem, lease patients one at a time:
+
+    queue_dir/lock           lockf() lock that serializes all queue updates
+    queue_dir/leases/<pid>   worker id and expiry time of a running patient
+    queue_dir/done/<pid>     completion marker, written after the outputs are saved
+
+A lease that is not renewed or completed before it expires (e.g. the worker
+died) is handed out again, so the consumers call renew() while they work on a
+patient and drop it when renew() returns False. A patient is finished if it has a
+completion marker or, for outputs written before there was a queue, an output file
+(utils.save_pkl writes them atomically, so they are never half written).
+"""
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+import utils
+
+
+class WorkQueue(object):
+    def __init__(self, queue_dir, items, lease_timeout=3 * 3600, worker_id=None):
+        """
+        :param queue_dir: directory shared by all workers of this queue
+        :param items: patient ids, leased in this order
+        :param lease_timeout: seconds after which an unrenewed lease is handed out again
+        """
+        self.queue_dir = queue_dir
+        self.items = list(items)
+        self.lease_timeout = lease_timeout
+        self.worker_id = worker_id or '%s-%d' % (utils.hostname(), os.getpid())
+        # when this worker last wrote the lease of each item it holds
+        self.renewed_at = {}
+        self.leases_dir = queue_dir + '/leases'
+        self.done_dir = queue_dir + '/done'
+        utils.auto_make_dir(self.leases_dir)
+        utils.auto_make_dir(self.done_dir)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.queue_dir + '/lock', 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def _read_lease(self, item):
+        try:
+            with open(self.leases_dir + '/' + item) as f:
+                worker_id, expires = f.read().split()
+            return worker_id, float(expires)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_lease(self, item):
+        path = self.leases_dir + '/' + item
+        now = time.time()
+        with open(path + '.tmp', 'w') as f:
+            f.write('%s %f' % (self.worker_id, now + self.lease_timeout))
+        os.rename(path + '.tmp', path)
+        self.renewed_at[item] = now
+
+    def is_completed(self, item):
+        return os.path.isfile(self.done_dir + '/' + item)
+
+    def lease(self):
+        """
+        Returns the next patient that is neither completed nor leased by a live worker,
+        or None if there is no such patient.
+        """
+        with self._locked():
+            now = time.time()
+            for item in self.items:
+                if self.is_completed(item):
+                    continue
+                lease = self._read_lease(item)
+                if lease is not None and lease[1] > now:
+                    continue
+                if lease is not None:
+                    print('work queue: lease of %s by %s expired, taking it over' % (item, lease[0]))
+                self._write_lease(item)
+                return item
+        return None
+
+    def renew(self, item, min_interval=None):
+        """
+        Extends the lease of this worker on item. Returns False, without touching
+        the lease, if it expired and was taken over (or completed) by another worker:
+        the caller should then drop the item.
+
+        :param min_interval: seconds since the last renewal below which nothing is
+            done (default: a tenth of lease_timeout), so that it can be called per batch
+        """
+        if min_interval is None:
+            min_interval = self.lease_timeout / 10.
+        if time.time() - self.renewed_at.get(item, -float('inf')) < min_interval:
+            return True
+        with self._locked():
+            lease = self._read_lease(item)
+            if lease is None or lease[0] != self.worker_id:
+                print('work queue: lost the lease on %s' % item)
+                self.renewed_at.pop(item, None)
+                return False
+            self._write_lease(item)
+            return True
+
+    def complete(self, item):
+        with self._locked():
+            with open(self.done_dir + '/' + item, 'w') as f:
+                f.write('%s %f' % (self.worker_id, time.time()))
+            lease = self._read_lease(item)
+            if lease is not None and lease[0] == self.worker_id:
+                os.remove(self.leases_dir + '/' + item)
+        self.renewed_at.pop(item, None)
+
+    def release(self, item):
+        """
+        Gives a leased patient back to the queue without completing it.
+        """
+        with self._locked():
+            lease = self._read_lease(item)
+            if lease is not None and lease[0] == self.worker_id:
+                os.remove(self.leases_dir + '/' + item)
+        self.renewed_at.pop(item, None)
+
+    def completed_items(self):
+        return sorted(os.listdir(self.done_dir))
+
+    def __iter__(self):
+        while True:
+            item = self.lease()
+            if item is None:
+                break
+            yield item
+
+
+def get_queue_dir(queue_name):
+    import pathfinder
+    return utils.get_dir_path('work-queues', pathfinder.METADATA_PATH) + '/' + queue_name
+
+
+def get_completed_pids(queue_name, predictions_dir):
+    """
+    Patients that were completed through the queue, and the patients that already
+    have a file in predictions_dir, e.g. from runs before the queue existed.
+    """
+    import utils_lung
+    done_dir = get_queue_dir(queue_name) + '/done'
+    pids = set(os.listdir(done_dir)) if os.path.isdir(done_dir) else set()
+    if os.path.isdir(predictions_dir):
+        # not the temporary files of an output that is being written
+        pids.update(utils_lung.extract_pid_filename(f) for f in os.listdir(predictions_dir)
+                    if not f.endswith('.tmp'))
+    return sorted(pids)